@@ -6,6 +6,8 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from db_engine import engine_options, apply_profile, log_profile
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -22,24 +24,71 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)  # needed for url_for
 
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///whatsapp_integration.db")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+# Opções do engine de acordo com o banco (ver db_engine)
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 # Initialize the app with the extension
 db.init_app(app)
 
+# Processos servindo a API (workers do gunicorn ou do uvicorn); cada um tem seu estado em memória
+WEB_CONCURRENCY = max(int(os.environ.get('WEB_CONCURRENCY', '1')), 1)
+# Com preload_app (gunicorn.conf.py) as tarefas em segundo plano iniciam em cada worker, após o fork
+WEB_PREFORK = os.environ.get('WEB_PREFORK') == '1'
+
 with app.app_context():
-    # Make sure to import the models here or their tables won't be created
-    import models  # noqa: F401
+    apply_profile(db.engine)
+
+# Make sure to import the models here so that the schema migrations know their tables
+import models  # noqa: F401, E402
+
+
+def prepare_database():
+    """Checks the schema version (upgrading it with SCHEMA_AUTO_MIGRATE) and logs the engine profile"""
+    from schema import ensure_schema
+
+    with app.app_context():
+        log_profile(db.engine)
+        ensure_schema(db)
+
+
+def start_background_tasks():
+    """Starts the background threads of this process"""
+    from webhook_dispatcher import webhook_dispatcher, WEBHOOK_DISPATCHER_ENABLED
+    from send_jobs import send_job_queue, SEND_JOBS_ENABLED
+    from bridge_supervisor import bridge_supervisor, BRIDGE_SUPERVISOR_ENABLED
+    from session_events import session_event_relay, SSE_RELAY_ENABLED
+    from metrics import snapshot_writer, METRICS_MULTIPROC_DIR
+
+    # Iniciar o despachante de webhooks (entrega assíncrona com retentativas)
+    if WEBHOOK_DISPATCHER_ENABLED:
+        webhook_dispatcher.start()
+    # Iniciar a fila de envios assíncronos (?async=1 nas rotas de mídia)
+    if SEND_JOBS_ENABLED:
+        send_job_queue.start()
+    # Monitorar os bridges Node.js (health checks e reinício automático)
+    if BRIDGE_SUPERVISOR_ENABLED:
+        bridge_supervisor.start_monitor()
+    # Com vários workers, repassar ao stream de status as mudanças feitas pelos outros
+    if SSE_RELAY_ENABLED:
+        session_event_relay.start()
+    # Com vários workers, publicar as métricas deste para os scrapes respondidos pelos outros
+    if METRICS_MULTIPROC_DIR is not None:
+        snapshot_writer.start()
 
-    logger.info("Creating database tables...")
-    db.create_all()
-    logger.info("Database tables created successfully.")
 
 def init_app():
     """Inicializa a aplicação e registra as rotas"""
-    import routes  # noqa: F401, E402
+    import routes  # noqa: F401
+    import metrics
+    import tracing
+
+    prepare_database()
+    # Métricas de latência das requisições e das consultas (GET /metrics)
+    # e rastreamento opcional das requisições (GET /api/debug/traces)
+    with app.app_context():
+        metrics.init_app(app, db.engine)
+        tracing.init_app(app, db.engine)
+    if not WEB_PREFORK:
+        start_background_tasks()
     return app
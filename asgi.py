@@ -0,0 +1,293 @@
+"""
+ASGI entry point (async serving mode).
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:5000 asgi:application
+
+The routes that only forward a message to a bridge (send-text, send-image,
+send-document, send-audio with a JSON body, seen and typing) are served on the event
+loop: they wait for the send scheduler and for the bridge without holding a thread, so
+thousands of sends can be in flight in one process. The session status stream is also
+served on the loop, one coroutine per dashboard (SSE_MAX_ASYNC_SUBSCRIBERS). Every other
+request (CRUD, uploads, media, ?async=1 sends) runs the unchanged Flask app through
+a2wsgi on a pool of ASGI_WSGI_THREADS threads.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+
+import metrics
+from app import init_app
+from bridge_client import async_bridge_client, BridgeError, BRIDGE_TYPING_TIMEOUT
+from message_sender import (build_text_payload, build_image_payload, build_document_payload, build_audio_payload,
+                            send_payload_async)
+from session_events import session_events, subscriber_limit
+from session_registry import session_registry
+from tracing import tracer, TRACE_HEADER
+
+logger = logging.getLogger(__name__)
+
+# Threads running the Flask (WSGI) routes
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '32'))
+# Largest JSON body handled on the event loop; bigger sends are passed to Flask
+ASGI_NATIVE_MAX_BODY = int(os.environ.get('ASGI_NATIVE_MAX_BODY', str(32 * 1024 * 1024)))
+
+STREAM_PATH = '/api/sessions/stream'
+NATIVE_ROUTE = re.compile(r'^/api/sessions/(\d+)/(send-text|send-image|send-document|send-audio|seen|typing)$')
+# route -> endpoint of the equivalent Flask view (metrics labels)
+NATIVE_ENDPOINTS = {
+    'send-text': 'send_text_message',
+    'send-image': 'send_image_message',
+    'send-document': 'send_document_message',
+    'send-audio': 'send_audio_message',
+    'seen': 'mark_chat_as_seen',
+    'typing': 'start_typing',
+}
+# route -> (message type, payload builder, label of the log and error messages, success message)
+SEND_ROUTES = {
+    'send-text': ('text', build_text_payload, 'message', "Message sent successfully"),
+    'send-image': ('image', build_image_payload, 'image', "Image sent successfully"),
+    'send-document': ('document', build_document_payload, 'document', "Document sent successfully"),
+    'send-audio': ('audio', build_audio_payload, 'audio', "Audio sent successfully"),
+}
+
+
+def _replay(receive, body, more):
+    """receive() that first returns the body already read by a native route"""
+    replayed = False
+
+    async def replay():
+        nonlocal replayed
+        if not replayed:
+            replayed = True
+            return {'type': 'http.request', 'body': body, 'more_body': more}
+        return await receive()
+    return replay
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class AsgiApplication:
+    """Serves the bridge-forwarding routes natively and the rest of the Flask app on threads"""
+
+    def __init__(self, wsgi_app, threads=ASGI_WSGI_THREADS):
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=threads)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['path'] == STREAM_PATH and scope['method'] == 'GET':
+                return await self._stream_sessions(scope, receive, send)
+            match = NATIVE_ROUTE.match(scope['path'])
+            if match and scope['method'] == 'POST' and self._is_native(scope):
+                await self._native(scope, receive, send, int(match.group(1)), match.group(2))
+            else:
+                await self._wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.wsgi.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def _is_native(scope):
+        content_type = b''
+        for name, value in scope.get('headers', []):
+            if name == b'content-type':
+                content_type = value
+        if content_type.split(b';')[0].strip().lower() != b'application/json':
+            return False  # Uploads e corpos não JSON seguem pelo Flask
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        return query.get('async') != ['1']
+
+    # --- Flask on the thread pool ---
+
+    async def _wsgi(self, scope, receive, send, head=None, more=True):
+        if head is not None:
+            # Corpo já lido pela rota nativa: o Flask o recebe de novo
+            receive = _replay(receive, head, more)
+        await self.wsgi(scope, receive, send)
+
+    # --- Native bridge-forwarding routes ---
+
+    @staticmethod
+    async def _json(send, status, body):
+        with tracer.phase('response'):
+            data = (json.dumps(body, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+        headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(data)).encode('latin-1')),
+        ]
+        trace_id = tracer.current_id()
+        if trace_id is not None:
+            headers.append((TRACE_HEADER.lower().encode('latin-1'), trace_id.encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': data})
+
+    async def _stream_sessions(self, scope, receive, send):
+        """Session status stream (Server-Sent Events) served on the event loop"""
+        started_at = time.perf_counter()
+        last_event_id = next((value.decode('latin-1') for name, value in scope.get('headers', [])
+                              if name == b'last-event-id'), None)
+        stream = session_events.subscribe_async(last_event_id)
+        if stream is None:
+            # O painel volta ao polling quando o limite de conexões é atingido
+            await self._json(send, 503, {"error": "Too many status stream subscribers"})
+            status = 503
+        else:
+            status = 200
+        if metrics.METRICS_ENABLED:
+            metrics.observe_request('stream_sessions', 'GET', status, None, time.perf_counter() - started_at)
+        if stream is None:
+            return
+        # O primeiro next() inicia o gerador, cujo finally libera a vaga do assinante
+        chunk = await stream.__anext__()
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        pending = None
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ]})
+            while chunk is not None:
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+                pending = asyncio.ensure_future(anext(stream, None))
+                await asyncio.wait([pending, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    break
+                chunk = pending.result()
+                pending = None
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            if pending is not None:
+                pending.cancel()
+                await asyncio.wait([pending])
+            await stream.aclose()
+
+    async def _native(self, scope, receive, send, session_id, route):
+        started_at = time.perf_counter()
+        head = b''
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            head += message.get('body', b'')
+            more = message.get('more_body', False)
+            if len(head) > ASGI_NATIVE_MAX_BODY:
+                return await self._wsgi(scope, receive, send, head, more)
+
+        try:
+            data = json.loads(head)
+        except ValueError:
+            data = None
+        state = session_registry.peek(session_id)
+        if state is None:
+            state = await asyncio.to_thread(session_registry.get, session_id)
+        if not isinstance(data, dict) or state is None:
+            # Sessão inexistente ou JSON inválido: respostas de erro do próprio Flask
+            return await self._wsgi(scope, receive, send, head, False)
+
+        if metrics.METRICS_ENABLED:
+            metrics.http_requests_in_flight.inc()
+        trace_token = None
+        if tracer.enabled:
+            trace_id = next((value.decode('latin-1') for name, value in scope.get('headers', [])
+                             if name == TRACE_HEADER.lower().encode('latin-1')), None)
+            trace_token = tracer.start(NATIVE_ENDPOINTS[route], trace_id)
+        status = 500
+        try:
+            if state.status != 'connected':
+                status, body = 400, {"error": "WhatsApp session is not connected"}
+            elif route == 'seen':
+                status, body = await self._seen(session_id, data)
+            elif route == 'typing':
+                status, body = await self._typing(session_id, data)
+            else:
+                status, body = await self._send(session_id, route, data)
+            await self._json(send, status, body)
+        finally:
+            if trace_token is not None:
+                tracer.finish(trace_token, status)
+            if metrics.METRICS_ENABLED:
+                metrics.http_requests_in_flight.dec()
+                metrics.observe_request(NATIVE_ENDPOINTS[route], 'POST', status, session_id,
+                                        time.perf_counter() - started_at)
+
+    @staticmethod
+    async def _send(session_id, route, data):
+        message_type, build_payload, label, success = SEND_ROUTES[route]
+        try:
+            req_data = build_payload(data)
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        try:
+            response_data = await send_payload_async(session_id, message_type, req_data)
+            logger.info(f"{label.capitalize()} sent to {req_data['chatId']} via session {session_id}")
+            if message_type == 'text':
+                return 200, {"success": True, "message": success}
+            return 200, {"success": True, "message": success, "messageId": response_data.get('messageId')}
+        except BridgeError as e:
+            logger.error(f"Error sending {label}: {e.message}")
+            return e.status_code, {"error": f"Failed to send {label}: {e.message}"}
+        except Exception as e:
+            logger.error(f"Error sending {label}: {str(e)}")
+            return 500, {"error": str(e)}
+
+    @staticmethod
+    async def _seen(session_id, data):
+        if not data.get('chatId'):
+            return 400, {"error": "chatId is required"}
+        try:
+            await async_bridge_client.post(session_id, '/api/seen', {"chatId": data.get('chatId')})
+            logger.info(f"Chat {data.get('chatId')} marked as seen via session {session_id}")
+            return 200, {"success": True, "message": "Chat marked as seen"}
+        except BridgeError as e:
+            logger.error(f"Error marking chat as seen: {e.message}")
+            return e.status_code, {"error": f"Failed to mark chat as seen: {e.message}"}
+        except Exception as e:
+            logger.error(f"Error marking chat as seen: {str(e)}")
+            return 500, {"error": str(e)}
+
+    @staticmethod
+    async def _typing(session_id, data):
+        if not data.get('chatId'):
+            return 400, {"error": "chatId is required"}
+        duration = data.get('duration', 3000)
+        try:
+            await async_bridge_client.post(session_id, '/api/typing', {
+                "chatId": data.get('chatId'),
+                "duration": duration
+            }, timeout=BRIDGE_TYPING_TIMEOUT)
+            logger.info(f"Started typing in chat {data.get('chatId')} via session {session_id} for {duration}ms")
+            return 200, {"success": True, "message": f"Started typing for {duration}ms"}
+        except BridgeError as e:
+            logger.error(f"Error starting typing: {e.message}")
+            return e.status_code, {"error": f"Failed to start typing: {e.message}"}
+        except Exception as e:
+            logger.error(f"Error starting typing: {str(e)}")
+            return 500, {"error": str(e)}
+
+
+# Inicializa a aplicação
+application = AsgiApplication(init_app())
+metrics.http_worker_threads.function = lambda: ASGI_WSGI_THREADS
+# O stream de status é servido no loop; o limite por threads vale só se a rota Flask for usada
+session_events.max_subscribers = subscriber_limit(ASGI_WSGI_THREADS)
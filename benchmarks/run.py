@@ -0,0 +1,469 @@
+"""
+Benchmarks of the API against stub bridges.
+
+Boots the app the way it runs in production (gunicorn gthread, or uvicorn with
+--server uvicorn) on a scratch SQLite database. Each session's bridge is a local
+stub with configurable latency and failure rate (see stub_bridge.py). The harness
+then drives the scenarios below with keep-alive clients. For each scenario it
+reports p50/p95/p99 latency per request kind, requests per second, and the memory
+(RSS) of the server processes.
+
+    python benchmarks/run.py                         # all scenarios, compared with baselines.json
+    python benchmarks/run.py send_text mixed -c 64 -d 20
+    python benchmarks/run.py --save-baseline         # store the results as the new baseline
+    python benchmarks/run.py --check                 # exit 1 when a scenario regressed
+
+A scenario regresses when its p95 or p99 is more than --tolerance above the baseline
+(plus 2 ms, so very fast requests don't flap), or its requests per second drop by
+more than --tolerance. baselines.json keeps one baseline per server. Baselines only mean something on the machine that recorded
+them; record a new one before comparing on another host.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_bridge import StubBridge  # noqa: E402
+
+BASELINE_FILE = os.path.join(ROOT, 'benchmarks', 'baselines.json')
+MEDIA_NAME = 'bench.jpg'
+# Absolute slack added to the latency limits, in seconds
+LATENCY_SLACK = 0.002
+
+# scenario -> [(weight, request kind)]
+SCENARIOS = {
+    'send_text': [(1, 'send_text')],
+    'mixed': [(50, 'send_text'), (10, 'send_image'), (20, 'status'), (15, 'webhook_lookup'), (5, 'media_fetch')],
+    'status_callbacks': [(1, 'status')],
+    'webhook_lookups': [(1, 'webhook_lookup')],
+    'media_fetch': [(1, 'media_fetch')],
+}
+
+
+class Client:
+    """Minimal keep-alive HTTP/1.1 client for the load generator"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(data)}"]
+        if body is not None:
+            lines.append("Content-Type: application/json")
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode() + data
+        for attempt in (1, 2):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                self.writer.write(request)
+                return await self._response()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if attempt == 2:
+                    raise
+
+    async def _response(self):
+        status = int((await self.reader.readuntil(b"\r\n")).split(b" ", 2)[1])
+        headers = {}
+        while True:
+            line = await self.reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if status in (204, 304):
+            body = b''
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    await self.reader.readuntil(b"\r\n")
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            body = b"".join(chunks)
+        else:
+            body = await self.reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, headers, body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class Workload:
+    """Builds the requests of each kind for the prepared sessions"""
+
+    def __init__(self, sessions, media_url, seed=0):
+        self.sessions = sessions
+        self.media_url = media_url
+        self.random = random.Random(seed)
+        self.etags = {}
+
+    def build(self, kind):
+        session_id = self.random.choice(self.sessions)
+        chat_id = f"55119{self.random.randrange(10 ** 7):07d}@c.us"
+        if kind == 'send_text':
+            return 'POST', f'/api/sessions/{session_id}/send-text', {"chatId": chat_id, "message": "Benchmark"}, None
+        if kind == 'send_image':
+            return ('POST', f'/api/sessions/{session_id}/send-image',
+                    {"chatId": chat_id, "imageUrl": self.media_url, "caption": "Benchmark"}, None)
+        if kind == 'status':
+            return 'POST', f'/api/sessions/{session_id}/status', {"status": "connected"}, None
+        if kind == 'webhook_lookup':
+            # Como o bridge: revalida com o ETag da última resposta
+            path = f'/api/sessions/{session_id}/webhooks?event=message'
+            etag = self.etags.get(path)
+            return 'GET', path, None, {"If-None-Match": etag} if etag else None
+        if kind == 'media_fetch':
+            return 'GET', f'/api/files/session_{session_id}/{MEDIA_NAME}', None, None
+        raise ValueError(f"Unknown request kind: {kind}")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies):
+    values = [round(value, 6) for value in sorted(latencies)]
+    return {
+        'count': len(values),
+        'p50': percentile(values, 0.50),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': values[-1] if values else None,
+    }
+
+
+def process_tree_memory(pid, path='status', field='VmRSS:'):
+    """Sum in bytes of a /proc/<pid>/<path> field over pid and its children (gunicorn master + workers)"""
+    try:
+        children = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as stat:
+                        parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+                except OSError:
+                    continue
+                children.setdefault(parent, []).append(int(entry))
+        total = 0
+        pending = [pid]
+        while pending:
+            current = pending.pop()
+            pending.extend(children.get(current, []))
+            try:
+                with open(f'/proc/{current}/{path}') as status:
+                    for line in status:
+                        if line.startswith(field):
+                            total += int(line.split()[1]) * 1024
+            except OSError:
+                continue
+        return total
+    except OSError:
+        return None  # Sem /proc (macOS): memória não medida
+
+
+def process_tree_rss(pid):
+    """RSS in bytes of pid and its children, from /proc"""
+    return process_tree_memory(pid)
+
+
+async def run_scenario(name, port, workload, concurrency, duration, warmup, server_pid):
+    mix = SCENARIOS[name]
+    kinds = [kind for _, kind in mix]
+    weights = [weight for weight, _ in mix]
+    samples = {kind: [] for kind in kinds}
+    errors = {kind: {} for kind in kinds}
+    started_at = time.perf_counter()
+    measure_from = started_at + warmup
+    stop_at = measure_from + duration
+    memory = []
+
+    async def worker():
+        client = Client('127.0.0.1', port)
+        try:
+            while True:
+                now = time.perf_counter()
+                if now >= stop_at:
+                    return
+                kind = workload.random.choices(kinds, weights)[0]
+                method, path, body, headers = workload.build(kind)
+                try:
+                    status, response_headers, _ = await client.request(method, path, body, headers)
+                except (OSError, asyncio.IncompleteReadError):
+                    status, response_headers = 599, {}
+                elapsed = time.perf_counter() - now
+                if kind == 'webhook_lookup' and 'etag' in response_headers:
+                    workload.etags[path] = response_headers['etag']
+                if now < measure_from:
+                    continue
+                samples[kind].append(elapsed)
+                if status >= 400:
+                    errors[kind][status] = errors[kind].get(status, 0) + 1
+        finally:
+            client.close()
+
+    async def sample_memory():
+        while time.perf_counter() < stop_at:
+            rss = process_tree_rss(server_pid)
+            if rss is not None:
+                memory.append(rss)
+            await asyncio.sleep(0.25)
+
+    await asyncio.gather(sample_memory(), *[worker() for _ in range(concurrency)])
+    total = sum(len(values) for values in samples.values())
+    result = {
+        'concurrency': concurrency,
+        'duration': duration,
+        'requests': total,
+        'rps': round(total / duration, 1),
+        'errors': sum(sum(codes.values()) for codes in errors.values()),
+        'latency': summarize([value for values in samples.values() for value in values]),
+        'kinds': {kind: dict(summarize(samples[kind]), errors=errors[kind]) for kind in kinds},
+    }
+    if memory:
+        result['memory_mb'] = {'start': round(memory[0] / 2 ** 20, 1), 'peak': round(max(memory) / 2 ** 20, 1),
+                               'end': round(memory[-1] / 2 ** 20, 1)}
+    return result
+
+
+def prepare(env, sessions, webhooks_per_session, bridges, media_bytes):
+    """Creates sessions, webhooks and a stored media file, and points each session at its stub"""
+    os.environ.update(env)
+    # Só o servidor entrega webhooks e processa a fila; aqui basta o banco
+    os.environ.update({'WEBHOOK_DISPATCHER_ENABLED': '0', 'SEND_JOBS_ENABLED': '0'})
+    sys.path.insert(0, ROOT)
+    import logging
+    logging.disable(logging.WARNING)
+    from app import app, db, init_app  # noqa: E402
+    from models import WhatsAppSession  # noqa: E402
+
+    init_app()
+    client = app.test_client()
+    session_ids = []
+    for index in range(sessions):
+        response = client.post('/api/sessions', json={"name": f"bench-{index}"})
+        session_id = response.get_json()['id']
+        session_ids.append(session_id)
+        for hook in range(webhooks_per_session):
+            client.post('/api/webhooks', json={"name": f"bench-{index}-{hook}", "url": "http://127.0.0.1:9/hook",
+                                               "session_id": session_id})
+    with app.app_context():
+        for session_id, bridge in zip(session_ids, bridges):
+            db.session.query(WhatsAppSession).filter_by(id=session_id).update(
+                {"status": "connected", "bridge_port": bridge.port, "node_id": None})
+        db.session.commit()
+        for session_id in session_ids:
+            client.put(f'/api/files/session_{session_id}/{MEDIA_NAME}', data=bridges[0].media[:media_bytes],
+                       content_type='image/jpeg')
+        db.engine.dispose()
+    return session_ids
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(kind, port, env, threads):
+    if kind == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--worker-class', 'gthread',
+                   '--workers', '1', '--threads', str(threads), '--timeout', '300', 'wsgi:application']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1', '--port', str(port),
+                   '--log-level', 'warning']
+    log = open(os.path.join(env['BENCH_DIR'], 'server.log'), 'w')
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}, see {log.name}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Server did not start within 60 seconds")
+
+
+def compare(results, baselines, tolerance):
+    """Returns the regressions of results against baselines, as messages"""
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if not baseline:
+            continue
+        for key in ('p95', 'p99'):
+            current, previous = result['latency'][key], baseline['latency'][key]
+            if current is not None and previous is not None and current > previous * (1 + tolerance) + LATENCY_SLACK:
+                regressions.append(f"{name}: {key} {current * 1000:.1f} ms > baseline {previous * 1000:.1f} ms")
+        if result['rps'] < baseline['rps'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['rps']} req/s < baseline {baseline['rps']} req/s")
+    return regressions
+
+
+def print_result(name, result, baseline=None):
+    def ms(value):
+        return f"{value * 1000:8.1f}" if value is not None else '       -'
+
+    memory = result.get('memory_mb')
+    print(f"\n== {name}: {result['rps']} req/s, {result['requests']} requests, {result['errors']} errors"
+          + (f", RSS {memory['start']} -> {memory['end']} MB (peak {memory['peak']})" if memory else ''))
+    print(f"   {'kind':<16}{'count':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}  errors")
+    rows = list(result['kinds'].items()) + [('total', dict(result['latency'], errors={}))]
+    for kind, stats in rows:
+        errors = ' '.join(f"{code}x{count}" for code, count in sorted(stats['errors'].items()))
+        print(f"   {kind:<16}{stats['count']:>8}{ms(stats['p50'])} {ms(stats['p95'])} {ms(stats['p99'])} "
+              f"{ms(stats['max'])}  {errors}")
+    if baseline:
+        print(f"   baseline: {baseline['rps']} req/s, p95 {ms(baseline['latency']['p95']).strip()} ms, "
+              f"p99 {ms(baseline['latency']['p99']).strip()} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument('--server', choices=('gunicorn', 'uvicorn'), default='gunicorn')
+    parser.add_argument('--threads', type=int, default=4, help="gunicorn threads (as in the Dockerfile)")
+    parser.add_argument('-c', '--concurrency', type=int, default=32)
+    parser.add_argument('-d', '--duration', type=float, default=10, help="measured seconds per scenario")
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--sessions', type=int, default=4)
+    parser.add_argument('--webhooks', type=int, default=3, help="webhooks per session")
+    parser.add_argument('--latency-ms', type=float, default=20, help="stub bridge latency")
+    parser.add_argument('--jitter-ms', type=float, default=5)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--media-kb', type=int, default=256)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="extra environment for the server (repeatable)")
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true', help="exit with status 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory")
+    args = parser.parse_args()
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    bench_dir = tempfile.mkdtemp(prefix='whatsflow-bench-')
+    bridges = [StubBridge(0, args.latency_ms, args.jitter_ms, args.failure_rate, args.media_kb * 1024).start()
+               for _ in range(args.sessions)]
+    env = dict(os.environ)
+    env.update({
+        'BENCH_DIR': bench_dir,
+        'DATABASE_URL': f"sqlite:///{os.path.join(bench_dir, 'bench.db')}",
+        'MEDIA_STORE_DIR': os.path.join(bench_dir, 'media'),
+        'MEDIA_UPLOAD_DIR': os.path.join(bench_dir, 'uploads'),
+        # A mídia das URLs vem do bridge simulado em 127.0.0.1
+        'MEDIA_URL_ALLOW_PRIVATE': '1',
+        # O benchmark mede a API, não os limites de envio por sessão
+        'SEND_RATE_DEFAULT': '1000000',
+        'SEND_BURST_DEFAULT': '1000000',
+        'SEND_CHAT_MIN_INTERVAL': '0',
+        'BRIDGE_SUPERVISOR_ENABLED': '0',
+        'BRIDGE_COMMAND': 'true',
+        'WEB_THREADS': str(args.threads),
+    })
+    for item in args.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+
+    server = None
+    try:
+        sessions = prepare(env, args.sessions, args.webhooks, bridges, args.media_kb * 1024)
+        port = free_port()
+        server = start_server(args.server, port, env, args.threads)
+        workload = Workload(sessions, f"http://127.0.0.1:{bridges[0].port}/media/{MEDIA_NAME}")
+        print(f"Server: {args.server} (pid {server.pid}), {args.sessions} sessions, stub latency "
+              f"{args.latency_ms}±{args.jitter_ms} ms, failure rate {args.failure_rate}, "
+              f"concurrency {args.concurrency}, {args.duration}s per scenario")
+
+        results = {}
+        for name in names:
+            results[name] = asyncio.run(run_scenario(name, port, workload, args.concurrency, args.duration,
+                                                     args.warmup, server.pid))
+    finally:
+        if server is not None:
+            os.killpg(server.pid, signal.SIGTERM)
+            try:
+                server.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                os.killpg(server.pid, signal.SIGKILL)
+        for bridge in bridges:
+            bridge.stop()
+        if not args.keep:
+            shutil.rmtree(bench_dir, ignore_errors=True)
+
+    stored = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            stored = json.load(file)
+    # Uma baseline por servidor: gunicorn e uvicorn não são comparáveis
+    baselines = stored.get(args.server, {}).get('scenarios', {})
+    for name, result in results.items():
+        print_result(name, result, baselines.get(name))
+
+    regressions = compare(results, baselines, args.tolerance)
+    if regressions:
+        print("\nRegressions:")
+        for message in regressions:
+            print(f"   {message}")
+
+    report = {
+        'recorded_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'host': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'options': {'server': args.server, 'threads': args.threads, 'concurrency': args.concurrency,
+                    'duration': args.duration, 'sessions': args.sessions, 'latency_ms': args.latency_ms,
+                    'jitter_ms': args.jitter_ms, 'failure_rate': args.failure_rate},
+        'scenarios': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.save_baseline:
+        report['scenarios'] = dict(baselines, **results)
+        stored[args.server] = report
+        with open(args.baseline, 'w') as file:
+            json.dump(stored, file, indent=2)
+            file.write('\n')
+        print(f"\nBaseline saved to {args.baseline}")
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Stub of the Node.js WhatsApp bridge for benchmarks.
+
+Answers the endpoints the API calls (send-text, send-image, send-document, send-audio,
+seen, typing, health) after a configurable latency, fails a configurable fraction of
+the sends, and serves a media file at /media/<name> for the imageUrl/documentUrl sends.
+
+    python benchmarks/stub_bridge.py --port 3001 --latency-ms 50 --jitter-ms 20 --failure-rate 0.01
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+SEND_PATHS = ('/api/send-text', '/api/send-image', '/api/send-document', '/api/send-audio', '/api/seen',
+              '/api/typing')
+
+
+class StubBridge:
+    """Threaded HTTP server emulating one bridge"""
+
+    def __init__(self, port=0, latency_ms=0.0, jitter_ms=0.0, failure_rate=0.0, media_bytes=256 * 1024):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.failure_rate = failure_rate
+        self.media = bytes(random.Random(0).getrandbits(8) for _ in range(media_bytes))
+        self.requests = 0
+        self.failures = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def _handler(self):
+        bridge = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _reply(self, status, body, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.path not in SEND_PATHS:
+                    return self._reply(404, b'{"success":false,"error":"Not found"}')
+                delay = bridge.latency + (random.uniform(-bridge.jitter, bridge.jitter) if bridge.jitter else 0)
+                if delay > 0:
+                    time.sleep(delay)
+                with bridge._lock:
+                    bridge.requests += 1
+                    failed = random.random() < bridge.failure_rate
+                    bridge.failures += failed
+                    message_id = next(bridge._ids)
+                if failed:
+                    return self._reply(500, b'{"success":false,"error":"Simulated failure"}')
+                self._reply(200, json.dumps({"success": True, "messageId": f"true_bench_{message_id}"}).encode())
+
+            def do_GET(self):
+                if self.path == '/health':
+                    return self._reply(200, b'{"status":"ok"}')
+                if self.path.startswith('/media/'):
+                    return self._reply(200, bridge.media, 'image/jpeg')
+                self._reply(404, b'{"success":false,"error":"Not found"}')
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='stub-bridge', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=3001)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--failure-rate', type=float, default=0)
+    args = parser.parse_args()
+    bridge = StubBridge(args.port, args.latency_ms, args.jitter_ms, args.failure_rate)
+    print(f"Stub bridge listening on 127.0.0.1:{bridge.port}")
+    try:
+        bridge.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
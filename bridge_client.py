@@ -0,0 +1,324 @@
+"""
+Shared HTTP client for the Node.js WhatsApp bridges.
+
+Keeps a pool of keep-alive connections per bridge so that every send does not
+pay for a new TCP handshake, and maps bridge failures to a single exception type.
+AsyncBridgeClient is the asyncio counterpart used by the ASGI entry point (asgi.py).
+"""
+import asyncio
+import http.client
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+import httpx
+
+from metrics import bridge_request_duration, bridge_errors
+from tracing import tracer, TRACE_HEADER
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of concurrent connections to a single bridge
+BRIDGE_POOL_SIZE = int(os.environ.get('BRIDGE_POOL_SIZE', '8'))
+# Same limit for the asyncio client (httpx), where an open connection does not cost a thread
+BRIDGE_ASYNC_POOL_SIZE = int(os.environ.get('BRIDGE_ASYNC_POOL_SIZE', '64'))
+# Seconds to wait for a free connection when the pool is exhausted
+BRIDGE_POOL_TIMEOUT = float(os.environ.get('BRIDGE_POOL_TIMEOUT', '30'))
+# Idle connections older than this are discarded (Node closes them after 5s by default)
+BRIDGE_KEEPALIVE_IDLE = float(os.environ.get('BRIDGE_KEEPALIVE_IDLE', '4'))
+# Timeouts for quick calls (text, seen), typing and media uploads
+BRIDGE_TIMEOUT = float(os.environ.get('BRIDGE_TIMEOUT', '10'))
+BRIDGE_TYPING_TIMEOUT = float(os.environ.get('BRIDGE_TYPING_TIMEOUT', '30'))
+BRIDGE_MEDIA_TIMEOUT = float(os.environ.get('BRIDGE_MEDIA_TIMEOUT', '180'))
+
+
+class BridgeError(Exception):
+    """Error returned by (or while talking to) a WhatsApp bridge"""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def bridge_address(session_id, port=None):
+    """Returns the (host, port) of the bridge for a session (port defaults to 3000 + session_id)"""
+    api_host = os.environ.get('API_HOST', 'localhost')
+    # Se estamos rodando no Docker e API_HOST é 'web', use 127.0.0.1 para chamadas dentro do mesmo contêiner
+    host_address = '127.0.0.1' if api_host == 'web' else api_host
+    return host_address, int(port) if port else 3000 + int(session_id)
+
+
+class BridgeConnectionPool:
+    """Bounded LIFO pool of keep-alive connections to one bridge"""
+
+    def __init__(self, host, port, maxsize=BRIDGE_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self._idle = []  # list of (connection, last_used)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxsize)
+
+    def _checkout(self, timeout):
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < BRIDGE_KEEPALIVE_IDLE and not self._dropped(conn):
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout), False
+
+    @staticmethod
+    def _dropped(conn):
+        """True when the bridge closed an idle connection (it is readable before any request: EOF)"""
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _checkin(self, conn):
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+
+    def request(self, method, path, body=None, headers=None, timeout=BRIDGE_TIMEOUT):
+        """Performs a request and returns (status, body bytes)"""
+        if not self._slots.acquire(timeout=BRIDGE_POOL_TIMEOUT):
+            raise BridgeError(f"Connection pool for {self.host}:{self.port} exhausted", 503)
+        try:
+            conn, reused = self._checkout(timeout)
+            try:
+                try:
+                    conn.request(method, path, body=body, headers=headers or {})
+                except (ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    if not reused:
+                        raise
+                    # The bridge closed an idle keep-alive connection before the request was
+                    # fully written, so it cannot have been processed; retry once on a fresh one
+                    conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+                    conn.request(method, path, body=body, headers=headers or {})
+                # The bridge may have the request from here on: never resend it (a send
+                # would be delivered twice)
+                response = conn.getresponse()
+                data = response.read()
+            except Exception:
+                conn.close()
+                raise
+
+            status, will_close = response.status, response.will_close
+            if will_close:
+                conn.close()
+            else:
+                self._checkin(conn)
+            return status, data
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for conn, _ in self._idle:
+                conn.close()
+            self._idle = []
+
+
+class BridgeClient:
+    """Per-session pooled client for the WhatsApp bridges
+
+    resolve_address maps a session to its bridge (host, port); the session registry
+    replaces it so that ports allocated by the bridge supervisor are used.
+    """
+
+    def __init__(self, pool_size=BRIDGE_POOL_SIZE, resolve_address=bridge_address):
+        self.pool_size = pool_size
+        self.resolve_address = resolve_address
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, session_id):
+        address = self.resolve_address(session_id)
+        pool = self._pools.get(session_id)
+        if pool is None or (pool.host, pool.port) != address:
+            with self._lock:
+                pool = self._pools.get(session_id)
+                if pool is None or (pool.host, pool.port) != address:
+                    # The bridge moved to another port: drop the connections to the old one
+                    if pool is not None:
+                        pool.close()
+                    pool = BridgeConnectionPool(address[0], address[1], self.pool_size)
+                    self._pools[session_id] = pool
+        return pool
+
+    def post(self, session_id, path, payload, timeout=BRIDGE_TIMEOUT):
+        """Sends a JSON payload to the session's bridge and returns the decoded response"""
+        started_at = time.perf_counter()
+        try:
+            return self._post(session_id, path, payload, timeout)
+        except BridgeError as e:
+            bridge_errors.labels(str(session_id), path, str(e.status_code)).inc()
+            raise
+        finally:
+            bridge_request_duration.labels(str(session_id), path).observe(time.perf_counter() - started_at)
+
+    @staticmethod
+    def _encode(payload):
+        """Request body and headers of a bridge call (with the trace ID of the current request)"""
+        with tracer.phase('encode'):
+            body = json.dumps(payload).encode('utf-8')
+        headers = {"Content-Type": "application/json"}
+        trace_id = tracer.current_id()
+        if trace_id is not None:
+            headers[TRACE_HEADER] = trace_id
+        return body, headers
+
+    def _post(self, session_id, path, payload, timeout):
+        pool = self._pool(session_id)
+        body, headers = self._encode(payload)
+
+        try:
+            with tracer.phase('bridge'):
+                status, data = pool.request("POST", path, body, headers, timeout)
+        except BridgeError:
+            raise
+        except (socket.timeout, TimeoutError):
+            raise BridgeError(f"Request to bridge timed out after {timeout:g} seconds", 504)
+        except (OSError, http.client.HTTPException) as e:
+            raise BridgeError(f"Connection error: {str(e)}", 500)
+
+        if status >= 400:
+            raise BridgeError(data.decode('utf-8', errors='replace'), status)
+
+        try:
+            return json.loads(data.decode('utf-8')) if data else {}
+        except ValueError:
+            raise BridgeError("Invalid response from bridge", 502)
+
+    def close_session(self, session_id):
+        """Drops the pooled connections of a session (e.g. after restart or delete)"""
+        with self._lock:
+            pool = self._pools.pop(session_id, None)
+        if pool is not None:
+            pool.close()
+
+
+class AsyncBridgePool:
+    """httpx client for one bridge (asyncio), with up to maxsize keep-alive connections
+
+    httpx never retries: a request that reached the bridge is not sent again. Requests
+    beyond maxsize wait on a semaphore rather than in the httpx pool, whose bookkeeping
+    grows with the number of queued requests.
+    """
+
+    def __init__(self, host, port, maxsize=BRIDGE_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        limits = httpx.Limits(max_connections=maxsize, max_keepalive_connections=maxsize,
+                              keepalive_expiry=BRIDGE_KEEPALIVE_IDLE)
+        self.client = httpx.AsyncClient(base_url=f"http://{host}:{port}", trust_env=False,
+                                        transport=httpx.AsyncHTTPTransport(limits=limits, retries=0))
+        self._slots = asyncio.Semaphore(maxsize)
+
+    async def request(self, method, path, body=b'', headers=None, timeout=BRIDGE_TIMEOUT):
+        """Performs a request and returns (status, body bytes)"""
+        try:
+            await asyncio.wait_for(self._slots.acquire(), BRIDGE_POOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise BridgeError(f"Connection pool for {self.host}:{self.port} exhausted", 503)
+        try:
+            response = await self.client.request(method, path, content=body, headers=headers,
+                                                 timeout=timeout)
+            return response.status_code, response.content
+        finally:
+            self._slots.release()
+
+    async def aclose(self):
+        """Closes the connections once the requests already started or queued are done"""
+        for _ in range(self.maxsize):
+            await self._slots.acquire()
+        await self.client.aclose()
+
+
+class AsyncBridgeClient(BridgeClient):
+    """Per-session pooled asyncio client for the WhatsApp bridges (used in the ASGI mode)"""
+
+    def __init__(self, pool_size=BRIDGE_POOL_SIZE, resolve_address=bridge_address):
+        super().__init__(pool_size, resolve_address)
+        self._loop = None
+        self._closing = set()  # aclose() tasks of the replaced pools
+
+    def _pool(self, session_id):
+        address = self.resolve_address(session_id)
+        pool = self._pools.get(session_id)
+        if pool is None or (pool.host, pool.port) != address:
+            # Pools are only used from the event loop thread, no lock needed
+            self._loop = asyncio.get_running_loop()
+            if pool is not None:
+                # The bridge moved to another port: drop the connections to the old one
+                self._discard(pool)
+            pool = AsyncBridgePool(address[0], address[1], self.pool_size)
+            self._pools[session_id] = pool
+        return pool
+
+    def _discard(self, pool):
+        task = self._loop.create_task(pool.aclose())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def post(self, session_id, path, payload, timeout=BRIDGE_TIMEOUT):
+        """Sends a JSON payload to the session's bridge and returns the decoded response"""
+        started_at = time.perf_counter()
+        try:
+            return await self._post(session_id, path, payload, timeout)
+        except BridgeError as e:
+            bridge_errors.labels(str(session_id), path, str(e.status_code)).inc()
+            raise
+        finally:
+            bridge_request_duration.labels(str(session_id), path).observe(time.perf_counter() - started_at)
+
+    async def _post(self, session_id, path, payload, timeout):
+        pool = self._pool(session_id)
+        body, headers = self._encode(payload)
+
+        try:
+            with tracer.phase('bridge'):
+                status, data = await pool.request("POST", path, body, headers, timeout)
+        except BridgeError:
+            raise
+        except httpx.TimeoutException:
+            raise BridgeError(f"Request to bridge timed out after {timeout:g} seconds", 504)
+        except httpx.TransportError as e:
+            raise BridgeError(f"Connection error: {str(e)}", 500)
+
+        if status >= 400:
+            raise BridgeError(data.decode('utf-8', errors='replace'), status)
+
+        try:
+            return json.loads(data.decode('utf-8')) if data else {}
+        except ValueError:
+            raise BridgeError("Invalid response from bridge", 502)
+
+    def close_session(self, session_id):
+        """Drops the pooled connections of a session; may be called from any thread"""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._close_session, session_id)
+
+    def _close_session(self, session_id):
+        pool = self._pools.pop(session_id, None)
+        if pool is not None:
+            self._discard(pool)
+
+
+bridge_client = BridgeClient()
+async_bridge_client = AsyncBridgeClient(BRIDGE_ASYNC_POOL_SIZE)
@@ -0,0 +1,192 @@
+"""
+Bridge nodes and placement of sessions on them.
+
+Every host that runs bridges also runs this application (against the same database)
+and registers itself as the BridgeNode named BRIDGE_NODE_NAME. Its bridge supervisor
+only starts and monitors the bridges of sessions placed on that node, and reports the
+node's load (running bridges, memory) with every health-check round. Sessions are
+placed on the active, live node with the most headroom; bridges that live on another
+node are started and stopped through that node's API.
+"""
+import json
+import logging
+import os
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+from sqlalchemy import func, update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from bridge_client import bridge_address
+from models import BridgeNode, WhatsAppSession
+
+logger = logging.getLogger(__name__)
+
+BRIDGE_NODE_NAME = os.environ.get('BRIDGE_NODE_NAME', 'local')
+# Address of this node's bridges for the other nodes (defaults to the single-host address)
+BRIDGE_NODE_HOST = os.environ.get('BRIDGE_NODE_HOST', '')
+# Base URL of this node's API for the other nodes (only needed with several nodes)
+BRIDGE_NODE_API_URL = os.environ.get('BRIDGE_NODE_API_URL', '')
+# Maximum number of bridges on this node (defaults to the size of its port range)
+BRIDGE_NODE_CAPACITY = os.environ.get('BRIDGE_NODE_CAPACITY', '')
+# Memory available to this node's bridges, and the estimate per bridge before usage is reported
+BRIDGE_NODE_MEMORY_MB = int(os.environ.get('BRIDGE_NODE_MEMORY_MB', '2048'))
+BRIDGE_SESSION_MEMORY_MB = int(os.environ.get('BRIDGE_SESSION_MEMORY_MB', '250'))
+# Seconds without a heartbeat after which a node is considered down
+BRIDGE_NODE_TIMEOUT = float(os.environ.get('BRIDGE_NODE_TIMEOUT', '60'))
+# Timeout of start/stop requests sent to another node
+BRIDGE_NODE_CALL_TIMEOUT = float(os.environ.get('BRIDGE_NODE_CALL_TIMEOUT', '60'))
+
+
+class NodeError(Exception):
+    """No node can take a session, or a request to another node failed"""
+
+    def __init__(self, message, status_code=503):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class BridgeNodes:
+    """Registry of bridge nodes and placement scheduler"""
+
+    def __init__(self):
+        self.local_node_id = None
+        self.local_host = None
+
+    def register_local(self, port_min, port_max):
+        """Creates or updates the row of this node and returns its ID"""
+        if self.local_node_id is not None:
+            return self.local_node_id
+
+        node = BridgeNode.query.filter_by(name=BRIDGE_NODE_NAME).first()
+        if node is None:
+            node = BridgeNode(name=BRIDGE_NODE_NAME, status='active')
+            db.session.add(node)
+        node.host = BRIDGE_NODE_HOST or bridge_address(0)[0]
+        node.api_url = BRIDGE_NODE_API_URL or None
+        node.port_min = port_min
+        node.port_max = port_max
+        node.capacity = int(BRIDGE_NODE_CAPACITY) if BRIDGE_NODE_CAPACITY else port_max - port_min + 1
+        node.memory_limit = BRIDGE_NODE_MEMORY_MB * 1024 * 1024
+        node.heartbeat_at = datetime.utcnow()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker of this node registered it first
+            db.session.rollback()
+            node = BridgeNode.query.filter_by(name=BRIDGE_NODE_NAME).one()
+
+        # Bridges started before nodes existed belong to the first node that registers
+        db.session.execute(
+            update(WhatsAppSession)
+            .where(WhatsAppSession.node_id.is_(None), WhatsAppSession.bridge_pid.isnot(None))
+            .values(node_id=node.id)
+        )
+        db.session.commit()
+        self.local_node_id = node.id
+        self.local_host = node.host
+        logger.info(f"Registered bridge node '{node.name}' (ID {node.id}, {node.host}, ports {port_min}-{port_max})")
+        return node.id
+
+    def is_local(self, node_id):
+        return node_id is not None and node_id == self.local_node_id
+
+    def heartbeat(self, running, rss_bytes):
+        """Reports the load of this node (called with every health-check round)"""
+        db.session.execute(
+            update(BridgeNode)
+            .where(BridgeNode.id == self.local_node_id)
+            .values(running=running, rss_bytes=rss_bytes, heartbeat_at=datetime.utcnow())
+        )
+        db.session.commit()
+
+    @staticmethod
+    def get(node_id):
+        return db.session.get(BridgeNode, node_id)
+
+    def _alive(self, node):
+        if node.id == self.local_node_id:
+            return True
+        return node.heartbeat_at is not None and \
+            (datetime.utcnow() - node.heartbeat_at).total_seconds() < BRIDGE_NODE_TIMEOUT
+
+    def alive(self, node_id):
+        node = self.get(node_id)
+        return node is not None and self._alive(node)
+
+    def accepts(self, node_id):
+        """True if new bridges may be placed on the node"""
+        node = self.get(node_id)
+        return node is not None and node.status == 'active' and self._alive(node)
+
+    @staticmethod
+    def _running_by_node():
+        return dict(
+            db.session.query(WhatsAppSession.node_id, func.count(WhatsAppSession.id))
+            .filter(WhatsAppSession.bridge_pid.isnot(None))
+            .group_by(WhatsAppSession.node_id)
+        )
+
+    def load(self):
+        """All nodes with their liveness and free capacity"""
+        running = self._running_by_node()
+        placed = dict(
+            db.session.query(WhatsAppSession.node_id, func.count(WhatsAppSession.id))
+            .group_by(WhatsAppSession.node_id)
+        )
+        nodes = []
+        for node in BridgeNode.query.order_by(BridgeNode.id):
+            data = node.to_dict()
+            data.update(
+                alive=self._alive(node),
+                sessions=placed.get(node.id, 0),
+                bridges=running.get(node.id, 0),
+                free_slots=max(0, node.capacity - running.get(node.id, 0))
+            )
+            nodes.append(data)
+        return nodes
+
+    def place(self, exclude_node_id=None):
+        """Returns the ID of the node with the most free slots and memory for one more bridge"""
+        running = self._running_by_node()
+        best = None
+        for node in BridgeNode.query.filter_by(status='active').order_by(BridgeNode.id):
+            if node.id == exclude_node_id or not self._alive(node):
+                continue
+            bridges = running.get(node.id, 0)
+            free_slots = node.capacity - bridges
+            if free_slots <= 0:
+                continue
+            per_bridge = node.rss_bytes / node.running if node.running else BRIDGE_SESSION_MEMORY_MB * 1024 * 1024
+            headroom = node.memory_limit - max(node.rss_bytes, bridges * per_bridge)
+            if headroom < per_bridge:
+                continue
+            score = min(free_slots / node.capacity, headroom / node.memory_limit)
+            if best is None or score > best[0]:
+                best = (score, node.id)
+        if best is None:
+            raise NodeError("No bridge node has capacity for another session")
+        return best[1]
+
+    def call(self, node_id, session_id, action):
+        """Asks another node to start, stop or restart one of its bridges"""
+        node = self.get(node_id)
+        if node is None or not node.api_url:
+            raise NodeError(f"Bridge node {node_id} has no API URL")
+        request = urllib.request.Request(
+            f"{node.api_url.rstrip('/')}/api/nodes/local/bridges/{session_id}/{action}",
+            data=b'{}', headers={"Content-Type": "application/json"}, method='POST'
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=BRIDGE_NODE_CALL_TIMEOUT) as response:
+                return json.loads(response.read() or b'{}')
+        except urllib.error.HTTPError as e:
+            raise NodeError(f"Bridge node '{node.name}': {e.read().decode('utf-8', errors='replace')}", 502)
+        except Exception as e:
+            raise NodeError(f"Bridge node '{node.name}' unreachable: {str(e)}", 502)
+
+
+bridge_nodes = BridgeNodes()
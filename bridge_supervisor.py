@@ -0,0 +1,623 @@
+"""
+Supervisor of the Node.js bridge processes.
+
+Owns the lifecycle of each session's bridge: it starts at most one process per
+session (its pid, port and start time are stored with the session), allocates the
+port from BRIDGE_PORT_MIN..BRIDGE_PORT_MAX, stops the whole process group (the bridge
+and its Chromium) on restart and delete, and probes GET /health on every running
+bridge, restarting dead or unresponsive ones with exponential backoff.
+
+Restarts are claimed with a conditional UPDATE on bridge_pid, so several worker
+processes can run the health loop without restarting the same bridge twice.
+
+With several bridge nodes (see bridge_nodes) each node's supervisor manages only the
+bridges placed on it; start/stop of a bridge on another node is forwarded to that node.
+
+Bridges of sessions created in bulk are started by the bridge launcher, at most
+BRIDGE_LAUNCH_CONCURRENCY at a time and BRIDGE_LAUNCH_INTERVAL seconds apart, so that
+provisioning many sessions does not start all their Chromium processes at once.
+"""
+import logging
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import threading
+import time
+import urllib.request
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import update
+
+from app import app, db
+from bridge_client import bridge_address, bridge_client
+from bridge_nodes import bridge_nodes, NodeError
+from models import BridgeNode, WhatsAppSession
+from session_registry import session_registry
+
+logger = logging.getLogger(__name__)
+
+BRIDGE_SUPERVISOR_ENABLED = os.environ.get('BRIDGE_SUPERVISOR_ENABLED', '1') == '1'
+# Command that runs a bridge; the session ID is appended and the port is passed in BRIDGE_PORT
+BRIDGE_COMMAND = os.environ.get('BRIDGE_COMMAND', 'node whatsapp_bridge.js')
+# Ports available to the bridges (must match the ports published by docker-compose)
+BRIDGE_PORT_MIN = int(os.environ.get('BRIDGE_PORT_MIN', '3001'))
+BRIDGE_PORT_MAX = int(os.environ.get('BRIDGE_PORT_MAX', '3010'))
+# Health checks: interval, request timeout and consecutive failures before a restart
+BRIDGE_HEALTH_INTERVAL = float(os.environ.get('BRIDGE_HEALTH_INTERVAL', '15'))
+BRIDGE_HEALTH_TIMEOUT = float(os.environ.get('BRIDGE_HEALTH_TIMEOUT', '5'))
+BRIDGE_HEALTH_FAILURES = int(os.environ.get('BRIDGE_HEALTH_FAILURES', '3'))
+# Delay before the n-th consecutive restart: BASE * 2^(n-1) seconds, capped at MAX
+BRIDGE_RESTART_BACKOFF_BASE = float(os.environ.get('BRIDGE_RESTART_BACKOFF_BASE', '5'))
+BRIDGE_RESTART_BACKOFF_MAX = float(os.environ.get('BRIDGE_RESTART_BACKOFF_MAX', '300'))
+# Seconds a bridge must stay healthy before its restart backoff is reset
+BRIDGE_STABLE_AFTER = float(os.environ.get('BRIDGE_STABLE_AFTER', '120'))
+# Seconds to wait for a graceful shutdown (SIGTERM) before killing the process group
+BRIDGE_STOP_TIMEOUT = float(os.environ.get('BRIDGE_STOP_TIMEOUT', '10'))
+# Bridges stopped in parallel when sessions are deleted in bulk
+BRIDGE_STOP_CONCURRENCY = int(os.environ.get('BRIDGE_STOP_CONCURRENCY', '8'))
+# Bridges the launcher starts at the same time (each one starts a Chromium)
+BRIDGE_LAUNCH_CONCURRENCY = int(os.environ.get('BRIDGE_LAUNCH_CONCURRENCY', '2'))
+# Seconds each launcher slot waits after a start before taking the next bridge
+BRIDGE_LAUNCH_INTERVAL = float(os.environ.get('BRIDGE_LAUNCH_INTERVAL', '2'))
+
+
+class BridgeStartError(Exception):
+    """A bridge could not be started"""
+
+
+def _read_cmdline(pid):
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            return f.read().decode('utf-8', errors='replace').split('\0')
+    except OSError:
+        return None
+
+
+def process_group_usage(pgid=None):
+    """Returns (processes, RSS bytes, CPU seconds) of a process group, or None without /proc
+
+    Without pgid, returns a dict with the usage of every process group.
+    """
+    if not os.path.isdir('/proc'):
+        return None
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    ticks = os.sysconf('SC_CLK_TCK')
+    groups = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # Fields after the command name: state, ppid, pgrp, ..., utime (12th), stime, ..., rss (22nd)
+        fields = stat[stat.rindex(')') + 2:].split()
+        group = int(fields[2])
+        if fields[0] == 'Z' or (pgid is not None and group != pgid):
+            continue
+        processes, rss, cpu = groups.get(group, (0, 0, 0.0))
+        groups[group] = (processes + 1, rss + int(fields[21]) * page_size,
+                         cpu + (int(fields[11]) + int(fields[12])) / ticks)
+    if pgid is not None:
+        return groups.get(pgid, (0, 0, 0.0))
+    return groups
+
+
+class _BridgeHealth:
+    __slots__ = ('failures', 'restarts', 'next_restart_at', 'healthy', 'checked_at', 'cpu_sample')
+
+    def __init__(self):
+        self.failures = 0
+        self.restarts = 0
+        self.next_restart_at = 0.0
+        self.healthy = None
+        self.checked_at = None
+        self.cpu_sample = None  # (cpu seconds, monotonic time) of the last usage report
+
+
+class BridgeSupervisor:
+    """Starts, stops, health-checks and restarts the session bridges"""
+
+    def __init__(self, app, command=BRIDGE_COMMAND, port_range=(BRIDGE_PORT_MIN, BRIDGE_PORT_MAX),
+                 health_interval=BRIDGE_HEALTH_INTERVAL):
+        self.app = app
+        self.command = shlex.split(command)
+        self.port_min, self.port_max = port_range
+        self.health_interval = health_interval
+        self._processes = {}  # session_id -> Popen of bridges started by this process
+        self._health = defaultdict(_BridgeHealth)
+        self._session_locks = defaultdict(threading.RLock)
+        self._locks_lock = threading.Lock()
+        self._port_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start_monitor(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='bridge-supervisor', daemon=True)
+        self._thread.start()
+        logger.info(f"Bridge supervisor started (ports {self.port_min}-{self.port_max})")
+
+    def stop_monitor(self):
+        self._stop.set()
+
+    def _lock(self, session_id):
+        with self._locks_lock:
+            return self._session_locks[session_id]
+
+    def _local_node(self):
+        return bridge_nodes.register_local(self.port_min, self.port_max)
+
+    @staticmethod
+    def _forward(node_id, session_id, action):
+        """Runs a start/stop on the node that owns the bridge; returns the bridge pid"""
+        result = bridge_nodes.call(node_id, session_id, action)
+        # The bridge address changed on another node: reload it on the next send
+        session_registry.remove(session_id)
+        bridge_client.close_session(session_id)
+        return result.get('pid')
+
+    # Processes
+
+    def _is_bridge(self, pid, session_id):
+        """True if pid is alive and is the bridge of session_id (pids can be reused)"""
+        process = self._processes.get(session_id)
+        if process is not None and process.pid == pid:
+            return process.poll() is None
+        cmdline = _read_cmdline(pid)
+        if cmdline is None:
+            if os.path.isdir('/proc'):
+                return False
+            try:
+                os.kill(pid, 0)
+                return True
+            except OSError:
+                return False
+        return str(session_id) in cmdline and self.command[-1] in cmdline
+
+    def _spawn(self, session_id, port):
+        env = dict(os.environ, BRIDGE_PORT=str(port))
+        try:
+            # Own process group, so that stopping the bridge also stops its Chromium processes
+            return subprocess.Popen(self.command + [str(session_id)], env=env, start_new_session=True)
+        except OSError as e:
+            raise BridgeStartError(f"Could not start bridge: {str(e)}")
+
+    def _terminate(self, session_id, pid):
+        """Stops a bridge and everything in its process group"""
+        process = self._processes.pop(session_id, None)
+        if process is not None and process.pid != pid:
+            process = None
+        if process is None and _read_cmdline(pid) is not None and not self._is_bridge(pid, session_id):
+            # The pid now belongs to an unrelated process
+            return
+
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            return
+
+        deadline = time.monotonic() + BRIDGE_STOP_TIMEOUT
+        if process is not None:
+            try:
+                process.wait(BRIDGE_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                pass
+        else:
+            while time.monotonic() < deadline and self._is_bridge(pid, session_id):
+                time.sleep(0.2)
+
+        # Whatever is left of the group (a stuck bridge or orphaned Chromium processes)
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        if process is not None:
+            try:
+                process.wait(1)
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Bridge of session {session_id} (PID {pid}) did not exit")
+
+    # Ports
+
+    @staticmethod
+    def _port_free(port):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(('0.0.0.0', port))
+                return True
+            except OSError:
+                return False
+
+    def _allocate_port(self, session_id, previous_port):
+        """Picks a free port, preferring the session's previous one and then the legacy 3000 + id"""
+        taken = {
+            port for (port,) in db.session.query(WhatsAppSession.bridge_port)
+            .filter(WhatsAppSession.id != session_id,
+                    WhatsAppSession.node_id == self._local_node(),
+                    WhatsAppSession.bridge_pid.isnot(None),
+                    WhatsAppSession.bridge_port.isnot(None))
+        }
+        candidates = [previous_port, 3000 + session_id] + list(range(self.port_min, self.port_max + 1))
+        for port in candidates:
+            if port is None or port in taken or not self.port_min <= port <= self.port_max:
+                continue
+            if self._port_free(port):
+                return port
+        raise BridgeStartError(f"No free bridge port between {self.port_min} and {self.port_max}")
+
+    # Lifecycle
+
+    def start(self, session_id):
+        """Starts the session's bridge unless it is already running; returns the bridge pid
+
+        Sessions without a node, or whose node no longer takes bridges, are placed first;
+        bridges placed on another node are started by that node.
+        """
+        with self._lock(session_id):
+            local_node_id = self._local_node()
+            row = (db.session.query(WhatsAppSession.bridge_pid, WhatsAppSession.bridge_port, WhatsAppSession.node_id)
+                   .filter_by(id=session_id).first())
+            if row is None:
+                raise BridgeStartError(f"Session {session_id} not found")
+
+            node_id = row.node_id
+            if node_id == local_node_id:
+                if row.bridge_pid and self._is_bridge(row.bridge_pid, session_id):
+                    return row.bridge_pid
+            elif node_id is not None and bridge_nodes.alive(node_id) and \
+                    (row.bridge_pid or bridge_nodes.accepts(node_id)):
+                return self._forward(node_id, session_id, 'start')
+
+            if node_id is None or not bridge_nodes.accepts(node_id):
+                node_id = bridge_nodes.place()
+                db.session.execute(
+                    update(WhatsAppSession)
+                    .where(WhatsAppSession.id == session_id)
+                    .values(node_id=node_id, bridge_pid=None)
+                )
+                db.session.commit()
+                logger.info(f"Placed session {session_id} on bridge node {node_id}")
+                if node_id != local_node_id:
+                    return self._forward(node_id, session_id, 'start')
+
+            with self._port_lock:
+                # The previous port is only meaningful on the node that allocated it
+                previous_port = row.bridge_port if row.node_id in (None, local_node_id) else None
+                port = self._allocate_port(session_id, previous_port)
+                process = self._spawn(session_id, port)
+                db.session.execute(
+                    update(WhatsAppSession)
+                    .where(WhatsAppSession.id == session_id)
+                    .values(bridge_pid=process.pid, bridge_port=port, bridge_started_at=datetime.utcnow())
+                )
+                db.session.commit()
+
+            self._processes[session_id] = process
+            health = self._health[session_id]
+            health.failures = 0
+            health.healthy = None
+            health.cpu_sample = None
+            bridge_client.close_session(session_id)
+            session_registry.update(session_id, heartbeat=False, port=port, host=bridge_nodes.local_host)
+            logger.info(f"Started WhatsApp bridge for session {session_id}, PID: {process.pid}, port: {port}")
+            return process.pid
+
+    def stop(self, session_id):
+        """Stops the session's bridge (if any) and marks it as stopped"""
+        with self._lock(session_id):
+            local_node_id = self._local_node()
+            row = db.session.query(WhatsAppSession.bridge_pid, WhatsAppSession.node_id).filter_by(id=session_id).first()
+            if row is not None and row.node_id is not None and row.node_id != local_node_id:
+                if row.bridge_pid and bridge_nodes.alive(row.node_id):
+                    self._forward(row.node_id, session_id, 'stop')
+                elif row.bridge_pid:
+                    # The node is down; its bridges are gone or unreachable anyway
+                    db.session.execute(
+                        update(WhatsAppSession).where(WhatsAppSession.id == session_id).values(bridge_pid=None)
+                    )
+                    db.session.commit()
+                bridge_client.close_session(session_id)
+                return
+            process = self._processes.get(session_id)
+            pid = row.bridge_pid if row is not None and row.bridge_pid else (process.pid if process else None)
+            if pid:
+                self._terminate(session_id, pid)
+                logger.info(f"Stopped WhatsApp bridge for session {session_id}, PID: {pid}")
+            if row is not None and row.bridge_pid:
+                db.session.execute(
+                    update(WhatsAppSession).where(WhatsAppSession.id == session_id).values(bridge_pid=None)
+                )
+                db.session.commit()
+            health = self._health.get(session_id)
+            if health is not None:
+                health.failures = 0
+                health.healthy = None
+            bridge_client.close_session(session_id)
+
+    def stop_many(self, session_ids):
+        """Stops several bridges, BRIDGE_STOP_CONCURRENCY at a time"""
+        if not session_ids:
+            return
+
+        def stop(session_id):
+            with self.app.app_context():
+                self.stop(session_id)
+
+        workers = max(1, min(BRIDGE_STOP_CONCURRENCY, len(session_ids)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bridge-stop') as executor:
+            list(executor.map(stop, session_ids))
+
+    def restart(self, session_id):
+        """Stops the running bridge (if any) and starts a new one; returns the new pid"""
+        with self._lock(session_id):
+            self.stop(session_id)
+            return self.start(session_id)
+
+    def migrate(self, session_id, node_id=None):
+        """Moves a session's bridge to another node (the best placed one by default)
+
+        The bridge is stopped on its current node and started on the new one, so the
+        session is unavailable for the time a bridge takes to start. The WhatsApp auth
+        data (.wwebjs_auth) must be on storage shared by the nodes.
+        """
+        with self._lock(session_id):
+            current = db.session.query(WhatsAppSession.node_id).filter_by(id=session_id).scalar()
+            if node_id is None:
+                node_id = bridge_nodes.place(exclude_node_id=current)
+            elif not bridge_nodes.accepts(node_id):
+                raise NodeError(f"Bridge node {node_id} is not accepting sessions", 409)
+            if node_id == current:
+                return self.start(session_id)
+
+            self.stop(session_id)
+            db.session.execute(
+                update(WhatsAppSession)
+                .where(WhatsAppSession.id == session_id)
+                .values(node_id=node_id, bridge_port=None)
+            )
+            db.session.commit()
+            logger.info(f"Migrating session {session_id} from bridge node {current} to {node_id}")
+            return self.start(session_id)
+
+    def drain(self, node_id, migrate=True):
+        """Stops placing sessions on a node and, optionally, moves its bridges elsewhere in the background"""
+        db.session.execute(update(BridgeNode).where(BridgeNode.id == node_id).values(status='draining'))
+        db.session.commit()
+        session_ids = [
+            session_id for (session_id,) in db.session.query(WhatsAppSession.id)
+            .filter(WhatsAppSession.node_id == node_id, WhatsAppSession.bridge_pid.isnot(None))
+            .order_by(WhatsAppSession.id)
+        ]
+        if migrate and session_ids:
+            threading.Thread(target=self._migrate_all, args=(session_ids,), name=f'bridge-drain-{node_id}',
+                             daemon=True).start()
+        return session_ids
+
+    def _migrate_all(self, session_ids):
+        # Uma sessão por vez, para que as demais continuem atendendo durante o rebalanceamento
+        for session_id in session_ids:
+            try:
+                with self.app.app_context():
+                    self.migrate(session_id)
+            except Exception as e:
+                logger.error(f"Error migrating session {session_id}: {str(e)}")
+
+    def activate(self, node_id):
+        db.session.execute(update(BridgeNode).where(BridgeNode.id == node_id).values(status='active'))
+        db.session.commit()
+
+    def forget(self, session_id):
+        """Drops the state of a deleted session (call after stop)"""
+        self._processes.pop(session_id, None)
+        self._health.pop(session_id, None)
+        with self._locks_lock:
+            self._session_locks.pop(session_id, None)
+
+    # Health checks
+
+    def _probe(self, port, session_id):
+        host, port = bridge_address(session_id, port)
+        try:
+            with urllib.request.urlopen(f"http://{host}:{port}/health", timeout=BRIDGE_HEALTH_TIMEOUT) as response:
+                return response.status == 200
+        except Exception:
+            return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    self.check_all()
+            except Exception as e:
+                logger.error(f"Error in bridge supervisor loop: {str(e)}")
+            self._stop.wait(self.health_interval)
+
+    def check_all(self):
+        """Probes every running bridge of this node and restarts the dead or unresponsive ones"""
+        rows = (db.session.query(WhatsAppSession.id, WhatsAppSession.bridge_pid, WhatsAppSession.bridge_port,
+                                 WhatsAppSession.bridge_started_at)
+                .filter(WhatsAppSession.node_id == self._local_node(), WhatsAppSession.bridge_pid.isnot(None))
+                .all())
+        # Reap bridges started by this process that exited in the meantime
+        for process in list(self._processes.values()):
+            process.poll()
+
+        for session_id, pid, port, started_at in rows:
+            health = self._health[session_id]
+            alive = self._is_bridge(pid, session_id)
+            health.healthy = alive and self._probe(port, session_id)
+            health.checked_at = datetime.utcnow()
+            if health.healthy:
+                health.failures = 0
+                if started_at and (datetime.utcnow() - started_at).total_seconds() >= BRIDGE_STABLE_AFTER:
+                    health.restarts = 0
+                continue
+
+            health.failures += 1
+            if alive and health.failures < BRIDGE_HEALTH_FAILURES:
+                continue
+            if time.monotonic() < health.next_restart_at:
+                continue
+            self._restart_failed(session_id, pid, health, alive)
+
+        # Report the node's load for the placement of new sessions
+        pids = [pid for (pid,) in db.session.query(WhatsAppSession.bridge_pid)
+                .filter(WhatsAppSession.node_id == self._local_node(), WhatsAppSession.bridge_pid.isnot(None))]
+        usage = process_group_usage() or {}
+        bridge_nodes.heartbeat(len(pids), sum(usage.get(pid, (0, 0, 0.0))[1] for pid in pids))
+
+    def _restart_failed(self, session_id, pid, health, alive):
+        with self._lock(session_id):
+            # Claim the restart; another worker may have restarted this bridge already
+            claimed = db.session.execute(
+                update(WhatsAppSession)
+                .where(WhatsAppSession.id == session_id, WhatsAppSession.bridge_pid == pid)
+                .values(bridge_pid=None)
+            ).rowcount
+            db.session.commit()
+            if not claimed:
+                return
+
+            reason = "unresponsive" if alive else "not running"
+            logger.warning(f"Bridge of session {session_id} (PID {pid}) is {reason}, restarting")
+            self._terminate(session_id, pid)
+            health.restarts += 1
+            delay = min(BRIDGE_RESTART_BACKOFF_MAX, BRIDGE_RESTART_BACKOFF_BASE * 2 ** (health.restarts - 1))
+            health.next_restart_at = time.monotonic() + delay
+            try:
+                self.start(session_id)
+            except Exception as e:
+                logger.error(f"Error restarting bridge of session {session_id}: {str(e)}")
+
+    # Reporting
+
+    def stats(self, session_id=None):
+        """Per-bridge process, health and resource usage (RSS and CPU of the whole process group)"""
+        self._local_node()
+        query = db.session.query(WhatsAppSession.id, WhatsAppSession.bridge_pid, WhatsAppSession.bridge_port,
+                                 WhatsAppSession.bridge_started_at, WhatsAppSession.node_id)
+        if session_id is not None:
+            query = query.filter_by(id=session_id)
+        usage_by_group = process_group_usage() or {}
+        reports = []
+        for sid, pid, port, started_at, node_id in query.order_by(WhatsAppSession.id):
+            local = bridge_nodes.is_local(node_id)
+            health = self._health.get(sid) if local else None
+            # Bridges on other nodes are checked (and measured) by their own node
+            running = bool(pid) and (self._is_bridge(pid, sid) if local else True)
+            report = {
+                'session_id': sid,
+                'node_id': node_id,
+                'pid': pid,
+                'port': port,
+                'running': running,
+                'started_at': started_at.isoformat() if started_at and pid else None,
+                'healthy': health.healthy if health else None,
+                'last_check': health.checked_at.isoformat() if health and health.checked_at else None,
+                'failures': health.failures if health else 0,
+                'restarts': health.restarts if health else 0,
+                'processes': None,
+                'rss_bytes': None,
+                'cpu_seconds': None,
+                'cpu_percent': None
+            }
+            usage = usage_by_group.get(pid) if running and local else None
+            if usage is not None:
+                processes, rss, cpu = usage
+                report.update(processes=processes, rss_bytes=rss, cpu_seconds=round(cpu, 2))
+                health = self._health[sid]
+                now = time.monotonic()
+                if health.cpu_sample is not None and now > health.cpu_sample[1]:
+                    report['cpu_percent'] = round(100 * (cpu - health.cpu_sample[0]) / (now - health.cpu_sample[1]), 1)
+                health.cpu_sample = (cpu, now)
+            reports.append(report)
+        return reports
+
+
+class BridgeLauncher:
+    """Starts queued bridges a few at a time, spaced out by an interval"""
+
+    def __init__(self, supervisor, concurrency=BRIDGE_LAUNCH_CONCURRENCY, interval=BRIDGE_LAUNCH_INTERVAL):
+        self.supervisor = supervisor
+        self.concurrency = max(1, concurrency)
+        self.interval = interval
+        self._pending = deque()
+        self._queued = set()
+        self._starting = set()
+        self._workers = 0
+        self._lock = threading.Lock()
+        self.started = 0
+        self.failed = 0
+        self._failures = deque(maxlen=100)
+
+    def launch(self, session_ids):
+        """Queues the bridges of session_ids; returns how many were queued (not already pending)"""
+        with self._lock:
+            queued = 0
+            for session_id in session_ids:
+                if session_id in self._queued or session_id in self._starting:
+                    continue
+                self._pending.append(session_id)
+                self._queued.add(session_id)
+                queued += 1
+            # Workers are started on demand and exit when the queue is empty
+            while self._workers < min(self.concurrency, len(self._pending)):
+                self._workers += 1
+                threading.Thread(target=self._run, name=f'bridge-launcher-{self._workers}', daemon=True).start()
+            return queued
+
+    def cancel(self, session_ids):
+        """Drops pending launches (of sessions being deleted)"""
+        session_ids = set(session_ids)
+        with self._lock:
+            self._pending = deque(session_id for session_id in self._pending if session_id not in session_ids)
+            self._queued -= session_ids
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._workers -= 1
+                    return
+                session_id = self._pending.popleft()
+                self._queued.discard(session_id)
+                self._starting.add(session_id)
+            try:
+                with self.supervisor.app.app_context():
+                    self.supervisor.start(session_id)
+                with self._lock:
+                    self.started += 1
+            except Exception as e:
+                logger.error(f"Error launching bridge of session {session_id}: {str(e)}")
+                with self._lock:
+                    self.failed += 1
+                    self._failures.append({'session_id': session_id, 'error': str(e),
+                                           'at': datetime.utcnow().isoformat()})
+            finally:
+                with self._lock:
+                    self._starting.discard(session_id)
+            time.sleep(self.interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'concurrency': self.concurrency,
+                'interval': self.interval,
+                'pending': list(self._pending),
+                'starting': sorted(self._starting),
+                'started': self.started,
+                'failed': self.failed,
+                'recent_failures': list(self._failures)
+            }
+
+
+bridge_supervisor = BridgeSupervisor(app)
+bridge_launcher = BridgeLauncher(bridge_supervisor)
@@ -0,0 +1,322 @@
+"""
+Bulk creation, update and deletion of sessions and webhooks.
+
+The whole payload is validated before anything is written. If any item is invalid,
+the request is rejected with the errors of every invalid item (BulkError). A valid
+payload is written with one statement per table and a single commit: ORM bulk
+INSERT ... RETURNING, bulk UPDATE by primary key, and DELETE ... WHERE id IN (...).
+The routes then update the in-memory state (registry, caches, scheduler) the same way
+the single-item routes do. Bridges of new sessions go through the bridge launcher.
+"""
+import json
+import os
+from datetime import datetime
+
+from sqlalchemy import delete, insert, select, update
+
+from app import db
+from models import WhatsAppSession, Webhook, WebhookDelivery, WebhookEvent
+
+# Maximum number of items accepted by a single bulk request
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', '1000'))
+
+SESSION_NAME_MAX = WhatsAppSession.name.type.length
+SESSION_DESCRIPTION_MAX = WhatsAppSession.description.type.length
+WEBHOOK_NAME_MAX = Webhook.name.type.length
+WEBHOOK_URL_MAX = Webhook.url.type.length
+
+
+class BulkError(Exception):
+    """The payload was rejected; errors lists the invalid items as {"index", "error"}"""
+
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.message = message
+        self.errors = errors or []
+
+    def to_dict(self):
+        result = {"error": self.message}
+        if self.errors:
+            result["errors"] = self.errors
+        return result
+
+
+def _items(items, name):
+    if not isinstance(items, list) or not items:
+        raise BulkError(f"{name} must be a non-empty list")
+    if len(items) > BULK_MAX_ITEMS:
+        raise BulkError(f"A bulk request accepts at most {BULK_MAX_ITEMS} items")
+    return items
+
+
+def _ids(ids):
+    _items(ids, "ids")
+    if not all(isinstance(item, int) and not isinstance(item, bool) for item in ids):
+        raise BulkError("ids must be integers")
+    if len(set(ids)) != len(ids):
+        raise BulkError("ids must not repeat")
+    return ids
+
+
+def _check(errors):
+    if errors:
+        raise BulkError(f"{len(errors)} invalid item(s), nothing was written", errors)
+
+
+def _string(data, field, max_length, required=False):
+    value = data.get(field)
+    if value is None or value == '':
+        if required:
+            raise ValueError(f"{field} is required")
+        return value
+    if not isinstance(value, str):
+        raise ValueError(f"{field} must be a string")
+    if len(value) > max_length:
+        raise ValueError(f"{field} is longer than {max_length} characters")
+    return value
+
+
+def _session_values(data, creating):
+    """Column values of a session item (raises ValueError)"""
+    if not isinstance(data, dict):
+        raise ValueError("item must be an object")
+    values = {}
+    if creating or 'name' in data:
+        values['name'] = _string(data, 'name', SESSION_NAME_MAX, required=True)
+    if 'description' in data or creating:
+        values['description'] = _string(data, 'description', SESSION_DESCRIPTION_MAX) or ''
+    # Limites de envio da sessão (None volta aos valores padrão), como em PUT /api/sessions/<id>
+    for field in ('send_rate', 'send_burst'):
+        if field in data:
+            value = data[field]
+            if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0):
+                raise ValueError(f"{field} must be a positive number")
+            values[field] = value
+    return values
+
+
+def _webhook_values(data, creating):
+    """Column values of a webhook item (raises ValueError)"""
+    if not isinstance(data, dict):
+        raise ValueError("item must be an object")
+    values = {}
+    if creating or 'name' in data:
+        values['name'] = _string(data, 'name', WEBHOOK_NAME_MAX, required=True)
+    if creating or 'url' in data:
+        values['url'] = _string(data, 'url', WEBHOOK_URL_MAX, required=True)
+    if creating or 'session_id' in data:
+        session_id = data.get('session_id')
+        if not isinstance(session_id, int) or isinstance(session_id, bool):
+            raise ValueError("session_id is required" if session_id is None else "session_id must be an integer")
+        values['session_id'] = session_id
+    if 'is_active' in data:
+        if not isinstance(data['is_active'], bool):
+            raise ValueError("is_active must be a boolean")
+        values['is_active'] = data['is_active']
+    elif creating:
+        values['is_active'] = True
+    if 'events' in data:
+        # Not a column: written to webhook_event by _subscribe
+        values['events'] = Webhook.validate_events(data['events'])
+    elif creating:
+        values['events'] = Webhook.DEFAULT_EVENTS
+    if 'headers' in data:
+        headers = data['headers']
+        if not isinstance(headers, dict) or not all(isinstance(value, str) for value in headers.values()):
+            raise ValueError("headers must be an object of strings")
+        values['headers'] = json.dumps(headers)
+    return values
+
+
+def _validate(items, build, creating):
+    """Builds the rows of items; returns (rows, errors)"""
+    rows, errors = [], []
+    for index, data in enumerate(items):
+        try:
+            row = build(data, creating)
+            if not creating:
+                item_id = data.get('id')
+                if not isinstance(item_id, int) or isinstance(item_id, bool):
+                    raise ValueError("id is required")
+                row['id'] = item_id
+            rows.append(row)
+        except ValueError as e:
+            errors.append({"index": index, "error": str(e)})
+            rows.append(None)
+    return rows, errors
+
+
+def _existing(model, ids):
+    if not ids:
+        return set()
+    return set(db.session.scalars(select(model.id).where(model.id.in_(ids))))
+
+
+def _check_ids(rows, errors, model, label):
+    """Reports the rows whose id is unknown or repeated"""
+    ids = [row['id'] for row in rows if row is not None]
+    existing = _existing(model, ids)
+    seen = set()
+    for index, row in enumerate(rows):
+        if row is None:
+            continue
+        if row['id'] not in existing:
+            errors.append({"index": index, "error": f"{label} {row['id']} not found"})
+        elif row['id'] in seen:
+            errors.append({"index": index, "error": f"{label} {row['id']} appears more than once"})
+        seen.add(row['id'])
+
+
+def _check_session_names(rows, errors):
+    """Reports names repeated in the payload or taken by another session"""
+    names = [row['name'] for row in rows if row is not None and 'name' in row]
+    taken = dict(db.session.execute(
+        select(WhatsAppSession.name, WhatsAppSession.id).where(WhatsAppSession.name.in_(names))
+    ).all()) if names else {}
+    seen = set()
+    for index, row in enumerate(rows):
+        if row is None or 'name' not in row:
+            continue
+        name = row['name']
+        owner = taken.get(name)
+        if name in seen:
+            errors.append({"index": index, "error": f"Session name '{name}' appears more than once"})
+        elif owner is not None and owner != row.get('id'):
+            errors.append({"index": index, "error": f"Session name '{name}' is already in use"})
+        seen.add(name)
+
+
+def _check_webhook_sessions(rows, errors):
+    session_ids = {row['session_id'] for row in rows if row is not None and 'session_id' in row}
+    existing = _existing(WhatsAppSession, session_ids)
+    for index, row in enumerate(rows):
+        if row is not None and 'session_id' in row and row['session_id'] not in existing:
+            errors.append({"index": index, "error": f"Session {row['session_id']} not found"})
+
+
+def _sorted(errors):
+    return sorted(errors, key=lambda error: error['index'])
+
+
+def _insert(model, rows, ordered=False):
+    """Inserts rows in batched multi-row statements; returns the new ids
+
+    The ids come in the order of rows only when ordered is set, which costs one
+    statement per row on SQLite.
+    """
+    statement = insert(model).returning(model.id, sort_by_parameter_order=ordered)
+    return list(db.session.scalars(statement, rows))
+
+
+def _subscribe(events_by_webhook):
+    """Replaces the event subscriptions of the webhooks in events_by_webhook"""
+    if not events_by_webhook:
+        return
+    db.session.execute(delete(WebhookEvent).where(WebhookEvent.webhook_id.in_(list(events_by_webhook))),
+                       execution_options={'synchronize_session': False})
+    rows = [{'webhook_id': webhook_id, 'event': event}
+            for webhook_id, events in events_by_webhook.items() for event in events]
+    if rows:
+        db.session.execute(insert(WebhookEvent), rows)
+
+
+def _update(model, rows):
+    now = datetime.utcnow()
+    db.session.execute(update(model), [dict(row, updated_at=now) for row in rows])
+
+
+def _commit():
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def create_sessions(items):
+    """Creates the sessions of items; returns their ids"""
+    rows, errors = _validate(_items(items, "sessions"), _session_values, creating=True)
+    _check_session_names(rows, errors)
+    _check(_sorted(errors))
+    ids = _insert(WhatsAppSession, rows)
+    _commit()
+    return ids
+
+
+def update_sessions(items):
+    """Updates the sessions of items (each with its id); returns their ids"""
+    rows, errors = _validate(_items(items, "sessions"), _session_values, creating=False)
+    _check_ids(rows, errors, WhatsAppSession, "Session")
+    _check_session_names(rows, errors)
+    _check(_sorted(errors))
+    _update(WhatsAppSession, rows)
+    _commit()
+    return [row['id'] for row in rows]
+
+
+def delete_sessions(ids):
+    """Deletes the sessions and their webhooks (stop their bridges first)"""
+    ids = _ids(ids)
+    webhook_ids = select(Webhook.id).where(Webhook.session_id.in_(ids)).scalar_subquery()
+    db.session.execute(delete(WebhookDelivery).where(WebhookDelivery.webhook_id.in_(webhook_ids)),
+                       execution_options={'synchronize_session': False})
+    db.session.execute(delete(WebhookEvent).where(WebhookEvent.webhook_id.in_(webhook_ids)),
+                       execution_options={'synchronize_session': False})
+    db.session.execute(delete(Webhook).where(Webhook.session_id.in_(ids)),
+                       execution_options={'synchronize_session': False})
+    db.session.execute(delete(WhatsAppSession).where(WhatsAppSession.id.in_(ids)),
+                       execution_options={'synchronize_session': False})
+    _commit()
+
+
+def check_sessions(ids):
+    """Validates a list of session ids to delete; returns it"""
+    ids = _ids(ids)
+    existing = _existing(WhatsAppSession, ids)
+    _check([{"index": index, "error": f"Session {session_id} not found"}
+            for index, session_id in enumerate(ids) if session_id not in existing])
+    return ids
+
+
+def create_webhooks(items):
+    """Creates the webhooks of items; returns their ids"""
+    rows, errors = _validate(_items(items, "webhooks"), _webhook_values, creating=True)
+    _check_webhook_sessions(rows, errors)
+    _check(_sorted(errors))
+    events = [row.pop('events') for row in rows]
+    ids = _insert(Webhook, rows, ordered=True)
+    _subscribe(dict(zip(ids, events)))
+    _commit()
+    return ids
+
+
+def update_webhooks(items):
+    """Updates the webhooks of items; returns the ids of the sessions whose webhooks changed"""
+    rows, errors = _validate(_items(items, "webhooks"), _webhook_values, creating=False)
+    _check_ids(rows, errors, Webhook, "Webhook")
+    _check_webhook_sessions(rows, errors)
+    _check(_sorted(errors))
+    previous = dict(db.session.execute(
+        select(Webhook.id, Webhook.session_id).where(Webhook.id.in_([row['id'] for row in rows]))
+    ).all())
+    events = {row['id']: row.pop('events') for row in rows if 'events' in row}
+    _update(Webhook, rows)
+    _subscribe(events)
+    _commit()
+    return set(previous.values()) | {row['session_id'] for row in rows if 'session_id' in row}
+
+
+def delete_webhooks(ids):
+    """Deletes the webhooks and their deliveries; returns the ids of their sessions"""
+    ids = _ids(ids)
+    owners = dict(db.session.execute(select(Webhook.id, Webhook.session_id).where(Webhook.id.in_(ids))).all())
+    _check([{"index": index, "error": f"Webhook {webhook_id} not found"}
+            for index, webhook_id in enumerate(ids) if webhook_id not in owners])
+    db.session.execute(delete(WebhookDelivery).where(WebhookDelivery.webhook_id.in_(ids)),
+                       execution_options={'synchronize_session': False})
+    db.session.execute(delete(WebhookEvent).where(WebhookEvent.webhook_id.in_(ids)),
+                       execution_options={'synchronize_session': False})
+    db.session.execute(delete(Webhook).where(Webhook.id.in_(ids)),
+                       execution_options={'synchronize_session': False})
+    _commit()
+    return set(owners.values())
@@ -0,0 +1,162 @@
+"""
+Database engine profiles.
+
+The engine options depend on the backend of DATABASE_URL:
+
+    sqlite      WAL journal (readers no longer wait for the writer), a busy timeout
+                instead of immediate "database is locked" errors, synchronous=NORMAL
+                and an in-memory page cache; no pre-ping (there is no server to lose).
+    postgresql  a sized pool (LIFO, so surplus connections go idle and get recycled),
+                statement and idle-in-transaction timeouts set once per connection,
+                no pre-ping round trip per checkout by default and, with the psycopg 3
+                driver (postgresql+psycopg://), server-side prepared statements.
+
+Every option can be overridden with the DB_* variables below; the effective profile
+is logged at startup and returned by GET /api/debug/database (X-Debug-Token).
+"""
+import logging
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+# Pool (PostgreSQL and other servers)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))
+# Seconds a request waits for a free connection before failing
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '300'))
+# Pre-ping costs a round trip per checkout; recycling already drops old connections
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '0') == '1'
+# PostgreSQL timeouts in milliseconds (0 = no limit)
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', '30000'))
+DB_LOCK_TIMEOUT = int(os.environ.get('DB_LOCK_TIMEOUT', '10000'))
+DB_IDLE_IN_TRANSACTION_TIMEOUT = int(os.environ.get('DB_IDLE_IN_TRANSACTION_TIMEOUT', '60000'))
+# Executions of a statement before psycopg 3 prepares it on the server (empty = never)
+DB_PREPARE_THRESHOLD = os.environ.get('DB_PREPARE_THRESHOLD', '5')
+DB_APPLICATION_NAME = os.environ.get('DB_APPLICATION_NAME', 'whatsflow')
+# Compiled SQL statements kept per engine
+DB_QUERY_CACHE_SIZE = int(os.environ.get('DB_QUERY_CACHE_SIZE', '1000'))
+
+# SQLite
+DB_SQLITE_JOURNAL_MODE = os.environ.get('DB_SQLITE_JOURNAL_MODE', 'wal')
+DB_SQLITE_BUSY_TIMEOUT = int(os.environ.get('DB_SQLITE_BUSY_TIMEOUT', '5000'))
+DB_SQLITE_SYNCHRONOUS = os.environ.get('DB_SQLITE_SYNCHRONOUS', 'normal')
+# Page cache in KiB and memory-mapped I/O in bytes, per connection
+DB_SQLITE_CACHE_SIZE = int(os.environ.get('DB_SQLITE_CACHE_SIZE', '20000'))
+DB_SQLITE_MMAP_SIZE = int(os.environ.get('DB_SQLITE_MMAP_SIZE', str(128 * 1024 * 1024)))
+
+
+def _sqlite_pragmas():
+    return {
+        'journal_mode': DB_SQLITE_JOURNAL_MODE,
+        'busy_timeout': DB_SQLITE_BUSY_TIMEOUT,
+        'synchronous': DB_SQLITE_SYNCHRONOUS,
+        'cache_size': -DB_SQLITE_CACHE_SIZE,
+        'mmap_size': DB_SQLITE_MMAP_SIZE,
+        'temp_store': 'memory',
+    }
+
+
+def _postgres_options():
+    options = {
+        'statement_timeout': DB_STATEMENT_TIMEOUT,
+        'lock_timeout': DB_LOCK_TIMEOUT,
+        'idle_in_transaction_session_timeout': DB_IDLE_IN_TRANSACTION_TIMEOUT,
+    }
+    return ' '.join(f"-c {name}={value}" for name, value in options.items())
+
+
+def engine_options(database_uri):
+    """SQLALCHEMY_ENGINE_OPTIONS for the backend of database_uri"""
+    url = make_url(database_uri)
+    options = {'query_cache_size': DB_QUERY_CACHE_SIZE}
+    if url.get_backend_name() == 'sqlite':
+        # Um arquivo local: nada a reconectar, e as pragmas são aplicadas em apply_profile
+        options['pool_pre_ping'] = False
+        return options
+
+    options.update({
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'pool_use_lifo': True,
+    })
+    if url.get_backend_name() == 'postgresql':
+        connect_args = {'application_name': DB_APPLICATION_NAME, 'options': _postgres_options()}
+        if url.get_driver_name() == 'psycopg' and DB_PREPARE_THRESHOLD:
+            connect_args['prepare_threshold'] = int(DB_PREPARE_THRESHOLD)
+        options['connect_args'] = connect_args
+    return options
+
+
+def apply_profile(engine):
+    """Registers the per-connection settings of engine's backend (the SQLite pragmas)"""
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = _sqlite_pragmas()
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+
+def describe(engine):
+    """Effective settings of engine, read back from the database where possible"""
+    backend = engine.dialect.name
+    profile = {'backend': backend, 'driver': engine.dialect.driver}
+    pool = engine.pool
+    if hasattr(pool, 'size'):
+        profile['pool'] = {
+            'size': pool.size(),
+            'max_overflow': pool._max_overflow,
+            'timeout': pool.timeout(),
+            'recycle': pool._recycle,
+            'pre_ping': pool._pre_ping,
+            'checked_out': pool.checkedout(),
+        }
+
+    with engine.connect() as connection:
+        if backend == 'sqlite':
+            profile['pragmas'] = {
+                name: connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+                for name in _sqlite_pragmas()
+            }
+        elif backend == 'postgresql':
+            profile['settings'] = {
+                name: connection.exec_driver_sql(f"SHOW {name}").scalar()
+                for name in ('statement_timeout', 'lock_timeout', 'idle_in_transaction_session_timeout',
+                             'application_name')
+            }
+            if engine.dialect.driver == 'psycopg':
+                profile['settings']['prepare_threshold'] = DB_PREPARE_THRESHOLD or None
+    return profile
+
+
+def log_profile(engine):
+    try:
+        profile = describe(engine)
+    except Exception as e:
+        logger.warning(f"Could not read the database profile: {str(e)}")
+        return
+    details = profile.get('pragmas') or profile.get('settings') or {}
+    summary = ', '.join(f"{name}={value}" for name, value in details.items())
+    if 'pool' in profile:
+        pool = profile['pool']
+        summary = (f"pool_size={pool['size']}, max_overflow={pool['max_overflow']}, "
+                   f"pre_ping={pool['pre_ping']}" + (f", {summary}" if summary else ''))
+    logger.info(f"Database engine: {profile['backend']}+{profile['driver']} ({summary})")
+    in_memory = engine.url.database in (None, '', ':memory:')
+    journal_mode = str(details.get('journal_mode', '')).lower()
+    if profile['backend'] == 'sqlite' and not in_memory and journal_mode != DB_SQLITE_JOURNAL_MODE.lower():
+        logger.warning(f"SQLite journal_mode is {details.get('journal_mode')}, not {DB_SQLITE_JOURNAL_MODE} "
+                       "(unsupported by the filesystem?)")
@@ -29,6 +29,10 @@ done
 
 echo "PostgreSQL está pronto - continuando..."
 
+# Aplicar as migrações pendentes do schema uma vez, antes dos workers
+echo "Migrando o schema do banco..."
+python3 -m schema upgrade
+
 # Executar o comando passado para o script
 echo "Iniciando a aplicação..."
 exec "$@"
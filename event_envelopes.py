@@ -0,0 +1,109 @@
+"""
+Normalization of the events posted by the bridges.
+
+A bridge posts each event once, with its payload and the account it came from. The
+event is normalized here exactly once: it gets the WAHA-style envelope (id, session,
+engine, environment) and its media reference, and is serialized to JSON a single
+time. All the webhooks subscribed to the event share that body.
+
+The only part of the body that differs per webhook is the host of the media URL
+(see media_host_for). The body is serialized with a random token in place of that
+host. Rendering for a webhook replaces the token with the host, a plain byte
+substitution, and each host is rendered once per event.
+"""
+import json
+import os
+import time
+
+from models import EventPayload
+
+EVENT_ENGINE = 'WEBJS'
+EVENT_ENVIRONMENT = {
+    "version": os.environ.get('EVENT_ENVIRONMENT_VERSION', '2025.2.1'),
+    "engine": EVENT_ENGINE,
+    "tier": "CORE",
+    "browser": os.environ.get('PUPPETEER_EXECUTABLE_PATH', '/usr/bin/chromium')
+}
+UNKNOWN_ME = {"id": "unknown", "pushName": "WhatsFlow"}
+
+
+def media_host_for(webhook_url):
+    """Host used in media URLs sent to a webhook (same rules the bridge used)"""
+    if 'localhost' in webhook_url:
+        return 'localhost:5000'
+    if '127.0.0.1' in webhook_url:
+        return '127.0.0.1:5000'
+    return f"{os.environ.get('API_HOST', 'web')}:{os.environ.get('API_PORT', '5000')}"
+
+
+def _event_id():
+    return f"evt_{_base36(int(time.time() * 1000))}{os.urandom(5).hex()}"
+
+
+def _base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    result = ''
+    while number:
+        number, remainder = divmod(number, 36)
+        result = digits[remainder] + result
+    return result or '0'
+
+
+class EventEnvelope:
+    """An event serialized once; render() fills in the media host of a webhook"""
+
+    __slots__ = ('event', 'body', 'media_token', '_rendered')
+
+    def __init__(self, event, body, media_token=None):
+        self.event = event
+        self.body = body
+        self.media_token = media_token
+        self._rendered = {}  # host -> bytes
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record.event, record.body, record.media_token)
+
+    def to_record(self, session_id):
+        return EventPayload(session_id=session_id, event=self.event, body=self.body, media_token=self.media_token)
+
+    def render(self, webhook_url):
+        """The body as sent to webhook_url"""
+        host = media_host_for(webhook_url) if self.media_token else None
+        body = self._rendered.get(host)
+        if body is None:
+            text = self.body.replace(self.media_token, host) if host else self.body
+            body = self._rendered[host] = text.encode('utf-8')
+        return body
+
+
+def normalize(session_id, data):
+    """Builds the envelope of an event posted by a bridge ({"event", "me", "payload"})"""
+    event = data['event']
+    source = data
+    payload = data.get('payload')
+    if isinstance(payload, dict) and 'environment' in payload and 'payload' in payload:
+        # Bridges anteriores enviam o envelope WAHA completo
+        source = payload
+        payload = payload['payload']
+    if payload is None:
+        payload = {}
+
+    media_token = None
+    media = payload.get('media') if isinstance(payload, dict) else None
+    if isinstance(media, dict) and str(media.get('url', '')).startswith('/'):
+        media_token = f"media-host-{os.urandom(12).hex()}"
+        media_url = f"http://{media_token}{media['url']}"
+        payload = dict(payload, media=dict(media, url=media_url), mediaUrl=media_url)
+
+    envelope = {
+        "id": source.get('id') or _event_id(),
+        "event": event,
+        "session": f"session_{session_id}",
+        "metadata": source.get('metadata') or {},
+        "me": source.get('me') or UNKNOWN_ME,
+        "payload": payload,
+        "engine": EVENT_ENGINE,
+        "environment": EVENT_ENVIRONMENT
+    }
+    return EventEnvelope(event, json.dumps(envelope), media_token)
@@ -0,0 +1,79 @@
+"""
+Gunicorn configuration (production launch mode).
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+The master loads the app once (preload_app) and forks the workers from it: imports,
+route registration and the schema check run once, a new or restarted worker serves
+requests right after the fork, and the workers share the loaded code copy-on-write.
+Each worker then opens its own database connections and starts its own background
+tasks (post_fork).
+
+In-memory state is per worker: the session registry and the webhook cache converge
+within their TTLs, each worker enforces its share of the send rate limits (see
+send_scheduler), and the status stream relays the changes made by the other workers
+(SSE_RELAY_INTERVAL). /metrics reports every worker, with a worker label, through the
+snapshots in METRICS_MULTIPROC_DIR (a temporary directory unless set; see metrics).
+"""
+import gc
+import glob
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5000')
+workers = max(int(os.environ.get('WEB_CONCURRENCY', '2')), 1)
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', '4'))
+timeout = int(os.environ.get('WEB_TIMEOUT', '300'))
+reuse_port = True
+
+# Desenvolvimento: WEB_RELOAD=1 recarrega o código quando um arquivo muda (sem preload)
+reload = os.environ.get('WEB_RELOAD') == '1'
+preload_app = os.environ.get('WEB_PRELOAD', '1') == '1' and not reload
+
+# Lidos pela aplicação: número de workers (limites de envio, relay do stream de status)
+# e se as tarefas em segundo plano ficam para depois do fork
+os.environ['WEB_CONCURRENCY'] = str(workers)
+os.environ['WEB_PREFORK'] = '1' if preload_app else '0'
+# Métricas de todos os workers no /metrics (ver metrics); o diretório temporário é removido na saída
+metrics_tempdir = None
+if workers > 1 and not os.environ.get('METRICS_MULTIPROC_DIR'):
+    metrics_tempdir = os.environ['METRICS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='whatsflow-metrics-')
+
+
+def on_starting(server):
+    # Amostras de uma execução anterior no mesmo diretório
+    directory = os.environ.get('METRICS_MULTIPROC_DIR')
+    if directory:
+        for path in glob.glob(os.path.join(directory, '*.json*')):
+            os.remove(path)
+
+
+def pre_fork(server, worker):
+    # Objetos carregados no master ficam fora da coleta de lixo: o gc dos workers não
+    # reescreve suas páginas, que continuam compartilhadas (copy-on-write)
+    if server.cfg.preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return  # Cada worker carrega a aplicação e inicia suas tarefas em init_app()
+    from app import app, db, start_background_tasks
+
+    # As conexões do pool vieram do master; o worker abre as suas
+    with app.app_context():
+        db.engine.dispose(close=False)
+    start_background_tasks()
+
+
+def child_exit(server, worker):
+    from metrics import remove_snapshot
+
+    remove_snapshot(worker.pid, os.environ.get('METRICS_MULTIPROC_DIR'))
+
+
+def on_exit(server):
+    if metrics_tempdir:
+        shutil.rmtree(metrics_tempdir, ignore_errors=True)
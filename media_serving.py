@@ -0,0 +1,64 @@
+"""
+Responses for media files.
+
+Media is served with a strong ETag (the content hash for files of the media store),
+Cache-Control, conditional GET and byte ranges, so webhook consumers that retry or
+seek (voice notes, videos) don't download the whole file again. With
+MEDIA_SENDFILE_MODE the file itself is sent by the web server in front of the app:
+
+    x-accel     nginx; MEDIA_ACCEL_ROOT must be exposed as an internal location at
+                MEDIA_ACCEL_PREFIX (location /protected-media/ { internal; alias /app/media/; })
+    x-sendfile  Apache mod_xsendfile, lighttpd
+"""
+import os
+import urllib.parse
+
+from flask import current_app, request
+from werkzeug.utils import send_file
+
+# '' (the app streams the file), 'x-accel' or 'x-sendfile'
+MEDIA_SENDFILE_MODE = os.environ.get('MEDIA_SENDFILE_MODE', '').lower()
+MEDIA_ACCEL_ROOT = os.environ.get('MEDIA_ACCEL_ROOT', '/app/media')
+MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected-media/')
+# Seconds clients may reuse a media file without revalidating it
+MEDIA_CACHE_MAX_AGE = int(os.environ.get('MEDIA_CACHE_MAX_AGE', '86400'))
+
+
+def _accel_path(path):
+    """Internal nginx URI of a file, or None if it is outside MEDIA_ACCEL_ROOT"""
+    root = os.path.abspath(MEDIA_ACCEL_ROOT)
+    path = os.path.abspath(path)
+    if os.path.commonpath([root, path]) != root:
+        return None
+    relative = os.path.relpath(path, root).replace(os.sep, '/')
+    return MEDIA_ACCEL_PREFIX.rstrip('/') + '/' + urllib.parse.quote(relative)
+
+
+def send_media(path, mimetype=None, etag=None, download_name=None, immutable=False):
+    """Sends a media file; etag=None derives the ETag from the file's mtime, size and path"""
+    internal = _accel_path(path) if MEDIA_SENDFILE_MODE == 'x-accel' else None
+    if internal is not None:
+        # nginx envia o arquivo (e atende os Range); aqui só validadores e cabeçalhos de cache
+        response = current_app.response_class(mimetype=mimetype or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = internal
+        stat = os.stat(path)
+        response.last_modified = stat.st_mtime
+        response.set_etag(etag or f"{stat.st_mtime}-{stat.st_size}")
+        response.cache_control.public = True
+        response.cache_control.max_age = MEDIA_CACHE_MAX_AGE
+        response = response.make_conditional(request.environ, accept_ranges=False)
+    else:
+        response = send_file(
+            path,
+            request.environ,
+            mimetype=mimetype,
+            download_name=download_name,
+            conditional=True,
+            etag=etag or True,
+            max_age=MEDIA_CACHE_MAX_AGE,
+            use_x_sendfile=MEDIA_SENDFILE_MODE == 'x-sendfile',
+            response_class=current_app.response_class
+        )
+    if immutable:
+        response.cache_control.immutable = True
+    return response
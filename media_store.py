@@ -0,0 +1,525 @@
+"""
+Content-addressed media store.
+
+Every media file (inbound media saved by the bridges, outbound media fetched from a
+URL) is stored once under MEDIA_STORE_DIR/<hash[:2]>/<hash>, keyed by the SHA-256 of
+its content, and indexed in the MediaObject table. Names served under
+/api/files/session_<id>/<name> are MediaRef rows and fetched URLs are MediaUrl rows;
+both count as references of the object they point to.
+
+Outbound sends with imageUrl/documentUrl/audioUrl are resolved here first: the URL is
+downloaded once per MEDIA_URL_CACHE_TTL and the bridge receives the hash of the stored
+file, so a campaign sending the same image to thousands of chats fetches it once.
+Downloads only reach public addresses: the peer of every connection (redirects
+included) is checked after connecting, so a name that resolves, or later re-resolves,
+to a private, loopback, link-local, reserved or multicast address is refused.
+
+Objects without references, objects not accessed for MEDIA_STORE_TTL and, beyond that,
+the least recently used objects are evicted to keep the store under MEDIA_STORE_MAX_BYTES.
+"""
+import contextlib
+import hashlib
+import http.client
+import ipaddress
+import logging
+import mimetypes
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+from flask import has_app_context
+from sqlalchemy import delete, func, update
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from media_uploads import MEDIA_UPLOAD_CHUNK, MEDIA_UPLOAD_MAX_BYTES
+from models import MediaObject, MediaRef, MediaUrl
+
+logger = logging.getLogger(__name__)
+
+# Shared with the bridges of this host (the bridge uses the same default: ./media/store)
+MEDIA_STORE_DIR = os.environ.get('MEDIA_STORE_DIR',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media', 'store'))
+MEDIA_STORE_MAX_BYTES = int(os.environ.get('MEDIA_STORE_MAX_BYTES', str(5 * 1024 * 1024 * 1024)))
+# Seconds without access after which an object is evicted (0 = only evict over the byte budget)
+MEDIA_STORE_TTL = float(os.environ.get('MEDIA_STORE_TTL', str(30 * 86400)))
+# Objects accessed more recently than this are never evicted (sends in progress may still read them)
+MEDIA_STORE_GRACE = float(os.environ.get('MEDIA_STORE_GRACE', '600'))
+MEDIA_STORE_EVICT_INTERVAL = float(os.environ.get('MEDIA_STORE_EVICT_INTERVAL', '60'))
+# Seconds a fetched media URL is reused before it is downloaded again (0 = send URLs to the bridge as is)
+MEDIA_URL_CACHE_TTL = float(os.environ.get('MEDIA_URL_CACHE_TTL', '3600'))
+MEDIA_FETCH_TIMEOUT = float(os.environ.get('MEDIA_FETCH_TIMEOUT', '120'))
+# Media URLs may point to non-public addresses (development, tests); or only these hosts
+MEDIA_URL_ALLOW_PRIVATE = os.environ.get('MEDIA_URL_ALLOW_PRIVATE') == '1'
+MEDIA_URL_ALLOWED_HOSTS = frozenset(host.strip().lower() for host in
+                                    os.environ.get('MEDIA_URL_ALLOWED_HOSTS', '').split(',') if host.strip())
+# Seconds a served name stays mapped to its object without asking the database
+MEDIA_REF_CACHE_TTL = float(os.environ.get('MEDIA_REF_CACHE_TTL', '300'))
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+# URL fields of the outbound payloads (see message_sender)
+URL_FIELDS = ('imageUrl', 'documentUrl', 'audioUrl')
+# Last-access times are written at most this often per object
+TOUCH_INTERVAL = 60
+URL_MEMO_MAX_ENTRIES = 10000
+REF_CACHE_MAX_ENTRIES = 10000
+
+
+class MediaStoreError(Exception):
+    """Media could not be stored or fetched"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class MediaUrlBlocked(MediaStoreError):
+    """A media URL points to an address the server must not fetch from"""
+
+
+def _blocked_address(address):
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return (not ip.is_global or ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved
+            or ip.is_multicast or ip.is_unspecified)
+
+
+def check_media_host(host, address):
+    """Raises MediaUrlBlocked when host, connected (or resolved) to address, may not be fetched"""
+    if MEDIA_URL_ALLOW_PRIVATE or (host or '').lower() in MEDIA_URL_ALLOWED_HOSTS:
+        return
+    if _blocked_address(address):
+        raise MediaUrlBlocked(f"Media URL host {host} resolves to a non-public address", 400)
+
+
+def check_media_url(url):
+    """Checks every address of a URL's host before the URL is handed to a bridge"""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise MediaStoreError(f"Unsupported media URL: {url}")
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(parts.hostname, parts.port or 80,
+                                                              type=socket.SOCK_STREAM)}
+    except socket.gaierror as e:
+        raise MediaStoreError(f"Media URL host {parts.hostname} cannot be resolved: {e}", 400)
+    for address in addresses:
+        check_media_host(parts.hostname, address)
+
+
+class _CheckedConnectionMixin:
+    """http.client connection that checks the peer right after the TCP connect (before TLS)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = self._connect_checked
+
+    def _connect_checked(self, address, *args, **kwargs):
+        sock = socket.create_connection(address, *args, **kwargs)
+        try:
+            check_media_host(self.host, sock.getpeername()[0])
+        except MediaUrlBlocked:
+            sock.close()
+            raise
+        return sock
+
+
+class _CheckedHTTPConnection(_CheckedConnectionMixin, http.client.HTTPConnection):
+    pass
+
+
+class _CheckedHTTPSConnection(_CheckedConnectionMixin, http.client.HTTPSConnection):
+    pass
+
+
+class _CheckedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_CheckedHTTPConnection, req)
+
+
+class _CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_CheckedHTTPSConnection, req, context=self._context)
+
+
+def _media_opener():
+    # Só http(s), sem proxy do ambiente: redirecionamentos passam pelas mesmas conexões verificadas
+    opener = urllib.request.OpenerDirector()
+    for handler in (_CheckedHTTPHandler(), _CheckedHTTPSHandler(), urllib.request.HTTPRedirectHandler(),
+                    urllib.request.HTTPDefaultErrorHandler(), urllib.request.HTTPErrorProcessor()):
+        opener.add_handler(handler)
+    return opener
+
+
+class MediaStore:
+    """Deduplicated media files with a reference-counted index and LRU/TTL eviction"""
+
+    def __init__(self, app, directory=MEDIA_STORE_DIR, max_bytes=MEDIA_STORE_MAX_BYTES, ttl=MEDIA_STORE_TTL,
+                 url_ttl=MEDIA_URL_CACHE_TTL):
+        self.app = app
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.url_ttl = url_ttl
+        self._urls = {}        # url -> (expires, hash, mimetype)
+        self._refs = {}        # (session_id, name) -> (expires, hash, mimetype)
+        self._mimetypes = {}   # hash -> mimetype (objects never change)
+        self._url_locks = {}   # url -> [Lock, users], so concurrent sends of a new URL fetch it once
+        self._touched = {}     # hash -> monotonic time of the last last_accessed_at write
+        self._evicted_at = 0.0
+        self._lock = threading.Lock()
+        self._opener = _media_opener()
+
+    def _context(self):
+        # Chamado também por threads de envio em segundo plano (lotes, jobs)
+        return contextlib.nullcontext() if has_app_context() else self.app.app_context()
+
+    def object_path(self, media_hash):
+        """Returns the file of an object, or None for an invalid hash"""
+        if not media_hash or not HASH_PATTERN.match(media_hash):
+            return None
+        return os.path.join(self.directory, media_hash[:2], media_hash)
+
+    def put(self, source, mimetype=None):
+        """Stores the content of a file-like object and returns its hash"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as target:
+                while True:
+                    chunk = source.read(MEDIA_UPLOAD_CHUNK)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > MEDIA_UPLOAD_MAX_BYTES:
+                        raise MediaStoreError(f"Media exceeds {MEDIA_UPLOAD_MAX_BYTES} bytes", 413)
+                    digest.update(chunk)
+                    target.write(chunk)
+            if size == 0:
+                raise MediaStoreError("Media is empty")
+            media_hash = digest.hexdigest()
+            path = self.object_path(media_hash)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+
+        now = datetime.utcnow()
+        with self._context():
+            if db.session.get(MediaObject, media_hash) is None:
+                db.session.add(MediaObject(hash=media_hash, size=size, mimetype=mimetype, ref_count=0,
+                                           last_accessed_at=now))
+                try:
+                    db.session.commit()
+                except IntegrityError:
+                    # Mesmo conteúdo gravado por outra requisição ao mesmo tempo
+                    db.session.rollback()
+            else:
+                self._touch(media_hash, force=True)
+        self._touched[media_hash] = time.monotonic()
+        return media_hash
+
+    @staticmethod
+    def _add_refs(media_hash, count):
+        db.session.execute(
+            update(MediaObject).where(MediaObject.hash == media_hash)
+            .values(ref_count=MediaObject.ref_count + count)
+        )
+
+    def index(self, session_id, name, source, mimetype=None):
+        """Stores a session's media under a name and returns its hash"""
+        media_hash = self.put(source, mimetype)
+        with self._context():
+            try:
+                self._set_ref(session_id, name, media_hash)
+            except IntegrityError:
+                # Mesmo nome gravado por outra requisição ao mesmo tempo: atualiza a linha dela
+                db.session.rollback()
+                self._set_ref(session_id, name, media_hash)
+        self._refs.pop((session_id, name), None)
+        self.evict()
+        return media_hash
+
+    def _set_ref(self, session_id, name, media_hash):
+        ref = MediaRef.query.filter_by(session_id=session_id, name=name).first()
+        if ref is None:
+            db.session.add(MediaRef(session_id=session_id, name=name, media_hash=media_hash))
+            self._add_refs(media_hash, 1)
+        elif ref.media_hash != media_hash:
+            self._add_refs(ref.media_hash, -1)
+            ref.media_hash = media_hash
+            self._add_refs(media_hash, 1)
+        db.session.commit()
+
+    def lookup(self, session_id, name):
+        """Returns (hash, path, mimetype) of a session's media, or None if it is not in the store"""
+        key = (session_id, name)
+        cached = self._refs.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            media_hash, mimetype = cached[1], cached[2]
+        else:
+            row = (db.session.query(MediaObject.hash, MediaObject.mimetype)
+                   .join(MediaRef, MediaRef.media_hash == MediaObject.hash)
+                   .filter(MediaRef.session_id == session_id, MediaRef.name == name)
+                   .first())
+            if row is None:
+                return None
+            media_hash, mimetype = row.hash, row.mimetype
+            with self._lock:
+                if len(self._refs) >= REF_CACHE_MAX_ENTRIES:
+                    self._refs.clear()
+                self._refs[key] = (time.monotonic() + MEDIA_REF_CACHE_TTL, media_hash, mimetype)
+        path = self.object_path(media_hash)
+        if not os.path.exists(path):
+            # Despejado (talvez por outro processo)
+            self._refs.pop(key, None)
+            return None
+        self._touch(media_hash)
+        return media_hash, path, mimetype
+
+    def open_object(self, media_hash):
+        """Returns (path, mimetype) of an object, or None if it is not in the store"""
+        path = self.object_path(media_hash)
+        if path is None or not os.path.exists(path):
+            return None
+        if media_hash in self._mimetypes:
+            mimetype = self._mimetypes[media_hash]
+        else:
+            obj = db.session.get(MediaObject, media_hash)
+            if obj is None:
+                return None
+            mimetype = obj.mimetype
+            with self._lock:
+                if len(self._mimetypes) >= REF_CACHE_MAX_ENTRIES:
+                    self._mimetypes.clear()
+                self._mimetypes[media_hash] = mimetype
+        self._touch(media_hash)
+        return path, mimetype
+
+    def _touch(self, media_hash, force=False):
+        now = time.monotonic()
+        if not force and now - self._touched.get(media_hash, 0) < TOUCH_INTERVAL:
+            return
+        self._touched[media_hash] = now
+        db.session.execute(
+            update(MediaObject).where(MediaObject.hash == media_hash)
+            .values(last_accessed_at=datetime.utcnow())
+        )
+        db.session.commit()
+
+    def release_session(self, session_id):
+        """Drops the references of a deleted session (its objects are evicted once unreferenced)"""
+        refs = (db.session.query(MediaRef.media_hash, func.count(MediaRef.id))
+                .filter(MediaRef.session_id == session_id)
+                .group_by(MediaRef.media_hash)
+                .all())
+        for media_hash, count in refs:
+            self._add_refs(media_hash, -count)
+        db.session.execute(delete(MediaRef).where(MediaRef.session_id == session_id))
+        db.session.commit()
+        with self._lock:
+            for key in [key for key in self._refs if key[0] == session_id]:
+                del self._refs[key]
+
+    def resolve_url(self, url):
+        """Returns (hash, mimetype) of the media at a URL, downloading it only on a cache miss"""
+        cached = self._urls.get(url)
+        if cached is not None and cached[0] > time.monotonic():
+            self._touch_in_context(cached[1])
+            return cached[1], cached[2]
+
+        with self._lock:
+            entry = self._url_locks.get(url)
+            if entry is None:
+                entry = self._url_locks[url] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                with self._context():
+                    return self._resolve_url(url)
+        finally:
+            with self._lock:
+                # A entrada só sai quando o último que espera por ela terminar
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._url_locks[url]
+
+    def _touch_in_context(self, media_hash):
+        if time.monotonic() - self._touched.get(media_hash, 0) < TOUCH_INTERVAL:
+            return
+        with self._context():
+            self._touch(media_hash)
+
+    def _resolve_url(self, url):
+        # Outra thread pode ter acabado de buscar a mesma URL
+        cached = self._urls.get(url)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1], cached[2]
+
+        url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        memo = db.session.get(MediaUrl, url_hash)
+        if memo is not None:
+            age = (datetime.utcnow() - memo.fetched_at).total_seconds()
+            obj = db.session.get(MediaObject, memo.media_hash)
+            if age < self.url_ttl and obj is not None and os.path.exists(self.object_path(obj.hash)):
+                self._touch(obj.hash)
+                self._remember(url, self.url_ttl - age, obj.hash, obj.mimetype)
+                return obj.hash, obj.mimetype
+
+        media_hash, mimetype = self._fetch(url)
+        if memo is None:
+            db.session.add(MediaUrl(url_hash=url_hash, url=url, media_hash=media_hash, fetched_at=datetime.utcnow()))
+            self._add_refs(media_hash, 1)
+        else:
+            if memo.media_hash != media_hash:
+                self._add_refs(memo.media_hash, -1)
+                self._add_refs(media_hash, 1)
+                memo.media_hash = media_hash
+            memo.fetched_at = datetime.utcnow()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # URL registrada por outro processo ao mesmo tempo; o objeto é o mesmo ou será substituído
+            db.session.rollback()
+        self._remember(url, self.url_ttl, media_hash, mimetype)
+        self.evict()
+        return media_hash, mimetype
+
+    def _remember(self, url, ttl, media_hash, mimetype):
+        with self._lock:
+            if len(self._urls) >= URL_MEMO_MAX_ENTRIES:
+                self._urls.clear()
+            self._urls[url] = (time.monotonic() + ttl, media_hash, mimetype)
+
+    def _fetch(self, url):
+        if urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+            raise MediaStoreError(f"Unsupported media URL: {url}")
+        logger.info(f"Fetching media from {url}")
+        request = urllib.request.Request(url, headers={'User-Agent': 'WhatsFlow'})
+        # O tamanho é limitado por put() (MEDIA_UPLOAD_MAX_BYTES)
+        with self._opener.open(request, timeout=MEDIA_FETCH_TIMEOUT) as response:
+            mimetype = response.headers.get_content_type() if response.headers.get('Content-Type') else None
+            if mimetype is None or mimetype == 'application/octet-stream':
+                mimetype = mimetypes.guess_type(urllib.parse.urlsplit(url).path)[0] or 'application/octet-stream'
+            media_hash = self.put(response, mimetype)
+        return media_hash, mimetype
+
+    def resolve_payload(self, payload):
+        """Replaces the media URL of an outbound payload with the hash of the stored file
+
+        Falls back to the original payload (the bridge fetches the URL itself) when URL
+        caching is disabled or the URL cannot be fetched here. Raises MediaStoreError for
+        URLs that must not be fetched at all (non-public addresses).
+        """
+        field = next((field for field in URL_FIELDS if payload.get(field)), None)
+        if field is None:
+            return payload
+        url = payload[field]
+        if self.url_ttl <= 0:
+            check_media_url(url)
+            return payload
+        try:
+            media_hash, mimetype = self.resolve_url(url)
+        except MediaUrlBlocked:
+            raise
+        except Exception as e:
+            logger.warning(f"Could not cache media {url}, the bridge will fetch it: {str(e)}")
+            return payload
+        payload = dict(payload)
+        del payload[field]
+        payload['mediaHash'] = media_hash
+        payload['mimetype'] = mimetype
+        if 'filename' in payload and not payload['filename']:
+            payload['filename'] = os.path.basename(urllib.parse.urlsplit(url).path)
+        return payload
+
+    def evict(self, force=False):
+        """Removes unreferenced, expired and least recently used objects; returns (objects, bytes) freed"""
+        now = time.monotonic()
+        if not force and now - self._evicted_at < MEDIA_STORE_EVICT_INTERVAL:
+            return 0, 0
+        self._evicted_at = now
+
+        with self._context():
+            utcnow = datetime.utcnow()
+            grace_cutoff = utcnow - timedelta(seconds=MEDIA_STORE_GRACE)
+            victims = {}
+            unreferenced = db.session.query(MediaObject.hash, MediaObject.size).filter(
+                MediaObject.ref_count <= 0, MediaObject.last_accessed_at < grace_cutoff
+            )
+            victims.update(unreferenced)
+            if self.ttl > 0:
+                expired = db.session.query(MediaObject.hash, MediaObject.size).filter(
+                    MediaObject.last_accessed_at < utcnow - timedelta(seconds=self.ttl)
+                )
+                victims.update(expired)
+
+            total = (db.session.query(func.coalesce(func.sum(MediaObject.size), 0)).scalar() or 0) - \
+                sum(victims.values())
+            if total > self.max_bytes:
+                lru = (db.session.query(MediaObject.hash, MediaObject.size)
+                       .filter(MediaObject.last_accessed_at < grace_cutoff)
+                       .order_by(MediaObject.last_accessed_at)
+                       .limit(10000)
+                       .all())
+                for media_hash, size in lru:
+                    if total <= self.max_bytes:
+                        break
+                    if media_hash not in victims:
+                        victims[media_hash] = size
+                        total -= size
+
+            if not victims:
+                return 0, 0
+            hashes = list(victims)
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                db.session.execute(delete(MediaRef).where(MediaRef.media_hash.in_(chunk)))
+                db.session.execute(delete(MediaUrl).where(MediaUrl.media_hash.in_(chunk)))
+                db.session.execute(delete(MediaObject).where(MediaObject.hash.in_(chunk)))
+            db.session.commit()
+
+        evicted = set(hashes)
+        with self._lock:
+            for url in [url for url, entry in self._urls.items() if entry[1] in evicted]:
+                del self._urls[url]
+            for key in [key for key, entry in self._refs.items() if entry[1] in evicted]:
+                del self._refs[key]
+        for media_hash in hashes:
+            self._touched.pop(media_hash, None)
+            self._mimetypes.pop(media_hash, None)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.object_path(media_hash))
+        freed = sum(victims.values())
+        logger.info(f"Evicted {len(hashes)} media objects ({freed} bytes)")
+        return len(hashes), freed
+
+    def stats(self):
+        objects, total = db.session.query(func.count(MediaObject.hash),
+                                          func.coalesce(func.sum(MediaObject.size), 0)).one()
+        return {
+            'objects': objects,
+            'bytes': int(total),
+            'max_bytes': self.max_bytes,
+            'refs': db.session.query(func.count(MediaRef.id)).scalar(),
+            'urls': db.session.query(func.count(MediaUrl.url_hash)).scalar(),
+            'unreferenced': db.session.query(func.count(MediaObject.hash))
+                                      .filter(MediaObject.ref_count <= 0).scalar()
+        }
+
+
+media_store = MediaStore(app)
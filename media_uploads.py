@@ -0,0 +1,152 @@
+"""
+Streaming store for uploaded media.
+
+Media sent to the send-image/send-document/send-audio routes as multipart/form-data,
+or as a raw request body, is written to MEDIA_UPLOAD_DIR in fixed-size chunks, so the
+memory used per upload stays bounded whatever the file size. The bridge receives the
+upload ID instead of base64 inside the JSON payload: bridges on the same host read the
+file from the shared media directory, others download it from GET /api/uploads/<id>.
+Files are removed once the send finishes and swept after MEDIA_UPLOAD_TTL otherwise.
+"""
+import logging
+import mimetypes
+import os
+import re
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Directory shared with the bridges (the bridge uses the same default: ./media/uploads)
+MEDIA_UPLOAD_DIR = os.environ.get('MEDIA_UPLOAD_DIR',
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media', 'uploads'))
+MEDIA_UPLOAD_MAX_BYTES = int(os.environ.get('MEDIA_UPLOAD_MAX_BYTES', str(100 * 1024 * 1024)))
+# Seconds after which uploads that were never sent (or whose send crashed) are deleted
+MEDIA_UPLOAD_TTL = float(os.environ.get('MEDIA_UPLOAD_TTL', '86400'))
+MEDIA_UPLOAD_CHUNK = 64 * 1024
+
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(Exception):
+    """The uploaded media was rejected"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class MediaUpload:
+    __slots__ = ('id', 'path', 'size', 'mimetype', 'filename')
+
+    def __init__(self, upload_id, path, size, mimetype, filename):
+        self.id = upload_id
+        self.path = path
+        self.size = size
+        self.mimetype = mimetype
+        self.filename = filename
+
+
+def is_upload_request(request):
+    """True for multipart or raw binary bodies (JSON bodies keep using the URL/base64 fields)"""
+    return bool(request.mimetype) and request.mimetype != 'application/json'
+
+
+class MediaUploadStore:
+    """Writes uploads to disk in chunks and hands out their IDs"""
+
+    def __init__(self, directory=MEDIA_UPLOAD_DIR, max_bytes=MEDIA_UPLOAD_MAX_BYTES, ttl=MEDIA_UPLOAD_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._swept_at = 0.0
+
+    def path(self, upload_id):
+        """Returns the file of an upload, or None for an invalid ID"""
+        if not upload_id or not UPLOAD_ID_PATTERN.match(upload_id):
+            return None
+        return os.path.join(self.directory, upload_id)
+
+    def receive(self, request):
+        """Stores the media of a request; returns (MediaUpload, form fields)
+
+        multipart/form-data: the file comes in the 'file' part and the other fields
+        (chatId, caption, filename, asVoiceMessage) as form fields. Any other content
+        type: the body is the file and the fields come in the query string.
+        """
+        if request.content_length is not None and request.content_length > self.max_bytes:
+            raise UploadError(f"Upload exceeds {self.max_bytes} bytes", 413)
+
+        if request.mimetype == 'multipart/form-data':
+            if request.content_length is None:
+                raise UploadError("Content-Length is required for multipart uploads", 411)
+            file = request.files.get('file')
+            if file is None:
+                raise UploadError("file is required")
+            fields = request.form.to_dict()
+            filename = fields.get('filename') or file.filename or ''
+            upload = self._write(file.stream, file.mimetype, filename)
+        else:
+            fields = request.args.to_dict()
+            filename = fields.get('filename', '')
+            upload = self._write(request.stream, request.mimetype, filename)
+        return upload, fields
+
+    def _write(self, source, mimetype, filename):
+        self._sweep()
+        os.makedirs(self.directory, exist_ok=True)
+        upload_id = uuid.uuid4().hex
+        path = os.path.join(self.directory, upload_id)
+        size = 0
+        try:
+            with open(path, 'wb') as target:
+                while True:
+                    chunk = source.read(MEDIA_UPLOAD_CHUNK)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadError(f"Upload exceeds {self.max_bytes} bytes", 413)
+                    target.write(chunk)
+        except BaseException:
+            self.discard(upload_id)
+            raise
+        if size == 0:
+            self.discard(upload_id)
+            raise UploadError("Uploaded file is empty")
+
+        if not mimetype or mimetype == 'application/octet-stream':
+            mimetype = (mimetypes.guess_type(filename)[0] if filename else None) or 'application/octet-stream'
+        return MediaUpload(upload_id, path, size, mimetype, filename)
+
+    def discard(self, upload_id):
+        path = self.path(upload_id)
+        if path is None:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove upload {upload_id}: {str(e)}")
+
+    def _sweep(self):
+        """Removes expired uploads, at most once every ten minutes"""
+        now = time.time()
+        if now - self._swept_at < 600:
+            return
+        self._swept_at = now
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                if UPLOAD_ID_PATTERN.match(entry.name) and now - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+media_uploads = MediaUploadStore()
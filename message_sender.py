@@ -0,0 +1,220 @@
+"""
+Outbound message payloads and sending helpers.
+
+Builds the bridge requests for each message type (the same payload shapes accepted by
+the send-text/send-image/send-document/send-audio routes) and sends batches of
+messages over the pooled bridge connections with bounded concurrency.
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from bridge_client import (bridge_client, async_bridge_client, BridgeError, BRIDGE_POOL_SIZE, BRIDGE_TIMEOUT,
+                           BRIDGE_MEDIA_TIMEOUT)
+from media_store import media_store, MediaStoreError, URL_FIELDS
+from metrics import send_queue_wait
+from tracing import tracer
+from send_scheduler import send_scheduler, SendQueueTimeout
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of items accepted by a single batch request
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '10000'))
+# Concurrent bridge calls per batch (defaults to the bridge pool size)
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', str(BRIDGE_POOL_SIZE)))
+
+
+def build_text_payload(data):
+    if not data.get('chatId') or not data.get('message'):
+        raise ValueError("chatId and message are required")
+    return {
+        "chatId": data.get('chatId'),
+        "message": data.get('message')
+    }
+
+
+def build_image_payload(data):
+    if not data.get('chatId'):
+        raise ValueError("chatId is required")
+    if not data.get('imageUrl') and not data.get('imageBase64'):
+        raise ValueError("imageUrl or imageBase64 is required")
+    payload = {
+        "chatId": data.get('chatId'),
+        "caption": data.get('caption', '')  # Legenda opcional
+    }
+    # Adicionar a URL da imagem ou base64, dependendo do que foi fornecido
+    if data.get('imageUrl'):
+        payload["imageUrl"] = data.get('imageUrl')
+    else:
+        payload["imageBase64"] = data.get('imageBase64')
+    return payload
+
+
+def build_document_payload(data):
+    if not data.get('chatId'):
+        raise ValueError("chatId is required")
+    if not data.get('documentUrl') and not data.get('documentBase64'):
+        raise ValueError("documentUrl or documentBase64 is required")
+    payload = {
+        "chatId": data.get('chatId'),
+        "caption": data.get('caption', ''),  # Legenda opcional
+        "filename": data.get('filename', '')  # Nome do arquivo opcional
+    }
+    # Adicionar a URL do documento ou base64, dependendo do que foi fornecido
+    if data.get('documentUrl'):
+        payload["documentUrl"] = data.get('documentUrl')
+    else:
+        payload["documentBase64"] = data.get('documentBase64')
+    return payload
+
+
+def build_audio_payload(data):
+    if not data.get('chatId'):
+        raise ValueError("chatId is required")
+    if not data.get('audioUrl') and not data.get('audioBase64'):
+        raise ValueError("audioUrl or audioBase64 is required")
+    payload = {
+        "chatId": data.get('chatId'),
+        "filename": data.get('filename', ''),  # Nome do arquivo opcional
+        "asVoiceMessage": data.get('asVoiceMessage', True)  # Se deve enviar como mensagem de voz
+    }
+    # Adicionar a URL do áudio ou base64, dependendo do que foi fornecido
+    if data.get('audioUrl'):
+        payload["audioUrl"] = data.get('audioUrl')
+    else:
+        payload["audioBase64"] = data.get('audioBase64')
+    return payload
+
+
+def build_upload_payload(message_type, data, upload):
+    """Payload for media already stored by media_uploads; the bridge loads it by uploadId"""
+    if not data.get('chatId'):
+        raise ValueError("chatId is required")
+    payload = {
+        "chatId": data.get('chatId'),
+        "uploadId": upload.id,
+        "mimetype": upload.mimetype,
+        "filename": data.get('filename') or upload.filename
+    }
+    if message_type == 'audio':
+        # Campos de formulário/query string chegam como texto
+        as_voice = data.get('asVoiceMessage', True)
+        if isinstance(as_voice, str):
+            as_voice = as_voice.lower() not in ('0', 'false', 'no')
+        payload["asVoiceMessage"] = as_voice
+    else:
+        payload["caption"] = data.get('caption', '')  # Legenda opcional
+    return payload
+
+
+# Message type -> (bridge path, payload builder, timeout)
+MESSAGE_TYPES = {
+    'text': ('/api/send-text', build_text_payload, BRIDGE_TIMEOUT),
+    'image': ('/api/send-image', build_image_payload, BRIDGE_MEDIA_TIMEOUT),
+    'document': ('/api/send-document', build_document_payload, BRIDGE_MEDIA_TIMEOUT),
+    'audio': ('/api/send-audio', build_audio_payload, BRIDGE_MEDIA_TIMEOUT),
+}
+
+
+def build_message(message_type, data):
+    """Returns (bridge path, payload, timeout) for a message; raises ValueError if invalid"""
+    if not isinstance(data, dict):
+        raise ValueError("Message must be an object")
+    if message_type not in MESSAGE_TYPES:
+        raise ValueError(f"Unsupported message type: {message_type}")
+    path, builder, timeout = MESSAGE_TYPES[message_type]
+    return path, builder(data), timeout
+
+
+def send_message(session_id, message_type, data):
+    """Sends one message through the session's bridge and returns the bridge response"""
+    _, payload, _ = build_message(message_type, data)
+    return send_payload(session_id, message_type, payload)
+
+
+def send_payload(session_id, message_type, payload):
+    """Sends an already built bridge payload (see build_message)
+
+    Waits for the session's scheduler first, so sends beyond the session's rate are
+    queued instead of being pushed into the bridge all at once. Media URLs are replaced
+    with the hash of the file in the media store, so each URL is downloaded once.
+    """
+    path, _, timeout = MESSAGE_TYPES[message_type]
+    if message_type != 'text':
+        try:
+            with tracer.phase('media'):
+                payload = media_store.resolve_payload(payload)
+        except MediaStoreError as e:
+            raise BridgeError(e.message, e.status_code)
+    try:
+        with tracer.phase('queue'):
+            send_queue_wait.observe(send_scheduler.acquire(session_id, payload['chatId']))
+    except SendQueueTimeout as e:
+        raise BridgeError(str(e), 503)
+    return bridge_client.post(session_id, path, payload, timeout=timeout)
+
+
+async def send_payload_async(session_id, message_type, payload):
+    """send_payload for the ASGI mode: waits for the scheduler and the bridge without holding a thread"""
+    path, _, timeout = MESSAGE_TYPES[message_type]
+    if any(payload.get(field) for field in URL_FIELDS):
+        # Busca da URL (na primeira vez) e consultas ao banco ficam fora do event loop
+        try:
+            with tracer.phase('media'):
+                payload = await asyncio.to_thread(media_store.resolve_payload, payload)
+        except MediaStoreError as e:
+            raise BridgeError(e.message, e.status_code)
+    try:
+        with tracer.phase('queue'):
+            send_queue_wait.observe(await send_scheduler.acquire_async(session_id, payload['chatId']))
+    except SendQueueTimeout as e:
+        raise BridgeError(str(e), 503)
+    return await async_bridge_client.post(session_id, path, payload, timeout=timeout)
+
+
+def _send_item(session_id, index, message_type, payload, trace=None):
+    # Só o rastreamento da requisição segue para a thread; o contexto da aplicação não
+    # (cada thread abre o seu, com sua própria sessão do banco)
+    token = tracer.attach(trace)
+    try:
+        response_data = send_payload(session_id, message_type, payload)
+        return {"index": index, "success": True, "chatId": payload["chatId"],
+                "messageId": response_data.get('messageId')}
+    except BridgeError as e:
+        return {"index": index, "success": False, "chatId": payload["chatId"],
+                "error": e.message, "status": e.status_code}
+    except Exception as e:
+        return {"index": index, "success": False, "chatId": payload["chatId"], "error": str(e), "status": 500}
+    finally:
+        tracer.detach(token)
+
+
+def send_batch(session_id, items, concurrency=BATCH_CONCURRENCY, trace=None):
+    """Sends a list of messages, yielding one result per item as they complete
+
+    Each item is a send payload plus an optional "type" (text, image, document or audio;
+    defaults to text). Invalid items are reported without being sent. trace is the
+    request's trace (tracer.current()), taken by the caller: a streamed response runs
+    this generator after the request's context is gone.
+    """
+    concurrency = max(1, min(concurrency, BATCH_CONCURRENCY))
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f'batch-{session_id}') as executor:
+        futures = []
+        for index, item in enumerate(items):
+            try:
+                message_type = item.get('type', 'text') if isinstance(item, dict) else None
+                _, payload, _ = build_message(message_type, item)
+            except ValueError as e:
+                yield {"index": index, "success": False, "error": str(e), "status": 400}
+                continue
+            # Cada item leva o rastreamento da requisição (ID enviado ao bridge)
+            futures.append(executor.submit(_send_item, session_id, index, message_type, payload, trace))
+
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # If the consumer goes away (e.g. a streaming client disconnects), drop what was not sent yet
+            for future in futures:
+                future.cancel()
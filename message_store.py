@@ -0,0 +1,149 @@
+"""
+Message history.
+
+The bridges report every message they see (received, sent, and again on each ack) in
+batches to POST /api/sessions/<id>/messages. Each batch is written with bulk upserts:
+new messages are inserted and known ones only have their ack raised, so acks that
+arrive before or after the message converge to the same row. History is read per chat
+with keyset pagination on (timestamp, id), which costs the same on any page.
+"""
+import base64
+import logging
+import os
+
+from sqlalchemy import and_, case, delete, or_, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db
+from models import Message
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of messages accepted by a single ingest request
+MESSAGE_INGEST_MAX = int(os.environ.get('MESSAGE_INGEST_MAX', '5000'))
+MESSAGE_PAGE_DEFAULT = int(os.environ.get('MESSAGE_PAGE_DEFAULT', '50'))
+MESSAGE_PAGE_MAX = int(os.environ.get('MESSAGE_PAGE_MAX', '500'))
+# Rows per INSERT statement
+INGEST_CHUNK = 500
+
+
+class MessageStore:
+    """Bulk ingestion and keyset-paginated history of messages"""
+
+    @staticmethod
+    def _row(session_id, data):
+        """Column values of a reported message, or None if it lacks the required fields"""
+        if not isinstance(data, dict) or not data.get('id') or not data.get('chatId'):
+            return None
+        try:
+            timestamp = int(data.get('timestamp'))
+            ack = int(data.get('ack') or 0)
+        except (TypeError, ValueError):
+            return None
+        return {
+            'session_id': session_id,
+            'message_id': str(data['id'])[:255],
+            'chat_id': str(data['chatId'])[:255],
+            'from_id': data.get('from'),
+            'to_id': data.get('to'),
+            'from_me': bool(data.get('fromMe')),
+            'type': data.get('type'),
+            'body': data.get('body'),
+            'has_media': bool(data.get('hasMedia')),
+            'ack': ack,
+            'timestamp': timestamp
+        }
+
+    def ingest(self, session_id, messages):
+        """Upserts a batch of reported messages; returns (stored, skipped)"""
+        rows = {}
+        skipped = 0
+        for data in messages:
+            row = self._row(session_id, data)
+            if row is None:
+                skipped += 1
+                continue
+            # Mesma mensagem várias vezes no lote (criação + acks): fica a de maior ack
+            previous = rows.get(row['message_id'])
+            if previous is None or row['ack'] >= previous['ack']:
+                rows[row['message_id']] = row
+        rows = list(rows.values())
+
+        for start in range(0, len(rows), INGEST_CHUNK):
+            self._upsert(rows[start:start + INGEST_CHUNK])
+        db.session.commit()
+        return len(rows), skipped
+
+    @staticmethod
+    def _upsert(rows):
+        if not rows:
+            return
+        table = Message.__table__
+        dialect = db.engine.dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            statement = insert(table)
+            # Acks só avançam (um ack antigo que chega atrasado não rebaixa o estado)
+            statement = statement.on_conflict_do_update(
+                index_elements=['session_id', 'message_id'],
+                set_={'ack': case((statement.excluded.ack > table.c.ack, statement.excluded.ack), else_=table.c.ack)}
+            )
+            db.session.execute(statement, rows)
+            return
+
+        # Outros bancos: atualizar os existentes e inserir o resto
+        existing = {
+            message_id for (message_id,) in db.session.query(Message.message_id).filter(
+                Message.session_id == rows[0]['session_id'],
+                Message.message_id.in_([row['message_id'] for row in rows])
+            )
+        }
+        for row in rows:
+            if row['message_id'] in existing:
+                db.session.execute(
+                    update(table)
+                    .where(table.c.session_id == row['session_id'], table.c.message_id == row['message_id'],
+                           table.c.ack < row['ack'])
+                    .values(ack=row['ack'])
+                )
+        new_rows = [row for row in rows if row['message_id'] not in existing]
+        if new_rows:
+            db.session.execute(table.insert(), new_rows)
+
+    @staticmethod
+    def encode_cursor(message):
+        return base64.urlsafe_b64encode(f"{message.timestamp}:{message.id}".encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Returns (timestamp, id) of a cursor; raises ValueError if it is invalid"""
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            timestamp, row_id = base64.urlsafe_b64decode(padded.encode()).decode().split(':')
+            return int(timestamp), int(row_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    def history(self, session_id, chat_id, limit=MESSAGE_PAGE_DEFAULT, cursor=None):
+        """Returns (messages newest first, cursor of the next page or None)"""
+        query = Message.query.filter(Message.session_id == session_id, Message.chat_id == chat_id)
+        if cursor:
+            timestamp, row_id = self.decode_cursor(cursor)
+            query = query.filter(or_(
+                Message.timestamp < timestamp,
+                and_(Message.timestamp == timestamp, Message.id < row_id)
+            ))
+        messages = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+        next_cursor = None
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = self.encode_cursor(messages[-1])
+        return messages, next_cursor
+
+    @staticmethod
+    def delete_session(session_id):
+        db.session.execute(delete(Message).where(Message.session_id == session_id))
+        db.session.commit()
+
+
+message_store = MessageStore()
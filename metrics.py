@@ -0,0 +1,405 @@
+"""
+Prometheus metrics, served as text at GET /metrics.
+
+A small in-process registry, so the hot path pays one dictionary lookup and one
+lock per observation. Metric families are declared here at import time. Each label
+combination gets its own child on first use, and the child is reused after that.
+
+Latency of a send is split across:
+
+    whatsflow_http_request_duration_seconds     whole request, per endpoint
+    whatsflow_session_request_duration_seconds  the forwarding routes, per session
+    whatsflow_send_queue_wait_seconds           time waiting for the send scheduler
+    whatsflow_bridge_request_duration_seconds   the HTTP call to the bridge (WhatsApp included)
+    whatsflow_db_query_duration_seconds         every SQL statement, per operation
+
+With several worker processes set METRICS_MULTIPROC_DIR (gunicorn.conf.py does it):
+each worker writes its samples there every METRICS_SNAPSHOT_INTERVAL seconds and
+the worker answering a scrape reports every worker, each series with a worker label
+(its PID). The other workers' samples are up to one interval old. The file of a
+worker that exits is removed (or ignored once stale), so its series stop; sum over
+the worker label in queries.
+"""
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# METRICS_ENABLED=0 disables the request and query hooks (the endpoint keeps working)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+# Worker threads serving requests, to compare with the in-flight gauge (gunicorn --threads)
+WEB_THREADS = int(os.environ.get('WEB_THREADS', '4'))
+# Directory shared by the worker processes (multiprocess mode, see above)
+METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR') or None
+METRICS_SNAPSHOT_INTERVAL = float(os.environ.get('METRICS_SNAPSHOT_INTERVAL', '5'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+
+# Endpoints that only forward a request to a session's bridge
+FORWARDING_ENDPOINTS = frozenset({
+    'send_text_message', 'send_image_message', 'send_document_message', 'send_audio_message',
+    'mark_chat_as_seen', 'start_typing',
+})
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ('_lock', '_buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    if len(values) != len(self.labelnames):
+                        raise ValueError(f"{self.name} expects labels {self.labelnames}")
+                    child = self._new_child()
+                    self._children[values] = child
+        return child
+
+    def collect(self):
+        """[label values, sample] of every child (JSON-serializable)"""
+        return [[list(values), self._sample(child)]
+                for values, child in sorted(self._children.items(), key=lambda item: item[0])]
+
+    def _sample(self, child):
+        return child.value
+
+    def render(self, workers=None):
+        """Text lines of the family; workers maps a worker label to its collect() (multiprocess mode)"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        if workers is None:
+            for values, sample in self.collect():
+                lines.extend(self._render_sample(self.labelnames, values, sample))
+        else:
+            labelnames = self.labelnames + ('worker',)
+            for worker, samples in sorted(workers.items()):
+                for values, sample in samples:
+                    lines.extend(self._render_sample(labelnames, values + [worker], sample))
+        return lines
+
+    def _render_sample(self, labelnames, values, sample):
+        return [f"{self.name}{_format_labels(labelnames, values)} {_format_number(sample)}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.function = function  # gauges read at scrape time
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def collect(self):
+        if self.function is not None:
+            self._default.set(self.function())
+        return super().collect()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _sample(self, child):
+        with child._lock:
+            return [list(child.counts), child.sum]
+
+    def _render_sample(self, labelnames, values, sample):
+        counts, total = sample
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(labelnames, values, f'le="{_format_number(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_number(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Metric families in declaration order"""
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def collect(self):
+        return {metric.name: metric.collect() for metric in self._metrics}
+
+    def render(self):
+        workers = None
+        if METRICS_MULTIPROC_DIR is not None:
+            workers = read_snapshots(METRICS_MULTIPROC_DIR)
+            workers[str(os.getpid())] = self.collect()
+        lines = []
+        for metric in self._metrics:
+            if workers is None:
+                lines.extend(metric.render())
+            else:
+                lines.extend(metric.render({worker: samples.get(metric.name, [])
+                                            for worker, samples in workers.items()}))
+        return '\n'.join(lines) + '\n'
+
+
+def read_snapshots(directory):
+    """{worker PID: collected samples} written by the other live workers"""
+    own = str(os.getpid())
+    # Arquivos não atualizados há três intervalos são de workers que já saíram
+    oldest = time.time() - 3 * METRICS_SNAPSHOT_INTERVAL
+    workers = {}
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        worker = os.path.basename(path)[:-len('.json')]
+        if worker == own:
+            continue
+        try:
+            if os.path.getmtime(path) < oldest:
+                continue
+            with open(path) as snapshot:
+                workers[worker] = json.load(snapshot)
+        except (OSError, ValueError):
+            continue  # Worker saindo (arquivo removido)
+    return workers
+
+
+class SnapshotWriter:
+    """Writes this worker's samples to METRICS_MULTIPROC_DIR for the scrapes answered by the others"""
+
+    def __init__(self, registry, directory=METRICS_MULTIPROC_DIR, interval=METRICS_SNAPSHOT_INTERVAL):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='metrics-snapshot', daemon=True)
+            self._thread.start()
+
+    def write(self):
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(path + '.tmp', 'w') as snapshot:
+            json.dump(self.registry.collect(), snapshot)
+        os.replace(path + '.tmp', path)  # Os leitores nunca veem um arquivo pela metade
+
+    def _run(self):
+        while True:
+            try:
+                self.write()
+            except Exception as e:
+                logger.error(f"Error writing the metrics snapshot: {str(e)}")
+            time.sleep(self.interval)
+
+
+def remove_snapshot(pid, directory=METRICS_MULTIPROC_DIR):
+    """Drops the samples of a worker that exited (called by the gunicorn master)"""
+    if directory is None:
+        return
+    for path in (os.path.join(directory, f"{pid}.json"), os.path.join(directory, f"{pid}.json.tmp")):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+registry = MetricsRegistry()
+snapshot_writer = SnapshotWriter(registry)
+
+http_request_duration = registry.histogram(
+    'whatsflow_http_request_duration_seconds', 'HTTP request latency per endpoint',
+    ('endpoint', 'method', 'status'))
+http_requests_in_flight = registry.gauge(
+    'whatsflow_http_requests_in_flight', 'Requests being served right now')
+http_worker_threads = registry.gauge(
+    'whatsflow_http_worker_threads', 'Threads available to serve requests', function=lambda: WEB_THREADS)
+session_request_duration = registry.histogram(
+    'whatsflow_session_request_duration_seconds', 'Latency of the bridge-forwarding routes per session',
+    ('session', 'endpoint', 'status'))
+send_queue_wait = registry.histogram(
+    'whatsflow_send_queue_wait_seconds', 'Time sends waited for the session send scheduler')
+bridge_request_duration = registry.histogram(
+    'whatsflow_bridge_request_duration_seconds', 'Latency of calls to the WhatsApp bridges',
+    ('session', 'path'))
+bridge_errors = registry.counter(
+    'whatsflow_bridge_errors_total', 'Failed bridge calls by HTTP status code', ('session', 'path', 'code'))
+db_query_duration = registry.histogram(
+    'whatsflow_db_query_duration_seconds', 'SQL statement latency', ('operation',), buckets=QUERY_BUCKETS)
+webhook_changes = registry.counter(
+    'whatsflow_webhook_changes_total', 'Webhooks created, updated and deleted through the API', ('operation',))
+
+_OPERATIONS = {'SELECT': 'select', 'INSERT': 'insert', 'UPDATE': 'update', 'DELETE': 'delete'}
+
+
+def observe_request(endpoint, method, status, session_id, duration):
+    """Records a finished request (also called by the native ASGI routes)"""
+    status = str(status)
+    http_request_duration.labels(endpoint, method, status).observe(duration)
+    if endpoint in FORWARDING_ENDPOINTS and session_id is not None:
+        session_request_duration.labels(str(session_id), endpoint, status).observe(duration)
+
+
+def init_app(app, engine):
+    """Installs the request timing hooks on app and the query timing hooks on engine"""
+    from flask import g, request
+    from sqlalchemy import event
+
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started_at = time.perf_counter()
+        http_requests_in_flight.inc()
+
+    @app.teardown_request
+    def observe_request_duration(exc=None):
+        started_at = g.pop('metrics_started_at', None)
+        if started_at is None:
+            return
+        http_requests_in_flight.dec()
+        status = g.pop('metrics_status', 500)
+        view_args = request.view_args or {}
+        observe_request(request.endpoint or 'unmatched', request.method, status, view_args.get('session_id'),
+                        time.perf_counter() - started_at)
+
+    @app.after_request
+    def record_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_started_at', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def observe_query_duration(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('metrics_query_started_at')
+        if not started:
+            return
+        operation = _OPERATIONS.get(statement[:6].upper(), 'other')
+        db_query_duration.labels(operation).observe(time.perf_counter() - started.pop())
+
+    @event.listens_for(engine, 'handle_error')
+    def discard_query_timer(context):
+        started = context.connection.info.get('metrics_query_started_at') if context.connection else None
+        if started:
+            started.pop()
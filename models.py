@@ -1,5 +1,6 @@
 from app import db
 from datetime import datetime
+from functools import lru_cache
 import json
 
 class WhatsAppSession(db.Model):
@@ -8,22 +9,37 @@ class WhatsAppSession(db.Model):
     name = db.Column(db.String(100), nullable=False, unique=True)
     description = db.Column(db.String(255))
     status = db.Column(db.String(50), default="disconnected")
-    qr_code = db.Column(db.Text)
-    session_data = db.Column(db.Text)
+    # Colunas pesadas (QR code em data URL e dados da sessão) só são carregadas quando usadas
+    qr_code = db.deferred(db.Column(db.Text))
+    session_data = db.deferred(db.Column(db.Text))
+    send_rate = db.Column(db.Float)  # Messages per second (None = SEND_RATE_DEFAULT, no limit when unset)
+    send_burst = db.Column(db.Integer)  # Token bucket size (None = SEND_BURST_DEFAULT)
+    # Processo do bridge Node.js, gerenciado pelo bridge_supervisor (pid None = bridge parado)
+    bridge_pid = db.Column(db.Integer)
+    bridge_port = db.Column(db.Integer)
+    bridge_started_at = db.Column(db.DateTime)
+    node_id = db.Column(db.Integer, db.ForeignKey('bridge_node.id'), index=True)  # Nó onde o bridge roda
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     webhooks = db.relationship('Webhook', backref='session', lazy=True, cascade="all, delete-orphan")
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'description': self.description,
-            'status': self.status,
-            'qr_code': self.qr_code,
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat()
-        }
+    # Fields available to to_dict and to the ?fields= projection of the sessions API
+    FIELDS = {
+        'id': lambda session: session.id,
+        'name': lambda session: session.name,
+        'description': lambda session: session.description,
+        'status': lambda session: session.status,
+        'qr_code': lambda session: session.qr_code,
+        'send_rate': lambda session: session.send_rate,
+        'send_burst': lambda session: session.send_burst,
+        'bridge_port': lambda session: session.bridge_port,
+        'node_id': lambda session: session.node_id,
+        'created_at': lambda session: session.created_at.isoformat(),
+        'updated_at': lambda session: session.updated_at.isoformat()
+    }
+
+    def to_dict(self, fields=None):
+        return {field: self.FIELDS[field](self) for field in (fields or self.FIELDS)}
 
 class Webhook(db.Model):
     """Model for Webhooks related to WhatsApp sessions"""
@@ -31,25 +47,57 @@ class Webhook(db.Model):
     name = db.Column(db.String(100), nullable=False)
     url = db.Column(db.String(255), nullable=False)
     session_id = db.Column(db.Integer, db.ForeignKey('whats_app_session.id'), nullable=False)
-    events = db.Column(db.Text)  # JSON array of event names
+    # Legacy JSON array of event names; schema.migrate_webhook_events moves it to webhook_event
+    events = db.Column(db.Text)
     headers = db.Column(db.Text)  # JSON object of custom headers
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    deliveries = db.relationship('WebhookDelivery', backref='webhook', lazy='dynamic', cascade="all, delete-orphan")
+    # Eventos assinados, carregados junto com os webhooks (uma consulta para todos)
+    subscriptions = db.relationship('WebhookEvent', lazy='selectin', cascade="all, delete-orphan",
+                                    order_by='WebhookEvent.event')
+
+    __table_args__ = (
+        db.Index('ix_webhook_session_active', 'session_id', 'is_active'),
+    )
+
+    # Events of webhooks created without an explicit list
+    DEFAULT_EVENTS = ['message', 'message_create', 'message_ack', 'group_join', 'group_leave']
+
+    @classmethod
+    def subscribed(cls, session_id, event):
+        """Query for the active webhooks of a session subscribed to an event"""
+        return (cls.query.join(WebhookEvent, WebhookEvent.webhook_id == cls.id)
+                .filter(cls.session_id == session_id, cls.is_active.is_(True), WebhookEvent.event == event)
+                .order_by(cls.id))
 
     def get_events(self):
-        if not self.events:
-            return []
-        return json.loads(self.events)
-    
+        return [subscription.event for subscription in self.subscriptions]
+
+    @staticmethod
+    def validate_events(events):
+        """Returns events without repeats; raises ValueError unless it is a list of event names"""
+        if not isinstance(events, list) or not all(isinstance(event, str) and event for event in events):
+            raise ValueError("events must be a list of event names")
+        max_length = WebhookEvent.event.type.length
+        for event in events:
+            if len(event) > max_length:
+                raise ValueError(f"Event name '{event[:max_length]}...' is longer than {max_length} characters")
+        return list(dict.fromkeys(events))
+
     def set_events(self, events_list):
-        self.events = json.dumps(events_list)
-    
+        # Mantém as linhas dos eventos que continuam assinados
+        wanted = dict.fromkeys(self.validate_events(events_list))
+        self.subscriptions = [subscription for subscription in self.subscriptions if subscription.event in wanted]
+        current = {subscription.event for subscription in self.subscriptions}
+        self.subscriptions.extend(WebhookEvent(event=event) for event in wanted if event not in current)
+
     def get_headers(self):
         if not self.headers:
             return {}
-        return json.loads(self.headers)
-    
+        return dict(_decode_headers(self.headers))
+
     def set_headers(self, headers_dict):
         self.headers = json.dumps(headers_dict)
 
@@ -65,3 +113,203 @@ class Webhook(db.Model):
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
+
+@lru_cache(maxsize=1024)
+def _decode_headers(text):
+    # Keyed by the stored JSON, so each version of a row's headers is decoded once
+    return json.loads(text)
+
+class WebhookEvent(db.Model):
+    """Event a webhook is subscribed to"""
+    webhook_id = db.Column(db.Integer, db.ForeignKey('webhook.id', ondelete='CASCADE'), primary_key=True)
+    event = db.Column(db.String(50), primary_key=True)
+
+    __table_args__ = (
+        db.Index('ix_webhook_event_event_webhook', 'event', 'webhook_id'),
+    )
+
+class EventPayload(db.Model):
+    """Event serialized once and shared by its deliveries to every subscribed webhook"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, nullable=False)
+    event = db.Column(db.String(50), nullable=False)
+    body = db.Column(db.Text, nullable=False)  # JSON envelope, with media_token in place of the media host
+    media_token = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class WebhookDelivery(db.Model):
+    """Outbox of webhook deliveries, drained by the webhook dispatcher"""
+    id = db.Column(db.Integer, primary_key=True)
+    webhook_id = db.Column(db.Integer, db.ForeignKey('webhook.id'), nullable=False, index=True)
+    session_id = db.Column(db.Integer, nullable=False)
+    event = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # Serialized JSON body (empty when payload_id is set)
+    # Corpo compartilhado pelas entregas de todos os webhooks do evento
+    payload_id = db.Column(db.Integer, db.ForeignKey('event_payload.id'), index=True)
+    status = db.Column(db.String(20), default="pending", nullable=False)  # pending, delivering, delivered, dead
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    locked_at = db.Column(db.DateTime)
+    last_status_code = db.Column(db.Integer)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    delivered_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_webhook_delivery_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'webhook_id': self.webhook_id,
+            'session_id': self.session_id,
+            'event': self.event,
+            'status': self.status,
+            'attempts': self.attempts,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'last_status_code': self.last_status_code,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat(),
+            'delivered_at': self.delivered_at.isoformat() if self.delivered_at else None
+        }
+
+class SendJob(db.Model):
+    """Queued outbound message, sent in the background by the send job queue"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, nullable=False, index=True)
+    message_type = db.Column(db.String(20), nullable=False)  # text, image, document, audio
+    payload = db.Column(db.Text, nullable=False)  # JSON payload for the bridge
+    status = db.Column(db.String(20), default="queued", nullable=False)  # queued, running, sent, failed
+    message_id = db.Column(db.String(255))
+    error = db.Column(db.Text)
+    status_code = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_send_job_status_id', 'status', 'id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'session_id': self.session_id,
+            'type': self.message_type,
+            'status': self.status,
+            'messageId': self.message_id,
+            'error': self.error,
+            'status_code': self.status_code,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+class BridgeNode(db.Model):
+    """Host that runs bridges; registered by the app instance running on it"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+    host = db.Column(db.String(255), nullable=False)  # Address of the bridges as seen by the other nodes
+    api_url = db.Column(db.String(255))  # Base URL of the node's API, used to start/stop its bridges remotely
+    status = db.Column(db.String(20), default="active", nullable=False)  # active, draining
+    port_min = db.Column(db.Integer, nullable=False)
+    port_max = db.Column(db.Integer, nullable=False)
+    capacity = db.Column(db.Integer, nullable=False)  # Maximum number of bridges
+    memory_limit = db.Column(db.BigInteger, nullable=False)  # Bytes available to bridges
+    running = db.Column(db.Integer, default=0, nullable=False)  # Reported with each heartbeat
+    rss_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'host': self.host,
+            'api_url': self.api_url,
+            'status': self.status,
+            'port_min': self.port_min,
+            'port_max': self.port_max,
+            'capacity': self.capacity,
+            'memory_limit': self.memory_limit,
+            'running': self.running,
+            'rss_bytes': self.rss_bytes,
+            'heartbeat_at': self.heartbeat_at.isoformat() if self.heartbeat_at else None,
+            'created_at': self.created_at.isoformat()
+        }
+
+class MediaObject(db.Model):
+    """File of the content-addressed media store, keyed by the SHA-256 of its content"""
+    hash = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    mimetype = db.Column(db.String(255))
+    ref_count = db.Column(db.Integer, default=0, nullable=False)  # MediaRef + MediaUrl rows pointing here
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_accessed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    def to_dict(self):
+        return {
+            'hash': self.hash,
+            'size': self.size,
+            'mimetype': self.mimetype,
+            'ref_count': self.ref_count,
+            'created_at': self.created_at.isoformat(),
+            'last_accessed_at': self.last_accessed_at.isoformat()
+        }
+
+class MediaRef(db.Model):
+    """Name under which a session's media is served (/api/files/session_<id>/<name>)"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(255), nullable=False)
+    media_hash = db.Column(db.String(64), db.ForeignKey('media_object.hash'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('session_id', 'name', name='uq_media_ref_session_name'),
+    )
+
+class MediaUrl(db.Model):
+    """Outbound media URL already fetched into the media store"""
+    url_hash = db.Column(db.String(64), primary_key=True)  # SHA-256 of the URL
+    url = db.Column(db.Text, nullable=False)
+    media_hash = db.Column(db.String(64), db.ForeignKey('media_object.hash'), nullable=False, index=True)
+    fetched_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class Message(db.Model):
+    """Message seen by a session's bridge (received, sent, and their acks)"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, nullable=False)
+    message_id = db.Column(db.String(255), nullable=False, index=True)  # Serialized WhatsApp ID
+    chat_id = db.Column(db.String(255), nullable=False)
+    from_id = db.Column(db.String(255))
+    to_id = db.Column(db.String(255))
+    from_me = db.Column(db.Boolean, default=False, nullable=False)
+    type = db.Column(db.String(50))
+    body = db.Column(db.Text)
+    has_media = db.Column(db.Boolean, default=False, nullable=False)
+    ack = db.Column(db.Integer, default=0, nullable=False)  # -1 error, 0 pending ... 4 played
+    timestamp = db.Column(db.BigInteger, nullable=False)  # Unix time reported by WhatsApp
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('session_id', 'message_id', name='uq_message_session_message'),
+        # Histórico por conversa com paginação por chave (timestamp, id)
+        db.Index('ix_message_session_chat_timestamp', 'session_id', 'chat_id', 'timestamp', 'id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.message_id,
+            'session_id': self.session_id,
+            'chatId': self.chat_id,
+            'from': self.from_id,
+            'to': self.to_id,
+            'fromMe': self.from_me,
+            'type': self.type,
+            'body': self.body,
+            'hasMedia': self.has_media,
+            'ack': self.ack,
+            'timestamp': self.timestamp
+        }
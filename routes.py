@@ -1,23 +1,49 @@
+import base64
+import hmac
 import json
 import logging
-import subprocess
 import os
-from flask import render_template, request, jsonify, redirect, url_for, flash
+from flask import (render_template, request, jsonify, redirect, url_for, flash, Response, abort, make_response,
+                   send_file)
+from sqlalchemy.orm import undefer
+from werkzeug.exceptions import HTTPException
+from werkzeug.security import safe_join
 from app import app, db
-from models import WhatsAppSession, Webhook
-import urllib.request
-import urllib.error
-import json
+from models import WhatsAppSession, Webhook, WebhookDelivery, SendJob
+from webhook_cache import webhook_cache
+from webhook_dispatcher import webhook_dispatcher
+from event_envelopes import normalize as normalize_event
+from send_jobs import send_job_queue
+from bridge_client import bridge_client, BridgeError, BRIDGE_TYPING_TIMEOUT
+from message_sender import (build_text_payload, build_image_payload, build_document_payload, build_audio_payload,
+                            build_upload_payload,
+                            send_payload, send_batch, BATCH_MAX_ITEMS, BATCH_CONCURRENCY)
+from send_scheduler import send_scheduler
+from session_registry import session_registry
+from session_events import session_events, qr_etag
+from status_ingest import status_ingest
+from bridge_supervisor import bridge_supervisor, bridge_launcher, BridgeStartError
+from bulk_ops import (create_sessions, update_sessions, delete_sessions, check_sessions, create_webhooks,
+                      update_webhooks, delete_webhooks, BulkError)
+from bridge_nodes import bridge_nodes, NodeError
+from media_uploads import media_uploads, is_upload_request, UploadError
+from media_store import media_store, MediaStoreError
+from media_serving import send_media
+from message_store import message_store, MESSAGE_INGEST_MAX, MESSAGE_PAGE_DEFAULT, MESSAGE_PAGE_MAX
+from db_engine import describe as describe_database
+from metrics import registry as metrics_registry, webhook_changes
+from tracing import tracer, profiler, DEBUG_TOKEN, PROFILER_DEFAULT_INTERVAL
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
-# Helper function to start the Node.js bridge
-def start_node_bridge(session_id):
+# Helper function to start (or restart) the Node.js bridge; the supervisor tracks its process and port
+def start_node_bridge(session_id, restart=False):
     try:
-        cmd = f"node whatsapp_bridge.js {session_id}"
-        process = subprocess.Popen(cmd, shell=True)
-        logger.info(f"Started WhatsApp bridge for session {session_id}, PID: {process.pid}")
+        if restart:
+            bridge_supervisor.restart(session_id)
+        else:
+            bridge_supervisor.start(session_id)
         return True
     except Exception as e:
         logger.error(f"Error starting WhatsApp bridge: {str(e)}")
@@ -33,10 +59,29 @@ def index():
 def list_sessions():
     return render_template('sessions.html')
 
+# Helper to read the ?fields= projection of the sessions API (None = all fields)
+def parse_session_fields():
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in WhatsAppSession.FIELDS]
+    if unknown:
+        abort(make_response(jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400))
+    return fields
+
+# Query for sessions that only loads the deferred QR code column when it was requested
+def session_query(fields):
+    query = WhatsAppSession.query
+    if fields is None or 'qr_code' in fields:
+        query = query.options(undefer(WhatsAppSession.qr_code))
+    return query
+
 @app.route('/api/sessions', methods=['GET'])
 def get_sessions():
-    sessions = WhatsAppSession.query.all()
-    return jsonify([session.to_dict() for session in sessions])
+    fields = parse_session_fields()
+    sessions = session_query(fields).order_by(WhatsAppSession.id).all()
+    return jsonify([session.to_dict(fields) for session in sessions])
 
 @app.route('/api/sessions', methods=['POST'])
 def create_session():
@@ -51,6 +96,8 @@ def create_session():
         )
         db.session.add(session)
         db.session.commit()
+        session_registry.update(session.id, session.status, heartbeat=False)
+        session_events.publish('session', {"id": session.id, "status": session.status, "qr_etag": None})
 
         # Start the WhatsApp bridge for this session
         start_node_bridge(session.id)
@@ -61,10 +108,41 @@ def create_session():
         logger.error(f"Error creating session: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# Stream de eventos de status das sessões (Server-Sent Events), substitui o polling do painel
+@app.route('/api/sessions/stream')
+def stream_sessions():
+    stream = session_events.subscribe(request.headers.get('Last-Event-ID'))
+    if stream is None:
+        # O painel volta ao polling quando o limite de conexões é atingido
+        return jsonify({"error": "Too many status stream subscribers"}), 503
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/sessions/<int:session_id>', methods=['GET'])
 def get_session(session_id):
-    session = WhatsAppSession.query.get_or_404(session_id)
-    return jsonify(session.to_dict())
+    fields = parse_session_fields()
+    session = session_query(fields).filter_by(id=session_id).first_or_404()
+    return jsonify(session.to_dict(fields))
+
+# QR code da sessão como imagem, com ETag para que um QR inalterado custe apenas um 304
+@app.route('/api/sessions/<int:session_id>/qr', methods=['GET'])
+def get_session_qr(session_id):
+    row = db.session.query(WhatsAppSession.qr_code).filter_by(id=session_id).first()
+    if row is None:
+        return jsonify({"error": "Session not found"}), 404
+    if not row.qr_code:
+        return jsonify({"error": "No QR code available for this session"}), 404
+
+    etag = qr_etag(row.qr_code)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        header, _, data = row.qr_code.partition(',')
+        mimetype = header[5:].split(';')[0] if header.startswith('data:') else 'image/png'
+        response = Response(base64.b64decode(data), mimetype=mimetype or 'image/png')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/api/sessions/<int:session_id>', methods=['PUT'])
 def update_session(session_id):
@@ -75,9 +153,18 @@ def update_session(session_id):
         session.name = data['name']
     if 'description' in data:
         session.description = data['description']
+    # Limites de envio da sessão (None volta aos valores padrão)
+    for field in ('send_rate', 'send_burst'):
+        if field in data:
+            value = data[field]
+            if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0):
+                return jsonify({"error": f"{field} must be a positive number"}), 400
+            setattr(session, field, value)
 
     try:
         db.session.commit()
+        send_scheduler.configure(session_id, session.send_rate, session.send_burst)
+        session_events.publish('session', {"id": session_id, "status": session.status})
         return jsonify(session.to_dict())
     except Exception as e:
         db.session.rollback()
@@ -88,13 +175,86 @@ def delete_session(session_id):
     session = WhatsAppSession.query.get_or_404(session_id)
 
     try:
+        # Encerrar o bridge (e o Chromium dele) antes de remover a sessão
+        bridge_supervisor.stop(session_id)
         db.session.delete(session)
         db.session.commit()
+        bridge_supervisor.forget(session_id)
+        media_store.release_session(session_id)
+        message_store.delete_session(session_id)
+        send_scheduler.discard(session_id)
+        session_registry.remove(session_id)
+        session_events.publish('session_deleted', {"id": session_id})
         return jsonify({"message": "Session deleted successfully"})
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+# Operações em lote: o payload inteiro é validado e gravado em uma única transação
+@app.route('/api/sessions/bulk', methods=['POST'])
+def create_sessions_bulk():
+    data = request.get_json(silent=True) or {}
+    try:
+        session_ids = create_sessions(data.get('sessions'))
+    except BulkError as e:
+        return jsonify(e.to_dict()), 400
+    except Exception as e:
+        logger.error(f"Error creating sessions in bulk: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+    sessions = session_query(None).filter(WhatsAppSession.id.in_(session_ids)).order_by(WhatsAppSession.id).all()
+    for session in sessions:
+        session_registry.update(session.id, session.status, heartbeat=False)
+        if session.send_rate is not None or session.send_burst is not None:
+            send_scheduler.configure(session.id, session.send_rate, session.send_burst)
+        session_events.publish('session', {"id": session.id, "status": session.status, "qr_etag": None})
+    # Os bridges sobem aos poucos pelo launcher (GET /api/bridges/launcher mostra o progresso)
+    queued = bridge_launcher.launch(session_ids) if data.get('start', True) else 0
+    logger.info(f"Created {len(sessions)} sessions in bulk, {queued} bridges queued")
+    return jsonify({"created": len(sessions), "bridges_queued": queued,
+                    "sessions": [session.to_dict() for session in sessions]}), 201
+
+@app.route('/api/sessions/bulk', methods=['PATCH'])
+def update_sessions_bulk():
+    data = request.get_json(silent=True) or {}
+    try:
+        session_ids = update_sessions(data.get('sessions'))
+    except BulkError as e:
+        return jsonify(e.to_dict()), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    sessions = session_query(None).filter(WhatsAppSession.id.in_(session_ids)).order_by(WhatsAppSession.id).all()
+    for session in sessions:
+        send_scheduler.configure(session.id, session.send_rate, session.send_burst)
+        session_events.publish('session', {"id": session.id, "status": session.status})
+    return jsonify({"updated": len(sessions), "sessions": [session.to_dict() for session in sessions]})
+
+@app.route('/api/sessions/bulk', methods=['DELETE'])
+def delete_sessions_bulk():
+    data = request.get_json(silent=True) or {}
+    try:
+        session_ids = check_sessions(data.get('ids'))
+        # Encerrar os bridges (e o Chromium deles) antes de remover as sessões
+        bridge_launcher.cancel(session_ids)
+        bridge_supervisor.stop_many(session_ids)
+        delete_sessions(session_ids)
+    except BulkError as e:
+        return jsonify(e.to_dict()), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+    for session_id in session_ids:
+        bridge_supervisor.forget(session_id)
+        media_store.release_session(session_id)
+        message_store.delete_session(session_id)
+        send_scheduler.discard(session_id)
+        session_registry.remove(session_id)
+        session_events.publish('session_deleted', {"id": session_id})
+    webhook_cache.invalidate(*session_ids)
+    return jsonify({"deleted": len(session_ids), "ids": session_ids})
+
 @app.route('/api/sessions/<int:session_id>/restart', methods=['POST'])
 def restart_session(session_id):
     session = WhatsAppSession.query.get_or_404(session_id)
@@ -103,13 +263,94 @@ def restart_session(session_id):
     session.status = "disconnected"
     session.qr_code = None
     db.session.commit()
+    session_registry.update(session_id, "disconnected", heartbeat=False)
+    session_events.publish('session', {"id": session_id, "status": "disconnected", "qr_etag": None})
 
-    # Start the WhatsApp bridge
-    if start_node_bridge(session_id):
+    # Restart the WhatsApp bridge (the running one, if any, is stopped first)
+    if start_node_bridge(session_id, restart=True):
         return jsonify({"message": "Session restarted successfully"})
     else:
         return jsonify({"error": "Failed to restart session"}), 500
 
+# Processos dos bridges: PID, porta, saúde, reinícios e uso de memória/CPU
+@app.route('/api/bridges', methods=['GET'])
+def get_bridges():
+    return jsonify(bridge_supervisor.stats())
+
+@app.route('/api/sessions/<int:session_id>/bridge', methods=['GET'])
+def get_session_bridge(session_id):
+    stats = bridge_supervisor.stats(session_id)
+    if not stats:
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify(stats[0])
+
+@app.route('/api/bridges/launcher', methods=['GET'])
+def get_bridge_launcher():
+    return jsonify(bridge_launcher.stats())
+
+# Nós de bridges: capacidade, carga e rebalanceamento de sessões entre nós
+@app.route('/api/nodes', methods=['GET'])
+def get_bridge_nodes():
+    return jsonify(bridge_nodes.load())
+
+@app.route('/api/nodes/<int:node_id>/drain', methods=['POST'])
+def drain_bridge_node(node_id):
+    if bridge_nodes.get(node_id) is None:
+        return jsonify({"error": "Node not found"}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        session_ids = bridge_supervisor.drain(node_id, migrate=data.get('migrate', True))
+        return jsonify({"node_id": node_id, "status": "draining", "sessions": session_ids}), 202
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/nodes/<int:node_id>/activate', methods=['POST'])
+def activate_bridge_node(node_id):
+    if bridge_nodes.get(node_id) is None:
+        return jsonify({"error": "Node not found"}), 404
+    bridge_supervisor.activate(node_id)
+    return jsonify({"node_id": node_id, "status": "active"})
+
+@app.route('/api/sessions/<int:session_id>/migrate', methods=['POST'])
+def migrate_session(session_id):
+    WhatsAppSession.query.get_or_404(session_id)
+    data = request.get_json(silent=True) or {}
+    try:
+        pid = bridge_supervisor.migrate(session_id, data.get('node_id'))
+    except NodeError as e:
+        return jsonify({"error": e.message}), e.status_code
+    except BridgeStartError as e:
+        return jsonify({"error": str(e)}), 503
+    node_id = db.session.query(WhatsAppSession.node_id).filter_by(id=session_id).scalar()
+    return jsonify({"session_id": session_id, "node_id": node_id, "pid": pid})
+
+# Usado pelos outros nós para iniciar/parar os bridges que rodam neste nó
+@app.route('/api/nodes/local/bridges/<int:session_id>/<action>', methods=['POST'])
+def control_local_bridge(session_id, action):
+    actions = {'start': bridge_supervisor.start, 'stop': bridge_supervisor.stop, 'restart': bridge_supervisor.restart}
+    if action not in actions:
+        return jsonify({"error": f"Unsupported action: {action}"}), 404
+    try:
+        pid = actions[action](session_id)
+    except NodeError as e:
+        return jsonify({"error": e.message}), e.status_code
+    except BridgeStartError as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"session_id": session_id, "action": action, "pid": pid})
+
+# Métricas do agendador de envios (profundidade da fila e tempo de espera)
+@app.route('/api/sessions/<int:session_id>/scheduler', methods=['GET'])
+def get_session_scheduler_stats(session_id):
+    stats = send_scheduler.stats(session_id)
+    if stats is None:
+        return jsonify({"error": "No sends scheduled for this session yet"}), 404
+    return jsonify(stats)
+
+@app.route('/api/scheduler/stats', methods=['GET'])
+def get_scheduler_stats():
+    return jsonify(send_scheduler.stats())
+
 # Webhook management routes
 @app.route('/webhooks')
 def list_webhooks():
@@ -126,6 +367,11 @@ def create_webhook():
     data = request.json
     if not data or not data.get('name') or not data.get('url') or not data.get('session_id'):
         return jsonify({"error": "Name, URL and session_id are required"}), 400
+    if 'events' in data:
+        try:
+            Webhook.validate_events(data['events'])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
     try:
         webhook = Webhook(
@@ -138,18 +384,73 @@ def create_webhook():
         if 'events' in data:
             webhook.set_events(data['events'])
         else:
-            webhook.set_events(['message', 'message_create', 'message_ack', 'group_join', 'group_leave'])
+            webhook.set_events(Webhook.DEFAULT_EVENTS)
 
         if 'headers' in data:
             webhook.set_headers(data['headers'])
 
         db.session.add(webhook)
         db.session.commit()
+        webhook_cache.invalidate(webhook.session_id)
+        webhook_changes.labels('create').inc()
         return jsonify(webhook.to_dict()), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/webhooks/bulk', methods=['POST'])
+def create_webhooks_bulk():
+    data = request.get_json(silent=True) or {}
+    try:
+        webhook_ids = create_webhooks(data.get('webhooks'))
+    except BulkError as e:
+        return jsonify(e.to_dict()), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    webhooks = Webhook.query.filter(Webhook.id.in_(webhook_ids)).order_by(Webhook.id).all()
+    webhook_cache.invalidate(*{webhook.session_id for webhook in webhooks})
+    webhook_changes.labels('create').inc(len(webhooks))
+    return jsonify({"created": len(webhooks), "webhooks": [webhook.to_dict() for webhook in webhooks]}), 201
+
+@app.route('/api/webhooks/bulk', methods=['PATCH'])
+def update_webhooks_bulk():
+    data = request.get_json(silent=True) or {}
+    try:
+        session_ids = update_webhooks(data.get('webhooks'))
+    except BulkError as e:
+        return jsonify(e.to_dict()), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    webhook_cache.invalidate(*session_ids)
+    webhook_ids = [item['id'] for item in data['webhooks']]
+    webhooks = Webhook.query.filter(Webhook.id.in_(webhook_ids)).order_by(Webhook.id).all()
+    webhook_changes.labels('update').inc(len(webhooks))
+    return jsonify({"updated": len(webhooks), "webhooks": [webhook.to_dict() for webhook in webhooks]})
+
+@app.route('/api/webhooks/bulk', methods=['DELETE'])
+def delete_webhooks_bulk():
+    data = request.get_json(silent=True) or {}
+    try:
+        session_ids = delete_webhooks(data.get('ids'))
+    except BulkError as e:
+        return jsonify(e.to_dict()), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    webhook_cache.invalidate(*session_ids)
+    webhook_changes.labels('delete').inc(len(data['ids']))
+    return jsonify({"deleted": len(data['ids']), "ids": data['ids']})
+
+# Lookup used by the Node.js bridge on every event: active webhooks of a session, optionally filtered by event
+@app.route('/api/sessions/<int:session_id>/webhooks', methods=['GET'])
+def get_session_webhooks(session_id):
+    body, etag = webhook_cache.lookup(session_id, request.args.get('event'))
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
 @app.route('/api/webhooks/<int:webhook_id>', methods=['GET'])
 def get_webhook(webhook_id):
     webhook = Webhook.query.get_or_404(webhook_id)
@@ -158,7 +459,13 @@ def get_webhook(webhook_id):
 @app.route('/api/webhooks/<int:webhook_id>', methods=['PUT'])
 def update_webhook(webhook_id):
     webhook = Webhook.query.get_or_404(webhook_id)
+    previous_session_id = webhook.session_id
     data = request.json
+    if 'events' in data:
+        try:
+            Webhook.validate_events(data['events'])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
     if 'name' in data:
         webhook.name = data['name']
@@ -175,6 +482,8 @@ def update_webhook(webhook_id):
 
     try:
         db.session.commit()
+        webhook_cache.invalidate(previous_session_id, webhook.session_id)
+        webhook_changes.labels('update').inc()
         return jsonify(webhook.to_dict())
     except Exception as e:
         db.session.rollback()
@@ -183,80 +492,201 @@ def update_webhook(webhook_id):
 @app.route('/api/webhooks/<int:webhook_id>', methods=['DELETE'])
 def delete_webhook(webhook_id):
     webhook = Webhook.query.get_or_404(webhook_id)
+    session_id = webhook.session_id
 
     try:
         db.session.delete(webhook)
         db.session.commit()
+        webhook_cache.invalidate(session_id)
+        webhook_changes.labels('delete').inc()
         return jsonify({"message": "Webhook deleted successfully"})
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
-# Session status callback route - used by the Node.js bridge to update session status
-@app.route('/api/sessions/<int:session_id>/status', methods=['POST'])
-def update_session_status(session_id):
-    session = WhatsAppSession.query.get_or_404(session_id)
+# Event ingestion route - the Node.js bridge posts each event once; delivery happens through the outbox
+@app.route('/api/sessions/<int:session_id>/events', methods=['POST'])
+def ingest_session_event(session_id):
     data = request.json
+    if not data or not data.get('event'):
+        return jsonify({"error": "event is required"}), 400
+
+    try:
+        queued = webhook_dispatcher.enqueue(session_id, normalize_event(session_id, data))
+        return jsonify({"queued": queued}), 202
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error queueing event: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-    if 'status' in data:
-        session.status = data['status']
-    if 'qr_code' in data:
-        session.qr_code = data['qr_code']
-    if 'session_data' in data:
-        session.session_data = data['session_data']
+# Histórico de mensagens: os bridges enviam em lotes as mensagens vistas (e novamente a cada ack)
+@app.route('/api/sessions/<int:session_id>/messages', methods=['POST'])
+def ingest_session_messages(session_id):
+    session_registry.get_or_404(session_id)
+    data = request.get_json(silent=True)
+    messages = data.get('messages') if isinstance(data, dict) else None
+    if not isinstance(messages, list):
+        return jsonify({"error": "messages must be a list"}), 400
+    if len(messages) > MESSAGE_INGEST_MAX:
+        return jsonify({"error": f"A batch accepts at most {MESSAGE_INGEST_MAX} messages"}), 400
 
     try:
-        db.session.commit()
-        return jsonify({"message": "Status updated successfully"})
+        stored, skipped = message_store.ingest(session_id, messages)
+        return jsonify({"stored": stored, "skipped": skipped})
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error storing messages: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/sessions/<int:session_id>/chats/<chat_id>/messages', methods=['GET'])
+def get_chat_messages(session_id, chat_id):
+    session_registry.get_or_404(session_id)
+    limit = request.args.get('limit', MESSAGE_PAGE_DEFAULT, type=int)
+    if limit < 1:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    try:
+        messages, next_cursor = message_store.history(session_id, chat_id, min(limit, MESSAGE_PAGE_MAX),
+                                                      request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "messages": [message.to_dict() for message in messages],
+        "next_cursor": next_cursor
+    })
+
+@app.route('/api/webhooks/deliveries/stats', methods=['GET'])
+def get_webhook_delivery_stats():
+    return jsonify(webhook_dispatcher.stats())
+
+@app.route('/api/webhooks/<int:webhook_id>/deliveries', methods=['GET'])
+def get_webhook_deliveries(webhook_id):
+    Webhook.query.get_or_404(webhook_id)
+    query = WebhookDelivery.query.filter_by(webhook_id=webhook_id)
+    if request.args.get('status'):
+        query = query.filter_by(status=request.args['status'])
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    deliveries = query.order_by(WebhookDelivery.id.desc()).limit(min(limit, 500)).all()
+    return jsonify([delivery.to_dict() for delivery in deliveries])
+
+@app.route('/api/webhooks/<int:webhook_id>/deliveries/retry', methods=['POST'])
+def retry_webhook_deliveries(webhook_id):
+    Webhook.query.get_or_404(webhook_id)
+    data = request.get_json(silent=True) or {}
+    delivery_ids = data.get('ids')
+    if delivery_ids is not None and not (
+            isinstance(delivery_ids, list)
+            and all(isinstance(item, int) and not isinstance(item, bool) for item in delivery_ids)):
+        return jsonify({"error": "ids must be a list of integers"}), 400
+
+    # Reenfileirar as entregas indicadas ou todas as entregas mortas do webhook
+    try:
+        retried = webhook_dispatcher.retry(webhook_id, delivery_ids)
+        return jsonify({"retried": retried})
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+# Session status callback route - used by the Node.js bridge to update session status
+@app.route('/api/sessions/<int:session_id>/status', methods=['POST'])
+def update_session_status(session_id):
+    session_registry.get_or_404(session_id)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "A JSON object is required"}), 400
+
+    # Agrupado com outros relatórios e gravado em lote, só se algo mudou (ver status_ingest)
+    status_ingest.submit({session_id: data})
+    return jsonify({"message": "Status update accepted"}), 202
+
+# Status de várias sessões de uma vez: {"updates": [{"id": 1, "status": "connected"}, ...]}
+@app.route('/api/sessions/status', methods=['POST'])
+def update_sessions_status():
+    data = request.get_json(silent=True)
+    updates = data.get('updates') if isinstance(data, dict) else None
+    if not isinstance(updates, list):
+        return jsonify({"error": "updates must be a list"}), 400
+
+    reports = {}
+    for item in updates:
+        if not isinstance(item, dict) or not isinstance(item.get('id'), int):
+            return jsonify({"error": "Each update needs an integer id"}), 400
+        reports.setdefault(item['id'], {}).update(item)
+    accepted = status_ingest.submit(reports)
+    return jsonify({"accepted": accepted}), 202
+
+# Helper to queue a send job and answer 202 with its ID
+def queue_send_job(session_id, message_type, req_data):
+    try:
+        job = send_job_queue.enqueue(session_id, message_type, req_data)
+        logger.info(f"Queued {message_type} send job {job.id} for session {session_id}")
+        response = jsonify({"success": True, "jobId": job.id, "status": job.status})
+        response.headers['Location'] = url_for('get_send_job', job_id=job.id)
+        return response, 202
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error queueing send job: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# Helper to read a media send: JSON with URL/base64, or the file itself (multipart or raw body)
+# streamed to the upload store. Returns (bridge payload, upload or None).
+def parse_media_request(message_type, build_payload):
+    if not is_upload_request(request):
+        try:
+            return build_payload(request.get_json(silent=True) or {}), None
+        except ValueError as e:
+            abort(make_response(jsonify({"error": str(e)}), 400))
+    try:
+        upload, fields = media_uploads.receive(request)
+    except UploadError as e:
+        abort(make_response(jsonify({"error": e.message}), e.status_code))
+    try:
+        return build_upload_payload(message_type, fields, upload), upload
+    except ValueError as e:
+        media_uploads.discard(upload.id)
+        abort(make_response(jsonify({"error": str(e)}), 400))
+
+# Arquivos enviados via upload, para bridges que não compartilham o diretório de mídia
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    path = media_uploads.path(upload_id)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return send_file(path, mimetype='application/octet-stream')
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_send_job(job_id):
+    job = SendJob.query.get_or_404(job_id)
+    return jsonify(job.to_dict())
+
 # Send message route - allows sending WhatsApp messages via API
 @app.route('/api/sessions/<int:session_id>/send-text', methods=['POST'])
 def send_text_message(session_id):
-    session = WhatsAppSession.query.get_or_404(session_id)
+    state = session_registry.get_or_404(session_id)
 
     # Verify session is connected
-    if session.status != 'connected':
+    if state.status != 'connected':
         return jsonify({"error": "WhatsApp session is not connected"}), 400
 
     # Get request data
     data = request.json
-    if not data or not data.get('chatId') or not data.get('message'):
-        return jsonify({"error": "chatId and message are required"}), 400
-
     try:
-        # Determine the port for this session's WhatsApp bridge
-        bridge_port = 3000 + session_id
+        req_data = build_text_payload(data or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
+    try:
         # Forward the request to the session's WhatsApp bridge
-        import urllib.request
-        import urllib.error
-        import json
-
-        req_data = json.dumps({
-            "chatId": data.get('chatId'),
-            "message": data.get('message')
-        }).encode('utf-8')
-
-        req = urllib.request.Request(
-            f"http://localhost:{bridge_port}/api/send-text",
-            data=req_data,
-            headers={"Content-Type": "application/json"},
-            method="POST"
-        )
-
-        try:
-            with urllib.request.urlopen(req, timeout=10) as response:
-                response_data = json.loads(response.read().decode('utf-8'))
-                logger.info(f"Message sent to {data.get('chatId')} via session {session_id}")
-                return jsonify({"success": True, "message": "Message sent successfully"})
-        except urllib.error.HTTPError as e:
-            error_message = e.read().decode('utf-8')
-            logger.error(f"Error sending message: {error_message}")
-            return jsonify({"error": f"Failed to send message: {error_message}"}), e.code
-
+        send_payload(session_id, 'text', req_data)
+        logger.info(f"Message sent to {data.get('chatId')} via session {session_id}")
+        return jsonify({"success": True, "message": "Message sent successfully"})
+    except BridgeError as e:
+        logger.error(f"Error sending message: {e.message}")
+        return jsonify({"error": f"Failed to send message: {e.message}"}), e.status_code
     except Exception as e:
         logger.error(f"Error sending message: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -264,10 +694,10 @@ def send_text_message(session_id):
 # Marcar mensagem como vista (seen)
 @app.route('/api/sessions/<int:session_id>/seen', methods=['POST'])
 def mark_chat_as_seen(session_id):
-    session = WhatsAppSession.query.get_or_404(session_id)
+    state = session_registry.get_or_404(session_id)
 
     # Verificar se a sessão está conectada
-    if session.status != 'connected':
+    if state.status != 'connected':
         return jsonify({"error": "WhatsApp session is not connected"}), 400
 
     # Obter dados da requisição
@@ -276,44 +706,24 @@ def mark_chat_as_seen(session_id):
         return jsonify({"error": "chatId is required"}), 400
 
     try:
-        # Determinar a porta para o bridge do WhatsApp dessa sessão
-        bridge_port = 3000 + session_id
-
         # Encaminhar a requisição para o bridge do WhatsApp
-        import urllib.request
-        import urllib.error
-        import json
-
-        req_data = json.dumps({
+        bridge_client.post(session_id, '/api/seen', {
             "chatId": data.get('chatId')
-        }).encode('utf-8')
-
-        req = urllib.request.Request(
-            f"http://localhost:{bridge_port}/api/seen",
-            data=req_data,
-            headers={"Content-Type": "application/json"},
-            method="POST"
-        )
-
-        try:
-            with urllib.request.urlopen(req, timeout=10) as response:
-                response_data = json.loads(response.read().decode('utf-8'))
-                logger.info(f"Chat {data.get('chatId')} marked as seen via session {session_id}")
-                return jsonify({"success": True, "message": "Chat marked as seen"})
-        except urllib.error.HTTPError as e:
-            error_message = e.read().decode('utf-8')
-            logger.error(f"Error marking chat as seen: {error_message}")
-            return jsonify({"error": f"Failed to mark chat as seen: {error_message}"}), e.code
-
+        })
+        logger.info(f"Chat {data.get('chatId')} marked as seen via session {session_id}")
+        return jsonify({"success": True, "message": "Chat marked as seen"})
+    except BridgeError as e:
+        logger.error(f"Error marking chat as seen: {e.message}")
+        return jsonify({"error": f"Failed to mark chat as seen: {e.message}"}), e.status_code
     except Exception as e:
         logger.error(f"Error marking chat as seen: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/sessions/<int:session_id>/typing', methods=['POST'])
 def start_typing(session_id):
-    session = WhatsAppSession.query.get_or_404(session_id)
+    state = session_registry.get_or_404(session_id)
     # Verificar se a sessão está conectada
-    if session.status != 'connected':
+    if state.status != 'connected':
         return jsonify({"error": "WhatsApp session is not connected"}), 400
     # Obter dados da requisição
     data = request.json
@@ -322,232 +732,131 @@ def start_typing(session_id):
     # Obter duração opcional da digitação (padrão: 3000ms)
     duration = data.get('duration', 3000)
     try:
-        # Determinar a porta para o bridge do WhatsApp dessa sessão
-        bridge_port = 3000 + session_id
         # Encaminhar a requisição para o bridge do WhatsApp
-        import urllib.request
-        import urllib.error
-        import json
-        req_data = json.dumps({
+        bridge_client.post(session_id, '/api/typing', {
             "chatId": data.get('chatId'),
             "duration": duration
-        }).encode('utf-8')
-        req = urllib.request.Request(
-            f"http://localhost:{bridge_port}/api/typing",
-            data=req_data,
-            headers={"Content-Type": "application/json"},
-            method="POST"
-        )
-        try:
-            with urllib.request.urlopen(req, timeout=30) as response:
-                response_data = json.loads(response.read().decode('utf-8'))
-                logger.info(f"Started typing in chat {data.get('chatId')} via session {session_id} for {duration}ms")
-                return jsonify({"success": True, "message": f"Started typing for {duration}ms"})
-        except urllib.error.HTTPError as e:
-            error_message = e.read().decode('utf-8')
-            logger.error(f"Error starting typing: {error_message}")
-            return jsonify({"error": f"Failed to start typing: {error_message}"}), e.code
+        }, timeout=BRIDGE_TYPING_TIMEOUT)
+        logger.info(f"Started typing in chat {data.get('chatId')} via session {session_id} for {duration}ms")
+        return jsonify({"success": True, "message": f"Started typing for {duration}ms"})
+    except BridgeError as e:
+        logger.error(f"Error starting typing: {e.message}")
+        return jsonify({"error": f"Failed to start typing: {e.message}"}), e.status_code
     except Exception as e:
         logger.error(f"Error starting typing: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/sessions/<int:session_id>/send-image', methods=['POST'])
 def send_image_message(session_id):
-    session = WhatsAppSession.query.get_or_404(session_id)
+    state = session_registry.get_or_404(session_id)
     # Verificar se a sessão está conectada
-    if session.status != 'connected':
+    if state.status != 'connected':
         return jsonify({"error": "WhatsApp session is not connected"}), 400
-    # Obter dados da requisição
-    data = request.json
-    if not data or not data.get('chatId'):
-        return jsonify({"error": "chatId is required"}), 400
-    # Verificar se há URL da imagem ou arquivo
-    if not data.get('imageUrl') and not data.get('imageBase64'):
-        return jsonify({"error": "imageUrl or imageBase64 is required"}), 400
-    try:
-        # Determinar a porta para o bridge do WhatsApp dessa sessão
-        bridge_port = 3000 + session_id
-        # Preparar dados para a requisição
-        req_data = {
-            "chatId": data.get('chatId'),
-            "caption": data.get('caption', '')  # Legenda opcional
-        }
-        # Adicionar a URL da imagem ou base64, dependendo do que foi fornecido
-        if data.get('imageUrl'):
-            req_data["imageUrl"] = data.get('imageUrl')
-        else:
-            req_data["imageBase64"] = data.get('imageBase64')
+    # Obter dados da requisição (JSON ou upload do arquivo)
+    req_data, upload = parse_media_request('image', build_image_payload)
+    # Modo assíncrono: enfileirar o envio e responder imediatamente com o ID do job
+    if request.args.get('async') == '1':
+        return queue_send_job(session_id, 'image', req_data)
+    try:
         # Encaminhar a requisição para o bridge do WhatsApp
-        import urllib.request
-        import urllib.error
-        import json
-        import os
-        # Usar o endereço interno baseado no ambiente Docker ou usar localhost como fallback
-        api_host = os.environ.get('API_HOST', 'localhost')
-
-        # Se estamos rodando no Docker e API_HOST é definido como 'web', use 127.0.0.1 para chamadas entre processos
-        # Este é um caso especial para chamadas dentro do mesmo contêiner
-        host_address = '127.0.0.1' if api_host == 'web' else api_host
-
-        logger.info(f"Connecting to WhatsApp bridge at http://{host_address}:{bridge_port}/api/send-image")
-
-        req = urllib.request.Request(
-            f"http://{host_address}:{bridge_port}/api/send-image",
-            data=json.dumps(req_data).encode('utf-8'),
-            headers={"Content-Type": "application/json"},
-            method="POST"
-        )
-        try:
-            # Aumentar timeout para 120 segundos
-            with urllib.request.urlopen(req, timeout=180) as response:
-                response_data = json.loads(response.read().decode('utf-8'))
-                logger.info(f"Image sent to {data.get('chatId')} via session {session_id}")
-                return jsonify({"success": True, "message": "Image sent successfully", "messageId": response_data.get('messageId')})
-        except urllib.error.HTTPError as e:
-            error_message = e.read().decode('utf-8')
-            logger.error(f"Error sending image: {error_message}")
-            return jsonify({"error": f"Failed to send image: {error_message}"}), e.code
-        except urllib.error.URLError as e:
-            logger.error(f"Connection error: {str(e)}")
-            return jsonify({"error": f"Connection error: {str(e)}"}), 500
-        except TimeoutError:
-            logger.error("Request timed out")
-            return jsonify({"error": "Request timed out after 3 minutes. The image might still be processing."}), 504
+        response_data = send_payload(session_id, 'image', req_data)
+        logger.info(f"Image sent to {req_data['chatId']} via session {session_id}")
+        return jsonify({"success": True, "message": "Image sent successfully", "messageId": response_data.get('messageId')})
+    except BridgeError as e:
+        logger.error(f"Error sending image: {e.message}")
+        return jsonify({"error": f"Failed to send image: {e.message}"}), e.status_code
     except Exception as e:
         logger.error(f"Error sending image: {str(e)}")
         return jsonify({"error": str(e)}), 500
+    finally:
+        if upload is not None:
+            media_uploads.discard(upload.id)
 
 @app.route('/api/sessions/<int:session_id>/send-document', methods=['POST'])
 def send_document_message(session_id):
-    session = WhatsAppSession.query.get_or_404(session_id)
+    state = session_registry.get_or_404(session_id)
     # Verificar se a sessão está conectada
-    if session.status != 'connected':
+    if state.status != 'connected':
         return jsonify({"error": "WhatsApp session is not connected"}), 400
-    # Obter dados da requisição
-    data = request.json
-    if not data or not data.get('chatId'):
-        return jsonify({"error": "chatId is required"}), 400
-    # Verificar se há URL do documento ou arquivo base64
-    if not data.get('documentUrl') and not data.get('documentBase64'):
-        return jsonify({"error": "documentUrl or documentBase64 is required"}), 400
-    try:
-        # Determinar a porta para o bridge do WhatsApp dessa sessão
-        bridge_port = 3000 + session_id
-        # Preparar dados para a requisição
-        req_data = {
-            "chatId": data.get('chatId'),
-            "caption": data.get('caption', ''),  # Legenda opcional
-            "filename": data.get('filename', '')  # Nome do arquivo opcional
-        }
-        # Adicionar a URL do documento ou base64, dependendo do que foi fornecido
-        if data.get('documentUrl'):
-            req_data["documentUrl"] = data.get('documentUrl')
-        else:
-            req_data["documentBase64"] = data.get('documentBase64')
+    # Obter dados da requisição (JSON ou upload do arquivo)
+    req_data, upload = parse_media_request('document', build_document_payload)
+    # Modo assíncrono: enfileirar o envio e responder imediatamente com o ID do job
+    if request.args.get('async') == '1':
+        return queue_send_job(session_id, 'document', req_data)
+    try:
         # Encaminhar a requisição para o bridge do WhatsApp
-        import urllib.request
-        import urllib.error
-        import json
-        import os
-        # Usar o endereço interno baseado no ambiente Docker ou usar localhost como fallback
-        api_host = os.environ.get('API_HOST', 'localhost')
-
-        # Se estamos rodando no Docker e API_HOST é definido como 'web', use 127.0.0.1 para chamadas entre processos
-        host_address = '127.0.0.1' if api_host == 'web' else api_host
-
-        logger.info(f"Connecting to WhatsApp bridge at http://{host_address}:{bridge_port}/api/send-document")
-
-        req = urllib.request.Request(
-            f"http://{host_address}:{bridge_port}/api/send-document",
-            data=json.dumps(req_data).encode('utf-8'),
-            headers={"Content-Type": "application/json"},
-            method="POST"
-        )
-        try:
-            # Aumentar timeout para 180 segundos
-            with urllib.request.urlopen(req, timeout=180) as response:
-                response_data = json.loads(response.read().decode('utf-8'))
-                logger.info(f"Document sent to {data.get('chatId')} via session {session_id}")
-                return jsonify({"success": True, "message": "Document sent successfully", "messageId": response_data.get('messageId')})
-        except urllib.error.HTTPError as e:
-            error_message = e.read().decode('utf-8')
-            logger.error(f"Error sending document: {error_message}")
-            return jsonify({"error": f"Failed to send document: {error_message}"}), e.code
-        except urllib.error.URLError as e:
-            logger.error(f"Connection error: {str(e)}")
-            return jsonify({"error": f"Connection error: {str(e)}"}), 500
-        except TimeoutError:
-            logger.error("Request timed out")
-            return jsonify({"error": "Request timed out after 3 minutes. The document might still be processing."}), 504
+        response_data = send_payload(session_id, 'document', req_data)
+        logger.info(f"Document sent to {req_data['chatId']} via session {session_id}")
+        return jsonify({"success": True, "message": "Document sent successfully", "messageId": response_data.get('messageId')})
+    except BridgeError as e:
+        logger.error(f"Error sending document: {e.message}")
+        return jsonify({"error": f"Failed to send document: {e.message}"}), e.status_code
     except Exception as e:
         logger.error(f"Error sending document: {str(e)}")
         return jsonify({"error": str(e)}), 500
+    finally:
+        if upload is not None:
+            media_uploads.discard(upload.id)
 
 @app.route('/api/sessions/<int:session_id>/send-audio', methods=['POST'])
 def send_audio_message(session_id):
-    session = WhatsAppSession.query.get_or_404(session_id)
+    state = session_registry.get_or_404(session_id)
     # Verificar se a sessão está conectada
-    if session.status != 'connected':
+    if state.status != 'connected':
         return jsonify({"error": "WhatsApp session is not connected"}), 400
-    # Obter dados da requisição
-    data = request.json
-    if not data or not data.get('chatId'):
-        return jsonify({"error": "chatId is required"}), 400
-    # Verificar se há URL do áudio ou arquivo base64
-    if not data.get('audioUrl') and not data.get('audioBase64'):
-        return jsonify({"error": "audioUrl or audioBase64 is required"}), 400
-    try:
-        # Determinar a porta para o bridge do WhatsApp dessa sessão
-        bridge_port = 3000 + session_id
-        # Preparar dados para a requisição
-        req_data = {
-            "chatId": data.get('chatId'),
-            "filename": data.get('filename', ''),  # Nome do arquivo opcional
-            "asVoiceMessage": data.get('asVoiceMessage', True)  # Se deve enviar como mensagem de voz
-        }
-        # Adicionar a URL do áudio ou base64, dependendo do que foi fornecido
-        if data.get('audioUrl'):
-            req_data["audioUrl"] = data.get('audioUrl')
-        else:
-            req_data["audioBase64"] = data.get('audioBase64')
+    # Obter dados da requisição (JSON ou upload do arquivo)
+    req_data, upload = parse_media_request('audio', build_audio_payload)
+    # Modo assíncrono: enfileirar o envio e responder imediatamente com o ID do job
+    if request.args.get('async') == '1':
+        return queue_send_job(session_id, 'audio', req_data)
+    try:
         # Encaminhar a requisição para o bridge do WhatsApp
-        import urllib.request
-        import urllib.error
-        import json
-        import os
-        # Usar o endereço interno baseado no ambiente Docker ou usar localhost como fallback
-        api_host = os.environ.get('API_HOST', 'localhost')
-
-        # Se estamos rodando no Docker e API_HOST é definido como 'web', use 127.0.0.1 para chamadas entre processos
-        host_address = '127.0.0.1' if api_host == 'web' else api_host
-
-        logger.info(f"Connecting to WhatsApp bridge at http://{host_address}:{bridge_port}/api/send-audio")
-
-        req = urllib.request.Request(
-            f"http://{host_address}:{bridge_port}/api/send-audio",
-            data=json.dumps(req_data).encode('utf-8'),
-            headers={"Content-Type": "application/json"},
-            method="POST"
-        )
-        try:
-            # Aumentar timeout para 180 segundos
-            with urllib.request.urlopen(req, timeout=180) as response:
-                response_data = json.loads(response.read().decode('utf-8'))
-                logger.info(f"Audio sent to {data.get('chatId')} via session {session_id}")
-                return jsonify({"success": True, "message": "Audio sent successfully", "messageId": response_data.get('messageId')})
-        except urllib.error.HTTPError as e:
-            error_message = e.read().decode('utf-8')
-            logger.error(f"Error sending audio: {error_message}")
-            return jsonify({"error": f"Failed to send audio: {error_message}"}), e.code
-        except urllib.error.URLError as e:
-            logger.error(f"Connection error: {str(e)}")
-            return jsonify({"error": f"Connection error: {str(e)}"}), 500
-        except TimeoutError:
-            logger.error("Request timed out")
-            return jsonify({"error": "Request timed out after 3 minutes. The audio might still be processing."}), 504
+        response_data = send_payload(session_id, 'audio', req_data)
+        logger.info(f"Audio sent to {req_data['chatId']} via session {session_id}")
+        return jsonify({"success": True, "message": "Audio sent successfully", "messageId": response_data.get('messageId')})
+    except BridgeError as e:
+        logger.error(f"Error sending audio: {e.message}")
+        return jsonify({"error": f"Failed to send audio: {e.message}"}), e.status_code
     except Exception as e:
         logger.error(f"Error sending audio: {str(e)}")
         return jsonify({"error": str(e)}), 500
+    finally:
+        if upload is not None:
+            media_uploads.discard(upload.id)
+
+# Envio em lote - várias mensagens em uma única chamada, com resultado por item
+@app.route('/api/sessions/<int:session_id>/send-batch', methods=['POST'])
+def send_batch_messages(session_id):
+    state = session_registry.get_or_404(session_id)
+    # Verificar se a sessão está conectada (uma única vez para todo o lote)
+    if state.status != 'connected':
+        return jsonify({"error": "WhatsApp session is not connected"}), 400
+    # Obter dados da requisição
+    data = request.json
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items must be a non-empty list"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"A batch accepts at most {BATCH_MAX_ITEMS} items"}), 400
+    concurrency = data.get('concurrency', BATCH_CONCURRENCY)
+    if not isinstance(concurrency, int) or concurrency < 1:
+        return jsonify({"error": "concurrency must be a positive integer"}), 400
+
+    logger.info(f"Sending batch of {len(items)} messages via session {session_id}")
+    # Obtido aqui: no modo streaming o gerador roda depois que a requisição terminou
+    trace = tracer.current()
+
+    # Modo streaming: um resultado NDJSON por item, na ordem em que terminam
+    if request.args.get('stream') == '1':
+        def generate():
+            for result in send_batch(session_id, items, concurrency, trace=trace):
+                yield json.dumps(result) + "\n"
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    results = sorted(send_batch(session_id, items, concurrency, trace=trace), key=lambda result: result['index'])
+    sent = sum(1 for result in results if result['success'])
+    logger.info(f"Batch via session {session_id} finished: {sent} sent, {len(results) - sent} failed")
+    return jsonify({"total": len(results), "sent": sent, "failed": len(results) - sent, "results": results})
 
 # Endpoint de teste para listar rotas
 @app.route('/api/debug/routes')
@@ -561,31 +870,161 @@ def list_routes():
         })
     return jsonify(routes)
 
+# Métricas no formato de texto do Prometheus
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics_registry.render(), mimetype=metrics_registry.CONTENT_TYPE)
+
+# Helper to protect the /api/debug endpoints (disabled while DEBUG_TOKEN is not set)
+def require_debug_token():
+    if not DEBUG_TOKEN:
+        abort(make_response(jsonify({"error": "Debug endpoints are disabled (set DEBUG_TOKEN)"}), 404))
+    if not hmac.compare_digest(request.headers.get('X-Debug-Token', ''), DEBUG_TOKEN):
+        abort(make_response(jsonify({"error": "Invalid debug token"}), 403))
+
+# Perfil efetivo do banco (pragmas do SQLite ou timeouts do PostgreSQL) e uso do pool
+@app.route('/api/debug/database')
+def database_profile():
+    require_debug_token()
+    try:
+        return jsonify(describe_database(db.engine))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Rastreamento: últimas requisições com o tempo de cada fase (?limit=, ?min_ms=, ?endpoint=)
+@app.route('/api/debug/traces', methods=['GET'])
+def list_traces():
+    require_debug_token()
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        min_ms = float(request.args.get('min_ms', 0))
+    except ValueError:
+        return jsonify({"error": "limit and min_ms must be numbers"}), 400
+    return jsonify({
+        "enabled": tracer.enabled,
+        "sample_rate": tracer.sample_rate,
+        "traces": tracer.traces(limit, min_ms, request.args.get('endpoint'))
+    })
+
+@app.route('/api/debug/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    require_debug_token()
+    trace = tracer.get(trace_id)
+    if trace is None:
+        return jsonify({"error": "Trace not found"}), 404
+    return jsonify(trace)
+
+# Ligar/desligar o rastreamento sem reiniciar: {"enabled": true, "sample_rate": 0.1}
+@app.route('/api/debug/traces', methods=['PUT'])
+def configure_traces():
+    require_debug_token()
+    data = request.get_json(silent=True) or {}
+    if 'enabled' in data:
+        tracer.enabled = bool(data['enabled'])
+    if 'sample_rate' in data:
+        try:
+            tracer.sample_rate = min(max(float(data['sample_rate']), 0.0), 1.0)
+        except (TypeError, ValueError):
+            return jsonify({"error": "sample_rate must be a number"}), 400
+    return jsonify({"enabled": tracer.enabled, "sample_rate": tracer.sample_rate})
+
+@app.route('/api/debug/traces', methods=['DELETE'])
+def clear_traces():
+    require_debug_token()
+    tracer.clear()
+    return jsonify({"message": "Traces cleared"})
+
+# Profiler por amostragem: POST inicia por ?seconds=, GET devolve as pilhas (folded) e DELETE interrompe
+@app.route('/api/debug/profile', methods=['POST'])
+def start_profiler():
+    require_debug_token()
+    try:
+        seconds = float(request.args.get('seconds', 30))
+        interval = float(request.args.get('interval', PROFILER_DEFAULT_INTERVAL))
+    except ValueError:
+        return jsonify({"error": "seconds and interval must be numbers"}), 400
+    if seconds <= 0:
+        return jsonify({"error": "seconds must be positive"}), 400
+    if not profiler.start(seconds, interval, idle=request.args.get('idle') == '1'):
+        return jsonify({"error": "The profiler is already running"}), 409
+    return jsonify(profiler.status()), 202
+
+@app.route('/api/debug/profile', methods=['GET'])
+def get_profile():
+    require_debug_token()
+    if request.args.get('format') == 'json':
+        return jsonify(profiler.status())
+    response = Response(profiler.folded(), mimetype='text/plain')
+    response.headers['X-Profile-Running'] = '1' if profiler.running else '0'
+    response.headers['X-Profile-Samples'] = str(profiler.samples)
+    return response
+
+@app.route('/api/debug/profile', methods=['DELETE'])
+def stop_profiler():
+    require_debug_token()
+    profiler.stop()
+    return Response(profiler.folded(), mimetype='text/plain')
+
+# Helper to read the session ID of a media directory name (session_1 -> 1)
+def media_session_id(session_name):
+    try:
+        session_id = int(session_name.split('_')[-1])
+    except ValueError:
+        abort(make_response(jsonify({"error": "Session not found"}), 404))
+    # Verificar se a sessão existe (registro em memória, sem consulta ao banco a cada arquivo)
+    if session_registry.get(session_id) is None:
+        abort(make_response(jsonify({"error": "Session not found"}), 404))
+    return session_id
+
 # Rota para servir arquivos de mídia
 @app.route('/api/files/<session_name>/<filename>')
 def serve_media_file(session_name, filename):
-    import os
-    from flask import send_from_directory
-
-    # Extrair o ID da sessão do nome da sessão (session_1 -> 1)
     try:
-        session_id = session_name.split('_')[-1]
-
-        # Verificar se a sessão existe
-        session = WhatsAppSession.query.get(session_id)
-        if not session:
-            return jsonify({"error": "Session not found"}), 404
+        session_id = media_session_id(session_name)
 
-        # Caminho para o diretório de mídia
-        media_dir = os.path.join('/app/media', session_name)
+        # Mídia indexada no armazenamento por conteúdo (ver media_store)
+        stored = media_store.lookup(session_id, filename)
+        if stored is not None:
+            media_hash, path, mimetype = stored
+            return send_media(path, mimetype, etag=media_hash, download_name=filename)
 
-        # Verificar se o diretório existe
-        if not os.path.exists(media_dir):
-            os.makedirs(media_dir, exist_ok=True)
+        # Arquivos gravados pelos bridges antes do armazenamento por conteúdo
+        path = safe_join('/app/media', session_name, filename)
+        if path is None or not os.path.isfile(path):
             return jsonify({"error": "File not found"}), 404
-
-        # Enviar o arquivo
-        return send_from_directory(media_dir, filename)
+        return send_media(path)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error serving media file: {str(e)}")
         return jsonify({"error": str(e)}), 500
+
+# Mídia recebida pelos bridges: gravada uma vez por conteúdo e servida pela rota acima
+@app.route('/api/files/<session_name>/<filename>', methods=['PUT'])
+def store_media_file(session_name, filename):
+    session_id = media_session_id(session_name)
+    try:
+        media_hash = media_store.index(session_id, filename, request.stream, request.mimetype or None)
+        return jsonify({
+            "url": url_for('serve_media_file', session_name=session_name, filename=filename),
+            "hash": media_hash
+        }), 201
+    except MediaStoreError as e:
+        return jsonify({"error": e.message}), e.status_code
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error storing media file: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# Objetos do armazenamento de mídia, para bridges que não compartilham o diretório
+@app.route('/api/media/<media_hash>', methods=['GET'])
+def get_media_object(media_hash):
+    stored = media_store.open_object(media_hash)
+    if stored is None:
+        abort(404)
+    path, mimetype = stored
+    return send_media(path, mimetype or 'application/octet-stream', etag=media_hash, immutable=True)
+
+@app.route('/api/media', methods=['GET'])
+def get_media_stats():
+    return jsonify(media_store.stats())
@@ -0,0 +1,339 @@
+"""
+Schema migrations.
+
+The database records the migrations already applied in the schema_version table.
+Serving processes only compare that version with the latest one (one query at
+startup); the migrations themselves run once per deploy, before the server starts:
+
+    python3 -m schema upgrade      # apply the pending migrations
+    python3 -m schema current      # print the version of the database
+
+Migration 1 creates the version 1 schema, frozen below as Core tables (SCHEMA_V1),
+and adds the columns and indexes of it that existing databases lack (databases
+created before schema_version start at 0, so it also brings them up to date). The
+steps never read the models, which keep changing: a change to the models adds a
+migration at the end of MIGRATIONS with its own DDL (add_missing_columns and
+add_missing_indexes take a MetaData describing the new columns and indexes), and
+data moved to new tables gets its own step.
+"""
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+from sqlalchemy import (BigInteger, Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, MetaData, String,
+                        Table, Text, UniqueConstraint, func, inspect, insert, select, text, update)
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# Apply pending migrations when a process starts (development); with 0 a database that
+# is behind stops the startup and `python3 -m schema upgrade` must run first
+SCHEMA_AUTO_MIGRATE = os.environ.get('SCHEMA_AUTO_MIGRATE', '1') == '1'
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+# Schema version 1, as created by migration 1. Frozen: never edit it to follow the models
+SCHEMA_V1 = MetaData()
+
+Table(
+    'bridge_node', SCHEMA_V1,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False, unique=True),
+    Column('host', String(255), nullable=False),
+    Column('api_url', String(255)),
+    Column('status', String(20), nullable=False),
+    Column('port_min', Integer, nullable=False),
+    Column('port_max', Integer, nullable=False),
+    Column('capacity', Integer, nullable=False),
+    Column('memory_limit', BigInteger, nullable=False),
+    Column('running', Integer, nullable=False),
+    Column('rss_bytes', BigInteger, nullable=False),
+    Column('heartbeat_at', DateTime),
+    Column('created_at', DateTime),
+)
+Table(
+    'whats_app_session', SCHEMA_V1,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False, unique=True),
+    Column('description', String(255)),
+    Column('status', String(50)),
+    Column('qr_code', Text),
+    Column('session_data', Text),
+    Column('send_rate', Float),
+    Column('send_burst', Integer),
+    Column('bridge_pid', Integer),
+    Column('bridge_port', Integer),
+    Column('bridge_started_at', DateTime),
+    Column('node_id', Integer, ForeignKey('bridge_node.id'), index=True),
+    Column('created_at', DateTime),
+    Column('updated_at', DateTime),
+)
+Table(
+    'webhook', SCHEMA_V1,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('url', String(255), nullable=False),
+    Column('session_id', Integer, ForeignKey('whats_app_session.id'), nullable=False),
+    Column('events', Text),
+    Column('headers', Text),
+    Column('is_active', Boolean),
+    Column('created_at', DateTime),
+    Column('updated_at', DateTime),
+    Index('ix_webhook_session_active', 'session_id', 'is_active'),
+)
+Table(
+    'webhook_event', SCHEMA_V1,
+    Column('webhook_id', Integer, ForeignKey('webhook.id', ondelete='CASCADE'), primary_key=True),
+    Column('event', String(50), primary_key=True),
+    Index('ix_webhook_event_event_webhook', 'event', 'webhook_id'),
+)
+Table(
+    'event_payload', SCHEMA_V1,
+    Column('id', Integer, primary_key=True),
+    Column('session_id', Integer, nullable=False),
+    Column('event', String(50), nullable=False),
+    Column('body', Text, nullable=False),
+    Column('media_token', String(64)),
+    Column('created_at', DateTime, index=True),
+)
+Table(
+    'webhook_delivery', SCHEMA_V1,
+    Column('id', Integer, primary_key=True),
+    Column('webhook_id', Integer, ForeignKey('webhook.id'), nullable=False, index=True),
+    Column('session_id', Integer, nullable=False),
+    Column('event', String(50), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('payload_id', Integer, ForeignKey('event_payload.id'), index=True),
+    Column('status', String(20), nullable=False),
+    Column('attempts', Integer, nullable=False),
+    Column('next_attempt_at', DateTime, nullable=False),
+    Column('locked_at', DateTime),
+    Column('last_status_code', Integer),
+    Column('last_error', Text),
+    Column('created_at', DateTime),
+    Column('delivered_at', DateTime),
+    Index('ix_webhook_delivery_status_next_attempt', 'status', 'next_attempt_at'),
+)
+Table(
+    'send_job', SCHEMA_V1,
+    Column('id', Integer, primary_key=True),
+    Column('session_id', Integer, nullable=False, index=True),
+    Column('message_type', String(20), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('status', String(20), nullable=False),
+    Column('message_id', String(255)),
+    Column('error', Text),
+    Column('status_code', Integer),
+    Column('created_at', DateTime),
+    Column('started_at', DateTime),
+    Column('finished_at', DateTime),
+    Index('ix_send_job_status_id', 'status', 'id'),
+)
+Table(
+    'media_object', SCHEMA_V1,
+    Column('hash', String(64), primary_key=True),
+    Column('size', BigInteger, nullable=False),
+    Column('mimetype', String(255)),
+    Column('ref_count', Integer, nullable=False),
+    Column('created_at', DateTime),
+    Column('last_accessed_at', DateTime, nullable=False, index=True),
+)
+Table(
+    'media_ref', SCHEMA_V1,
+    Column('id', Integer, primary_key=True),
+    Column('session_id', Integer, nullable=False),
+    Column('name', String(255), nullable=False),
+    Column('media_hash', String(64), ForeignKey('media_object.hash'), nullable=False, index=True),
+    Column('created_at', DateTime),
+    UniqueConstraint('session_id', 'name', name='uq_media_ref_session_name'),
+)
+Table(
+    'media_url', SCHEMA_V1,
+    Column('url_hash', String(64), primary_key=True),
+    Column('url', Text, nullable=False),
+    Column('media_hash', String(64), ForeignKey('media_object.hash'), nullable=False, index=True),
+    Column('fetched_at', DateTime, nullable=False),
+)
+Table(
+    'message', SCHEMA_V1,
+    Column('id', Integer, primary_key=True),
+    Column('session_id', Integer, nullable=False),
+    Column('message_id', String(255), nullable=False, index=True),
+    Column('chat_id', String(255), nullable=False),
+    Column('from_id', String(255)),
+    Column('to_id', String(255)),
+    Column('from_me', Boolean, nullable=False),
+    Column('type', String(50)),
+    Column('body', Text),
+    Column('has_media', Boolean, nullable=False),
+    Column('ack', Integer, nullable=False),
+    Column('timestamp', BigInteger, nullable=False),
+    Column('created_at', DateTime),
+    UniqueConstraint('session_id', 'message_id', name='uq_message_session_message'),
+    Index('ix_message_session_chat_timestamp', 'session_id', 'chat_id', 'timestamp', 'id'),
+)
+
+
+class SchemaOutdated(RuntimeError):
+    """The database is behind the code and SCHEMA_AUTO_MIGRATE is off"""
+
+
+def add_missing_columns(db, metadata):
+    """Adds the nullable columns of metadata that the existing tables lack"""
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            logger.info(f"Adding column {table.name}.{column.name} ({column_type})")
+            with db.engine.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+
+def add_missing_indexes(db, metadata):
+    """Creates the indexes of metadata that the existing tables lack"""
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            logger.info(f"Creating index {index.name} on {table.name}")
+            index.create(db.engine, checkfirst=True)
+
+
+def migrate_webhook_events(db):
+    """Moves the JSON event lists of Webhook.events into the webhook_event table
+
+    Migrated rows get events = NULL, so this runs once per webhook and is a single
+    cheap query afterwards.
+    """
+    webhook_table = SCHEMA_V1.tables['webhook']
+    with db.engine.connect() as connection:
+        legacy = connection.execute(
+            select(webhook_table.c.id, webhook_table.c.events).where(webhook_table.c.events.isnot(None))
+        ).all()
+    if not legacy:
+        return
+
+    rows = []
+    for webhook_id, events in legacy:
+        try:
+            names = json.loads(events) or []
+        except ValueError:
+            logger.warning(f"Webhook {webhook_id} has invalid events JSON, leaving it without subscriptions")
+            names = []
+        for name in dict.fromkeys(name for name in names if isinstance(name, str) and name):
+            rows.append({'webhook_id': webhook_id, 'event': name})
+
+    try:
+        with db.engine.begin() as connection:
+            if rows:
+                connection.execute(insert(SCHEMA_V1.tables['webhook_event']), rows)
+            connection.execute(
+                update(webhook_table)
+                .where(webhook_table.c.id.in_([webhook_id for webhook_id, _ in legacy]))
+                .values(events=None)
+            )
+    except IntegrityError:
+        # Outro processo migrou ao mesmo tempo
+        logger.info("Webhook events already migrated by another process")
+        return
+    logger.info(f"Migrated {len(rows)} event subscriptions of {len(legacy)} webhooks to webhook_event")
+
+
+def create_tables(db):
+    """Tables of schema version 1, plus the columns and indexes of it that existing tables lack"""
+    SCHEMA_V1.create_all(db.engine)
+    add_missing_columns(db, SCHEMA_V1)
+    add_missing_indexes(db, SCHEMA_V1)
+
+
+# (version, description, step); versions only grow, and a released step (with the
+# tables it uses) is never edited: later changes to the models get a new step
+MIGRATIONS = [
+    (1, "Tables, columns and indexes of the models", create_tables),
+    (2, "Webhook event subscriptions moved to webhook_event", migrate_webhook_events),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(engine):
+    """Latest migration applied to the database (0 before the first one)"""
+    with engine.connect() as connection:
+        if not inspect(connection).has_table(schema_version.name):
+            return 0
+        return connection.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def upgrade(db):
+    """Applies the pending migrations; returns the new version"""
+    schema_version.create(db.engine, checkfirst=True)
+    version = current_version(db.engine)
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info(f"Applying schema migration {number}: {description}")
+        step(db)
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(insert(schema_version).values(
+                    version=number, description=description, applied_at=datetime.utcnow()))
+        except IntegrityError:
+            # Outro processo aplicou a mesma migração ao mesmo tempo
+            logger.info(f"Schema migration {number} already recorded by another process")
+        version = number
+    return version
+
+
+def ensure_schema(db, auto_migrate=SCHEMA_AUTO_MIGRATE):
+    """Checks that the database is up to date, upgrading it when auto_migrate is set"""
+    version = current_version(db.engine)
+    if version == LATEST_VERSION:
+        return version
+    if version > LATEST_VERSION:
+        logger.warning(f"Database schema is at version {version}, newer than this code ({LATEST_VERSION})")
+        return version
+    if not auto_migrate:
+        raise SchemaOutdated(f"Database schema is at version {version}, expected {LATEST_VERSION}: "
+                             f"run `python3 -m schema upgrade`")
+    logger.info(f"Upgrading database schema from version {version} to {LATEST_VERSION}...")
+    return upgrade(db)
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else 'upgrade'
+    if command not in ('upgrade', 'current'):
+        print("usage: python3 -m schema [upgrade|current]", file=sys.stderr)
+        return 2
+    from app import app, db
+
+    with app.app_context():
+        if command == 'current':
+            print(f"{current_version(db.engine)} (latest {LATEST_VERSION})")
+            return 0
+        before = current_version(db.engine)
+        after = upgrade(db)
+        print(f"Database schema at version {after}" + (f" (was {before})" if after != before else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,157 @@
+"""
+Background send jobs.
+
+Slow sends (media uploads) can be queued in the SendJob table instead of holding a
+request thread. A worker pool drains the queue in FIFO order with a cap on concurrent
+jobs per session; job status is polled through GET /api/jobs/<id>.
+"""
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from app import app, db
+from bridge_client import BridgeError, BRIDGE_MEDIA_TIMEOUT
+from media_uploads import media_uploads
+from message_sender import send_payload
+from models import SendJob
+
+logger = logging.getLogger(__name__)
+
+SEND_JOBS_ENABLED = os.environ.get('SEND_JOBS_ENABLED', '1') == '1'
+SEND_JOB_WORKERS = int(os.environ.get('SEND_JOB_WORKERS', '8'))
+SEND_JOB_SESSION_CONCURRENCY = int(os.environ.get('SEND_JOB_SESSION_CONCURRENCY', '2'))
+SEND_JOB_POLL_INTERVAL = float(os.environ.get('SEND_JOB_POLL_INTERVAL', '1'))
+
+
+class SendJobQueue:
+    """Drains the SendJob table with a bounded thread pool"""
+
+    def __init__(self, app, workers=SEND_JOB_WORKERS, session_limit=SEND_JOB_SESSION_CONCURRENCY,
+                 poll_interval=SEND_JOB_POLL_INTERVAL):
+        self.app = app
+        self.workers = workers
+        self.session_limit = session_limit
+        self.poll_interval = poll_interval
+        self._executor = None
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._running = defaultdict(int)  # session_id -> jobs running in this process
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='send-job')
+        self._thread = threading.Thread(target=self._run, name='send-job-queue', daemon=True)
+        self._thread.start()
+        logger.info(f"Send job queue started with {self.workers} workers")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def enqueue(self, session_id, message_type, payload):
+        """Queues a built bridge payload (see message_sender.build_message) and returns the job"""
+        job = SendJob(session_id=session_id, message_type=message_type, payload=json.dumps(payload))
+        db.session.add(job)
+        db.session.commit()
+        self._wakeup.set()
+        return job
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    self._fail_stale()
+                    self._dispatch_queued()
+            except Exception as e:
+                logger.error(f"Error in send job queue loop: {str(e)}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _fail_stale(self):
+        """Marks jobs left running by a crashed process as failed (resending could duplicate messages)"""
+        stale_before = datetime.utcnow() - timedelta(seconds=BRIDGE_MEDIA_TIMEOUT * 2)
+        db.session.execute(
+            update(SendJob)
+            .where(SendJob.status == 'running', SendJob.started_at < stale_before)
+            .values(status='failed', error='Interrupted before completion', finished_at=datetime.utcnow())
+        )
+        db.session.commit()
+
+    def _dispatch_queued(self):
+        with self._lock:
+            capacity = self.workers - sum(self._running.values())
+        if capacity <= 0:
+            return
+
+        queued = (
+            db.session.query(SendJob.id, SendJob.session_id, SendJob.message_type, SendJob.payload)
+            .filter(SendJob.status == 'queued')
+            .order_by(SendJob.id)
+            .limit(capacity * 4)
+            .all()
+        )
+
+        for job_id, session_id, message_type, payload in queued:
+            if capacity <= 0:
+                break
+            with self._lock:
+                if self._running.get(session_id, 0) >= self.session_limit:
+                    continue
+
+            # Claim the job; another process may have taken it first
+            claimed = db.session.execute(
+                update(SendJob)
+                .where(SendJob.id == job_id, SendJob.status == 'queued')
+                .values(status='running', started_at=datetime.utcnow())
+            ).rowcount
+            db.session.commit()
+            if not claimed:
+                continue
+
+            with self._lock:
+                self._running[session_id] += 1
+            capacity -= 1
+            self._executor.submit(self._execute, job_id, session_id, message_type, payload)
+
+    def _execute(self, job_id, session_id, message_type, payload):
+        values = {}
+        payload = json.loads(payload)
+        try:
+            response_data = send_payload(session_id, message_type, payload)
+            values = {'status': 'sent', 'message_id': response_data.get('messageId')}
+            logger.info(f"Send job {job_id} ({message_type}) sent via session {session_id}")
+        except BridgeError as e:
+            values = {'status': 'failed', 'error': e.message, 'status_code': e.status_code}
+            logger.error(f"Send job {job_id} failed: {e.message}")
+        except Exception as e:
+            values = {'status': 'failed', 'error': str(e), 'status_code': 500}
+            logger.error(f"Send job {job_id} failed: {str(e)}")
+        finally:
+            try:
+                with self.app.app_context():
+                    values['finished_at'] = datetime.utcnow()
+                    db.session.execute(update(SendJob).where(SendJob.id == job_id).values(**values))
+                    db.session.commit()
+            except Exception as e:
+                logger.error(f"Error recording send job {job_id}: {str(e)}")
+            # Arquivos enviados via upload só são necessários até o envio
+            media_uploads.discard(payload.get('uploadId'))
+            with self._lock:
+                self._running[session_id] -= 1
+                if self._running[session_id] <= 0:
+                    del self._running[session_id]
+            self._wakeup.set()
+
+
+send_job_queue = SendJobQueue(app)
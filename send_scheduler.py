@@ -0,0 +1,293 @@
+"""
+Per-session outbound scheduler.
+
+Throttling is opt-in. A session with a rate (WhatsAppSession.send_rate, or
+SEND_RATE_DEFAULT for all sessions) takes a token from its token bucket before every
+message sent to a bridge; sessions without one send without waiting. Excess sends
+wait in per-chat FIFO queues that are served round-robin, so one busy chat cannot
+starve the others, and with SEND_CHAT_MIN_INTERVAL consecutive messages to the same
+chat are spaced out.
+
+The buckets live in each process. With WEB_CONCURRENCY worker processes every one
+enforces its share of a session's rate and burst, so together they stay within the
+limits. A worker's burst is at least 1, so a burst smaller than WEB_CONCURRENCY
+still lets WEB_CONCURRENCY messages out at once. The per-chat spacing only holds
+for sends served by the same process.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from app import app, db, WEB_CONCURRENCY
+from models import WhatsAppSession
+
+logger = logging.getLogger(__name__)
+
+# Rate of the sessions without their own (messages per second); unset means no limit
+SEND_RATE_DEFAULT = float(os.environ.get('SEND_RATE_DEFAULT') or 0) or None
+# Bucket size of the sessions with a rate but without their own burst
+SEND_BURST_DEFAULT = int(os.environ.get('SEND_BURST_DEFAULT', '5'))
+# Minimum seconds between two messages to the same chat (0 = no spacing)
+SEND_CHAT_MIN_INTERVAL = float(os.environ.get('SEND_CHAT_MIN_INTERVAL', '0'))
+# Maximum seconds a send waits in the queue before giving up
+SEND_QUEUE_TIMEOUT = float(os.environ.get('SEND_QUEUE_TIMEOUT', '300'))
+# Seconds after which session limits are re-read from the database
+SEND_LIMITS_REFRESH = float(os.environ.get('SEND_LIMITS_REFRESH', '60'))
+
+
+class SendQueueTimeout(Exception):
+    """A send waited longer than allowed for a token"""
+
+
+class _Ticket:
+    __slots__ = ('chat_id', 'enqueued_at', 'granted', 'waker')
+
+    def __init__(self, chat_id, enqueued_at):
+        self.chat_id = chat_id
+        self.enqueued_at = enqueued_at
+        self.granted = False
+        self.waker = None  # Wakes an async waiter when another caller grants its ticket
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class SessionScheduler:
+    """Token bucket with fair per-chat queues for one session"""
+
+    def __init__(self, rate=SEND_RATE_DEFAULT, burst=SEND_BURST_DEFAULT, chat_interval=SEND_CHAT_MIN_INTERVAL):
+        self._cond = threading.Condition()
+        self._chats = OrderedDict()  # chat_id -> deque of waiting tickets, in round-robin order
+        self._last_chat_send = {}    # chat_id -> monotonic time of the last granted send
+        self.chat_interval = chat_interval
+        self.configure(rate, burst)
+        self.tokens = float(self.burst) if self.rate is not None else float('inf')
+        self._refilled_at = time.monotonic()
+        self.loaded_at = self._refilled_at
+        # Metrics
+        self.waiting = 0
+        self.granted = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def configure(self, rate, burst):
+        if rate is None:
+            # Sem limite de taxa: o bucket nunca esvazia
+            self.rate = self.burst = None
+            return
+        # Parte deste processo dos limites da sessão (burst de pelo menos 1 por worker)
+        self.rate = max(float(rate) / WEB_CONCURRENCY, 0.001)
+        self.burst = max(int(burst) // WEB_CONCURRENCY, 1)
+
+    def _refill(self, now):
+        if self.rate is None:
+            self.tokens = float('inf')
+        else:
+            self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _grant_ready(self, now):
+        """Grants tokens to queued tickets, visiting chats round-robin
+
+        Returns (seconds until the next chance or None, whether any ticket was granted).
+        """
+        self._refill(now)
+        next_check = None
+        granted = False
+        progress = True
+        while progress and self._chats:
+            progress = False
+            for chat_id in list(self._chats):
+                ready_at = self._last_chat_send.get(chat_id, 0) + self.chat_interval
+                if ready_at > now:
+                    next_check = ready_at - now if next_check is None else min(next_check, ready_at - now)
+                    continue
+                if self.tokens < 1:
+                    break
+                queue = self._chats[chat_id]
+                ticket = queue.popleft()
+                ticket.granted = True
+                if ticket.waker is not None:
+                    ticket.waker()
+                self.tokens -= 1
+                self._last_chat_send[chat_id] = now
+                granted = True
+                if queue:
+                    self._chats.move_to_end(chat_id)
+                else:
+                    del self._chats[chat_id]
+                progress = True
+
+        if self._chats and self.tokens < 1:
+            token_in = (1 - self.tokens) / self.rate
+            next_check = token_in if next_check is None else min(next_check, token_in)
+        return next_check, granted
+
+    def _enqueue(self, chat_id):
+        ticket = _Ticket(chat_id, time.monotonic())
+        self._chats.setdefault(chat_id, deque()).append(ticket)
+        self.waiting += 1
+        return ticket
+
+    def _poll(self, ticket, timeout):
+        """Grants what is ready; returns None once the ticket is granted, else the seconds to wait
+
+        Must be called with _cond held.
+        """
+        now = time.monotonic()
+        next_check, granted = self._grant_ready(now)
+        if granted:
+            # Threads bloqueadas em acquire() só acordam por notify; pode ser o ticket de outra
+            self._cond.notify_all()
+        if ticket.granted:
+            return None
+        remaining = ticket.enqueued_at + timeout - now
+        if remaining <= 0:
+            self._chats[ticket.chat_id].remove(ticket)
+            if not self._chats[ticket.chat_id]:
+                del self._chats[ticket.chat_id]
+            self.timeouts += 1
+            raise SendQueueTimeout(f"Send queue wait exceeded {timeout:g} seconds")
+        return min(remaining, next_check if next_check is not None else remaining)
+
+    def _granted(self, ticket):
+        now = time.monotonic()
+        waited = now - ticket.enqueued_at
+        self.granted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        # Forget pacing info of idle chats so the map does not grow forever
+        if len(self._last_chat_send) > 10000:
+            cutoff = now - self.chat_interval
+            self._last_chat_send = {chat: sent for chat, sent in self._last_chat_send.items() if sent > cutoff}
+        return waited
+
+    def acquire(self, chat_id, timeout=SEND_QUEUE_TIMEOUT):
+        """Blocks until the session may send to chat_id; returns the seconds waited"""
+        with self._cond:
+            ticket = self._enqueue(chat_id)
+            try:
+                while True:
+                    delay = self._poll(ticket, timeout)
+                    if delay is None:
+                        break
+                    self._cond.wait(delay)
+            finally:
+                self.waiting -= 1
+            return self._granted(ticket)
+
+    async def acquire_async(self, chat_id, timeout=SEND_QUEUE_TIMEOUT):
+        """Like acquire, but waits on the event loop instead of blocking a thread"""
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            ticket = self._enqueue(chat_id)
+        try:
+            while True:
+                woken = loop.create_future()
+                with self._cond:
+                    delay = self._poll(ticket, timeout)
+                    if delay is None:
+                        break
+                    ticket.waker = lambda future=woken: loop.call_soon_threadsafe(_wake, future)
+                await asyncio.wait([woken], timeout=delay)
+        finally:
+            with self._cond:
+                ticket.waker = None
+                self.waiting -= 1
+                # Requisição cancelada ainda na fila: liberar o lugar sem consumir token
+                queue = self._chats.get(ticket.chat_id)
+                if not ticket.granted and queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._chats[ticket.chat_id]
+        with self._cond:
+            return self._granted(ticket)
+
+    def stats(self):
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'chat_interval': self.chat_interval,
+                'tokens': round(self.tokens, 3) if self.rate is not None else None,
+                'queue_depth': self.waiting,
+                'queued_chats': len(self._chats),
+                'granted': self.granted,
+                'timeouts': self.timeouts,
+                'avg_wait': round(self.total_wait / self.granted, 4) if self.granted else 0.0,
+                'max_wait': round(self.max_wait, 4)
+            }
+
+
+class SendScheduler:
+    """Registry of per-session schedulers"""
+
+    def __init__(self, app):
+        self.app = app
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _load_limits(self, session_id):
+        with self.app.app_context():
+            row = db.session.query(WhatsAppSession.send_rate, WhatsAppSession.send_burst).filter_by(id=session_id).first()
+        if row is None:
+            return SEND_RATE_DEFAULT, SEND_BURST_DEFAULT
+        return (row.send_rate if row.send_rate is not None else SEND_RATE_DEFAULT,
+                row.send_burst if row.send_burst is not None else SEND_BURST_DEFAULT)
+
+    def for_session(self, session_id):
+        scheduler = self._sessions.get(session_id)
+        if scheduler is not None and time.monotonic() - scheduler.loaded_at < SEND_LIMITS_REFRESH:
+            return scheduler
+
+        rate, burst = self._load_limits(session_id)
+        with self._lock:
+            scheduler = self._sessions.get(session_id)
+            if scheduler is None:
+                scheduler = SessionScheduler(rate, burst)
+                self._sessions[session_id] = scheduler
+            else:
+                with scheduler._cond:
+                    scheduler.configure(rate, burst)
+            scheduler.loaded_at = time.monotonic()
+        return scheduler
+
+    def configure(self, session_id, rate, burst):
+        """Applies new limits right away (called when a session is updated)"""
+        with self._lock:
+            scheduler = self._sessions.get(session_id)
+        if scheduler is not None:
+            with scheduler._cond:
+                scheduler.configure(rate if rate is not None else SEND_RATE_DEFAULT,
+                                    burst if burst is not None else SEND_BURST_DEFAULT)
+                scheduler._cond.notify_all()
+
+    def acquire(self, session_id, chat_id, timeout=SEND_QUEUE_TIMEOUT):
+        return self.for_session(session_id).acquire(chat_id, timeout)
+
+    async def acquire_async(self, session_id, chat_id, timeout=SEND_QUEUE_TIMEOUT):
+        scheduler = self._sessions.get(session_id)
+        if scheduler is None or time.monotonic() - scheduler.loaded_at >= SEND_LIMITS_REFRESH:
+            # Leitura dos limites no banco fora do event loop
+            scheduler = await asyncio.to_thread(self.for_session, session_id)
+        return await scheduler.acquire_async(chat_id, timeout)
+
+    def discard(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self, session_id=None):
+        if session_id is not None:
+            scheduler = self._sessions.get(session_id)
+            return scheduler.stats() if scheduler is not None else None
+        return {str(session_id): scheduler.stats() for session_id, scheduler in list(self._sessions.items())}
+
+
+send_scheduler = SendScheduler(app)
@@ -0,0 +1,251 @@
+"""
+Per-process broadcaster of session status events for the Server-Sent Events stream.
+
+Events are appended to one shared ring buffer with increasing sequence numbers and
+subscribers read it through their own cursor, so publishing costs the same no matter
+how many dashboards are connected and no thread is started per subscriber. Clients
+that reconnect with Last-Event-ID resume from where they stopped while the event is
+still in the buffer; otherwise they receive a 'reset' event and reload.
+
+Under gunicorn (gthread) each open stream holds one of the worker's request threads,
+so a worker serves only a few dashboards (half of WEB_THREADS by default). In async
+mode (asgi.py) the stream is served on the event loop: a subscriber is a coroutine
+waiting on an asyncio event and the limit is SSE_MAX_ASYNC_SUBSCRIBERS.
+
+With several worker processes a status report or API call reaches only one of them.
+The relay of every other worker finds the change in the sessions table and publishes
+it to its own subscribers.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from app import app, db, WEB_CONCURRENCY
+from metrics import WEB_THREADS
+from models import WhatsAppSession
+
+logger = logging.getLogger(__name__)
+
+SSE_BUFFER_SIZE = int(os.environ.get('SSE_BUFFER_SIZE', '1000'))
+# Each open stream holds a request thread, so a process accepts at most half of its
+# threads as streams (WEB_THREADS, or ASGI_WSGI_THREADS in async mode); a lower cap can be set
+SSE_MAX_SUBSCRIBERS = int(os.environ.get('SSE_MAX_SUBSCRIBERS') or 0) or None
+# Streams served on the event loop (async mode) do not hold a thread
+SSE_MAX_ASYNC_SUBSCRIBERS = int(os.environ.get('SSE_MAX_ASYNC_SUBSCRIBERS', '10000'))
+# Seconds between keep-alive comments, and lifetime of one stream before the client reconnects
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', '15'))
+SSE_STREAM_TIMEOUT = float(os.environ.get('SSE_STREAM_TIMEOUT', '300'))
+# Seconds between checks for session changes made by the other workers (0 disables the relay)
+SSE_RELAY_INTERVAL = float(os.environ.get('SSE_RELAY_INTERVAL', '2'))
+SSE_RELAY_ENABLED = WEB_CONCURRENCY > 1 and SSE_RELAY_INTERVAL > 0
+
+
+def subscriber_limit(threads):
+    """Streams allowed in a process serving requests with threads: at most half of them"""
+    limit = threads // 2
+    if SSE_MAX_SUBSCRIBERS is not None:
+        limit = min(limit, SSE_MAX_SUBSCRIBERS)
+    return limit
+
+
+def qr_etag(qr_code):
+    """ETag of a QR code, sent in the stream so the dashboard knows when to fetch the new QR"""
+    return hashlib.sha1(qr_code.encode('utf-8')).hexdigest() if qr_code else None
+
+
+def format_event(event_id, name, data):
+    return f"id: {event_id}\nevent: {name}\ndata: {data}\n\n"
+
+
+class SessionEventBroadcaster:
+    """Shared ring buffer of events with condition-based wakeups
+
+    Thread subscribers wait on the condition; async subscribers wait on the asyncio
+    event of their loop, which publish replaces and sets once per loop.
+    """
+
+    def __init__(self, buffer_size=SSE_BUFFER_SIZE, max_subscribers=None,
+                 max_async_subscribers=SSE_MAX_ASYNC_SUBSCRIBERS):
+        self.max_subscribers = subscriber_limit(WEB_THREADS) if max_subscribers is None else max_subscribers
+        self.max_async_subscribers = max_async_subscribers
+        self._events = deque(maxlen=buffer_size)  # (sequence, name, serialized data)
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self._loops = {}  # event loop -> [asyncio.Event, subscribers]
+        self.subscribers = 0
+        self.async_subscribers = 0
+
+    def publish(self, name, data):
+        serialized = json.dumps(data)
+        with self._cond:
+            self._sequence += 1
+            self._events.append((self._sequence, name, serialized))
+            self._cond.notify_all()
+            loops = list(self._loops)
+        for loop in loops:
+            try:
+                loop.call_soon_threadsafe(self._wake, loop)
+            except RuntimeError:
+                pass  # Loop encerrado; seus assinantes já terminaram
+
+    def _wake(self, loop):
+        # Roda no loop: os assinantes seguram o evento atual, o próximo publish usa um novo
+        waker = self._loops.get(loop)
+        if waker is not None:
+            event, waker[0] = waker[0], asyncio.Event()
+            event.set()
+
+    def _cursor(self, last_event_id):
+        """Start position of a new subscriber: (cursor, reset); call with the condition held"""
+        cursor = self._sequence
+        reset = False
+        if last_event_id:
+            try:
+                requested = int(last_event_id)
+            except ValueError:
+                requested = None
+            oldest = self._events[0][0] if self._events else self._sequence + 1
+            if requested is None or requested > self._sequence or requested < oldest - 1:
+                # Unknown id (another process or an evicted event): the client must reload
+                reset = True
+            else:
+                cursor = requested
+        return cursor, reset
+
+    def subscribe(self, last_event_id=None):
+        """Returns a generator of SSE messages, or None when the subscriber limit is reached"""
+        with self._cond:
+            if self.subscribers - self.async_subscribers >= self.max_subscribers:
+                return None
+            self.subscribers += 1
+            cursor, reset = self._cursor(last_event_id)
+        return self._stream(cursor, reset)
+
+    def subscribe_async(self, last_event_id=None):
+        """Returns an async generator of SSE messages for the running loop, or None at the limit"""
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self.async_subscribers >= self.max_async_subscribers:
+                return None
+            self.subscribers += 1
+            self.async_subscribers += 1
+            waker = self._loops.setdefault(loop, [asyncio.Event(), 0])
+            waker[1] += 1
+            cursor, reset = self._cursor(last_event_id)
+        return self._stream_async(loop, cursor, reset)
+    def _stream(self, cursor, reset):
+        started = time.monotonic()
+        try:
+            yield "retry: 3000\n\n"
+            if reset:
+                yield format_event(cursor, 'reset', '{}')
+            while time.monotonic() - started < SSE_STREAM_TIMEOUT:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._sequence > cursor, timeout=SSE_HEARTBEAT)
+                    pending = [event for event in self._events if event[0] > cursor]
+                if not pending:
+                    yield ": keep-alive\n\n"
+                    continue
+                for sequence, name, data in pending:
+                    yield format_event(sequence, name, data)
+                cursor = pending[-1][0]
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+    async def _stream_async(self, loop, cursor, reset):
+        started = time.monotonic()
+        try:
+            yield "retry: 3000\n\n"
+            if reset:
+                yield format_event(cursor, 'reset', '{}')
+            while time.monotonic() - started < SSE_STREAM_TIMEOUT:
+                # O evento é obtido antes de ler o buffer: um publish depois da leitura o sinaliza
+                waker = self._loops[loop][0]
+                with self._cond:
+                    pending = [event for event in self._events if event[0] > cursor]
+                if not pending:
+                    try:
+                        await asyncio.wait_for(waker.wait(), SSE_HEARTBEAT)
+                    except asyncio.TimeoutError:
+                        yield ": keep-alive\n\n"
+                    continue
+                for sequence, name, data in pending:
+                    yield format_event(sequence, name, data)
+                cursor = pending[-1][0]
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+                self.async_subscribers -= 1
+                waker = self._loops[loop]
+                waker[1] -= 1
+                if not waker[1]:
+                    del self._loops[loop]
+
+
+class SessionEventRelay:
+    """Publishes the session changes written by other processes
+
+    Polls the status and updated_at of the sessions only while this process has
+    subscribers. Changes made by this process are published again, which the
+    dashboard absorbs (it coalesces reloads and fetches a QR code only when it changed).
+    """
+
+    def __init__(self, broadcaster, app, interval=SSE_RELAY_INTERVAL):
+        self.broadcaster = broadcaster
+        self.app = app
+        self.interval = interval
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='session-event-relay', daemon=True)
+            self._thread.start()
+
+    def _snapshot(self):
+        with self.app.app_context():
+            rows = db.session.query(WhatsAppSession.id, WhatsAppSession.status, WhatsAppSession.updated_at).all()
+        return {row.id: (row.status, row.updated_at) for row in rows}
+
+    def _qr_etags(self, session_ids):
+        with self.app.app_context():
+            rows = db.session.query(WhatsAppSession.id, WhatsAppSession.qr_code).filter(
+                WhatsAppSession.id.in_(session_ids)).all()
+        return {row.id: qr_etag(row.qr_code) for row in rows}
+
+    def _run(self):
+        known = None
+        while True:
+            time.sleep(self.interval)
+            if not self.broadcaster.subscribers:
+                # Um novo assinante recarrega a tabela ao conectar
+                known = None
+                continue
+            try:
+                current = self._snapshot()
+                if known is not None:
+                    self._publish(known, current)
+                known = current
+            except Exception as e:
+                logger.error(f"Error relaying session events: {str(e)}")
+
+    def _publish(self, known, current):
+        changed = [session_id for session_id, state in current.items() if known.get(session_id) != state]
+        qr_sessions = [session_id for session_id in changed if current[session_id][0] == 'qr_code_ready']
+        etags = self._qr_etags(qr_sessions) if qr_sessions else {}
+        for session_id in changed:
+            event = {"id": session_id, "status": current[session_id][0]}
+            if session_id in etags:
+                event["qr_etag"] = etags[session_id]
+            self.broadcaster.publish('session', event)
+        for session_id in known.keys() - current.keys():
+            self.broadcaster.publish('session_deleted', {"id": session_id})
+
+
+session_events = SessionEventBroadcaster()
+session_event_relay = SessionEventRelay(session_events, app)
@@ -0,0 +1,133 @@
+"""
+In-memory registry of session connection state.
+
+The send routes only need to know whether a session is connected and where its bridge
+lives, so they read it from here instead of loading the full WhatsAppSession row (with
+its large qr_code and session_data columns). Status changes are written through by the
+routes that change them; entries older than SESSION_REGISTRY_TTL are re-read from the
+database so that other worker processes converge.
+
+The registry also resolves bridge addresses for bridge_client, since bridge ports are
+allocated by the bridge supervisor and stored with the session.
+"""
+import contextlib
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import abort, has_app_context
+
+from app import app, db
+from bridge_client import bridge_address, bridge_client, async_bridge_client
+from models import BridgeNode, WhatsAppSession
+
+SESSION_REGISTRY_TTL = float(os.environ.get('SESSION_REGISTRY_TTL', '5'))
+
+
+class SessionState:
+    __slots__ = ('session_id', 'status', 'host', 'port', 'last_heartbeat', 'loaded_at')
+
+    def __init__(self, session_id, status, last_heartbeat=None, port=None, host=None):
+        self.session_id = session_id
+        self.status = status
+        self.host, self.port = bridge_address(session_id, port)
+        if host:
+            self.host = host
+        self.last_heartbeat = last_heartbeat
+        self.loaded_at = time.monotonic()
+
+    def to_dict(self):
+        return {
+            'session_id': self.session_id,
+            'status': self.status,
+            'bridge_host': self.host,
+            'bridge_port': self.port,
+            'last_heartbeat': self.last_heartbeat.isoformat() if self.last_heartbeat else None
+        }
+
+
+class SessionRegistry:
+    """Write-through cache of session status with a TTL fallback to the database"""
+
+    def __init__(self, ttl=SESSION_REGISTRY_TTL):
+        self.ttl = ttl
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """Returns the SessionState of a session, or None if it does not exist"""
+        state = self._states.get(session_id)
+        if state is not None and time.monotonic() - state.loaded_at < self.ttl:
+            return state
+
+        row = self._load(session_id)
+        if row is None:
+            self.remove(session_id)
+            return None
+        return self._store(session_id, row.status, False, row.bridge_port, row.host)
+
+    def peek(self, session_id):
+        """Returns the cached SessionState if it is still fresh, without touching the database"""
+        state = self._states.get(session_id)
+        if state is not None and time.monotonic() - state.loaded_at < self.ttl:
+            return state
+        return None
+
+    @staticmethod
+    def _load(session_id):
+        # O host vem do nó onde o bridge da sessão foi colocado (ver bridge_nodes)
+        # Threads de envio em segundo plano (lotes, jobs, modo ASGI) não têm contexto da aplicação
+        context = contextlib.nullcontext() if has_app_context() else app.app_context()
+        with context:
+            return (db.session.query(WhatsAppSession.status, WhatsAppSession.bridge_port, BridgeNode.host)
+                    .outerjoin(BridgeNode, WhatsAppSession.node_id == BridgeNode.id)
+                    .filter(WhatsAppSession.id == session_id)
+                    .first())
+
+    def get_or_404(self, session_id):
+        state = self.get(session_id)
+        if state is None:
+            abort(404)
+        return state
+
+    def update(self, session_id, status=None, heartbeat=True, port=None, host=None):
+        """Records a status or bridge address change (heartbeat=True when it comes from the bridge itself)
+
+        A None status, port or host keeps the previously known value. Sessions that are
+        not cached yet are skipped; get() loads their full state when first needed.
+        """
+        if session_id not in self._states:
+            return None
+        return self._store(session_id, status, heartbeat, port, host)
+
+    def _store(self, session_id, status, heartbeat, port, host):
+        with self._lock:
+            previous = self._states.get(session_id)
+            last_heartbeat = datetime.utcnow() if heartbeat else (previous.last_heartbeat if previous else None)
+            if previous is not None:
+                status = status if status is not None else previous.status
+                port = port if port is not None else previous.port
+                host = host if host is not None else previous.host
+            state = SessionState(session_id, status, last_heartbeat, port, host)
+            self._states[session_id] = state
+        return state
+
+    def remove(self, session_id):
+        with self._lock:
+            self._states.pop(session_id, None)
+
+    def snapshot(self):
+        return [state.to_dict() for state in list(self._states.values())]
+
+    def address(self, session_id):
+        """Returns the (host, port) of a session's bridge"""
+        state = self.get(session_id)
+        if state is None:
+            return bridge_address(session_id)
+        return state.host, state.port
+
+
+session_registry = SessionRegistry()
+bridge_client.resolve_address = session_registry.address
+async_bridge_client.resolve_address = session_registry.address
@@ -25,7 +25,7 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
         
-        apiCall('/api/sessions')
+        apiCall('/api/sessions?fields=id,name,bridge_port')
             .then(sessions => {
                 if (sessions.length === 0) {
                     apiEndpointsTableBody.innerHTML = `
@@ -41,8 +41,8 @@ document.addEventListener('DOMContentLoaded', function() {
                 let tableContent = '';
                 
                 sessions.forEach(session => {
-                    // Calculate the port based on session ID (same logic as in whatsapp_bridge.js)
-                    const port = 3000 + parseInt(session.id);
+                    // Port allocated by the bridge supervisor (3000 + session ID for bridges not started yet)
+                    const port = session.bridge_port || 3000 + parseInt(session.id);
                     
                     // Generate the URLs for each API endpoint (using HTTPS for n8n compatibility)
                     const useHttps = true; // Set to true for n8n compatibility
@@ -152,6 +152,9 @@ document.addEventListener('DOMContentLoaded', function() {
     
     let selectedSessionId = null;
     let qrCheckInterval = null;
+    let sessionPollingInterval = null;
+    let sessionStreamConnected = false;
+    let reloadSessionsTimeout = null;
     
     // Load all sessions when page loads
     loadSessions();
@@ -159,8 +162,8 @@ document.addEventListener('DOMContentLoaded', function() {
     // Load API endpoints
     loadApiEndpoints();
     
-    // Set up polling for status updates
-    setInterval(loadSessions, 10000);
+    // Status updates pushed by the server, with polling as a fallback
+    subscribeToSessionEvents();
     
     // Create session event
     createSessionBtn.addEventListener('click', createSession);
@@ -171,9 +174,67 @@ document.addEventListener('DOMContentLoaded', function() {
     // Confirm delete event
     confirmDeleteBtn.addEventListener('click', deleteSession);
     
+    // Polling a cada 10 segundos, usado apenas enquanto o stream de status não está conectado
+    function startSessionPolling() {
+        if (!sessionPollingInterval) {
+            sessionPollingInterval = setInterval(loadSessions, 10000);
+        }
+    }
+    
+    function stopSessionPolling() {
+        if (sessionPollingInterval) {
+            clearInterval(sessionPollingInterval);
+            sessionPollingInterval = null;
+        }
+    }
+    
+    // Function to subscribe to the session status stream (Server-Sent Events)
+    function subscribeToSessionEvents() {
+        if (!window.EventSource) {
+            startSessionPolling();
+            return;
+        }
+        
+        const source = new EventSource('/api/sessions/stream');
+        
+        source.addEventListener('open', () => {
+            sessionStreamConnected = true;
+            stopSessionPolling();
+            // Atualizações perdidas enquanto o stream estava desconectado
+            scheduleLoadSessions();
+        });
+        
+        // O EventSource reconecta sozinho; até lá (ou se o servidor recusar o stream) voltamos ao polling
+        source.addEventListener('error', () => {
+            sessionStreamConnected = false;
+            startSessionPolling();
+        });
+        
+        source.addEventListener('session', event => {
+            const session = JSON.parse(event.data);
+            scheduleLoadSessions();
+            if (qrCheckInterval && String(session.id) === String(selectedSessionId) && session.status) {
+                handleSessionStatus(session);
+            }
+        });
+        
+        source.addEventListener('session_deleted', scheduleLoadSessions);
+        source.addEventListener('reset', scheduleLoadSessions);
+    }
+    
+    // Agrupa eventos próximos em um único recarregamento da tabela
+    function scheduleLoadSessions() {
+        if (reloadSessionsTimeout) return;
+        reloadSessionsTimeout = setTimeout(() => {
+            reloadSessionsTimeout = null;
+            loadSessions();
+        }, 250);
+    }
+    
     // Function to load all sessions
     function loadSessions() {
-        apiCall('/api/sessions')
+        // Apenas os campos exibidos na tabela (sem o QR code)
+        apiCall('/api/sessions?fields=id,name,description,status,created_at')
             .then(sessions => {
                 renderSessionsTable(sessions);
             })
@@ -392,10 +453,10 @@ document.addEventListener('DOMContentLoaded', function() {
         
         qrCodeModal.show();
         
-        apiCall(`/api/sessions/${sessionId}`)
-            .then(session => {
-                if (session.qr_code) {
-                    displayQRCode(session.qr_code);
+        fetchQRCode(sessionId)
+            .then(qrCodeURL => {
+                if (qrCodeURL) {
+                    displayQRCode(qrCodeURL);
                 } else {
                     qrCodeContainer.innerHTML = `
                         <div class="alert alert-warning">
@@ -414,6 +475,26 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
     
+    // Último QR code exibido (ETag e object URL), para só redesenhar quando o QR mudar
+    let lastQRCodeETag = null;
+    let lastQRCodeURL = null;
+
+    // Function to fetch the QR code image; the browser revalidates it with If-None-Match
+    function fetchQRCode(sessionId, onlyIfChanged = false) {
+        return fetch(`/api/sessions/${sessionId}/qr`, { cache: 'no-cache' })
+            .then(response => {
+                if (!response.ok) return null;
+                const etag = response.headers.get('ETag');
+                if (onlyIfChanged && etag && etag === lastQRCodeETag) return null;
+                lastQRCodeETag = etag;
+                return response.blob().then(blob => {
+                    if (lastQRCodeURL) URL.revokeObjectURL(lastQRCodeURL);
+                    lastQRCodeURL = URL.createObjectURL(blob);
+                    return lastQRCodeURL;
+                });
+            });
+    }
+
     // Function to display QR code
     function displayQRCode(qrCodeData) {
         qrCodeContainer.innerHTML = `
@@ -461,9 +542,11 @@ document.addEventListener('DOMContentLoaded', function() {
         // Check immediately
         checkSessionStatus();
         
-        // Then check every 2 seconds
+        // Then check every 2 seconds (status events replace this while the stream is connected)
         qrCheckInterval = setInterval(() => {
-            checkSessionStatus();
+            if (!sessionStreamConnected) {
+                checkSessionStatus();
+            }
         }, 2000);
         
         // Stop checking after 2 minutes
@@ -556,56 +639,8 @@ document.addEventListener('DOMContentLoaded', function() {
     function checkSessionStatus() {
         if (!selectedSessionId) return;
         
-        apiCall(`/api/sessions/${selectedSessionId}`)
-            .then(session => {
-                // If session is in QR code ready state, show the QR code modal
-                if (session.status === 'qr_code_ready' && session.qr_code) {
-                    qrCodeContainer.innerHTML = `
-                        <img src="${session.qr_code}" alt="WhatsApp QR Code" class="img-fluid">
-                        <p class="mt-2">Escaneie com seu aplicativo WhatsApp no celular</p>
-                    `;
-                    updateConnectionStatus('qr_code_ready');
-                    resetQRExpiryProgress();
-                    qrCodeModal.show();
-                }
-                
-                // Update connection status based on session status
-                if (session.status === 'connecting') {
-                    updateConnectionStatus('connecting');
-                }
-                
-                if (session.status === 'authenticated') {
-                    updateConnectionStatus('authenticated');
-                    // Manter o modal aberto, mas mostrar que estamos progredindo
-                }
-                
-                // If session is connected, stop checking and show success message
-                if (session.status === 'connected') {
-                    updateConnectionStatus('connected');
-                    
-                    if (qrCheckInterval) {
-                        clearInterval(qrCheckInterval);
-                        qrCheckInterval = null;
-                    }
-                    
-                    if (qrExpiryInterval) {
-                        clearInterval(qrExpiryInterval);
-                        qrExpiryInterval = null;
-                    }
-                    
-                    // Manter o modal aberto por 2 segundos para mostrar mensagem de sucesso
-                    setTimeout(() => {
-                        qrCodeModal.hide();
-                        showToast('Sessão do WhatsApp conectada com sucesso', 'success');
-                        loadSessions();
-                    }, 2000);
-                }
-                
-                // If session is disconnected
-                if (session.status === 'disconnected') {
-                    updateConnectionStatus('disconnected');
-                }
-            })
+        apiCall(`/api/sessions/${selectedSessionId}?fields=id,status`)
+            .then(handleSessionStatus)
             .catch(error => {
                 console.error('Error checking session status:', error);
                 // Não esconder o modal em caso de erro, apenas mostrar o status
@@ -614,4 +649,55 @@ document.addEventListener('DOMContentLoaded', function() {
                 document.getElementById('qr-connection-status').className = 'alert alert-danger mb-3';
             });
     }
+    
+    // Function to react to the status of the selected session (from polling or from the stream)
+    function handleSessionStatus(session) {
+        // If session is in QR code ready state, show the QR code modal (only when the QR changed)
+        if (session.status === 'qr_code_ready') {
+            fetchQRCode(session.id, true).then(qrCodeURL => {
+                if (!qrCodeURL) return;
+                displayQRCode(qrCodeURL);
+                updateConnectionStatus('qr_code_ready');
+                resetQRExpiryProgress();
+                qrCodeModal.show();
+            });
+        }
+        
+        // Update connection status based on session status
+        if (session.status === 'connecting') {
+            updateConnectionStatus('connecting');
+        }
+        
+        if (session.status === 'authenticated') {
+            updateConnectionStatus('authenticated');
+            // Manter o modal aberto, mas mostrar que estamos progredindo
+        }
+        
+        // If session is connected, stop checking and show success message
+        if (session.status === 'connected') {
+            updateConnectionStatus('connected');
+            
+            if (qrCheckInterval) {
+                clearInterval(qrCheckInterval);
+                qrCheckInterval = null;
+            }
+            
+            if (qrExpiryInterval) {
+                clearInterval(qrExpiryInterval);
+                qrExpiryInterval = null;
+            }
+            
+            // Manter o modal aberto por 2 segundos para mostrar mensagem de sucesso
+            setTimeout(() => {
+                qrCodeModal.hide();
+                showToast('Sessão do WhatsApp conectada com sucesso', 'success');
+                loadSessions();
+            }, 2000);
+        }
+        
+        // If session is disconnected
+        if (session.status === 'disconnected') {
+            updateConnectionStatus('disconnected');
+        }
+    }
 });
@@ -0,0 +1,121 @@
+"""
+Batched ingestion of session status reports.
+
+The bridges report every state transition and every QR refresh. Reports are merged per
+session for STATUS_COALESCE_WINDOW seconds (only the latest value of each field is
+kept) and then written together in one transaction. Each write is a conditional UPDATE
+that only matches when a value actually differs, so repeated reports neither write the
+row nor bump updated_at, and only real changes are published to the status stream.
+"""
+import contextlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import has_app_context
+from sqlalchemy import or_, update
+
+from app import app, db
+from models import WhatsAppSession
+from session_events import session_events, qr_etag
+from session_registry import session_registry
+
+logger = logging.getLogger(__name__)
+
+# Seconds reports are merged before being written (0 = write each report immediately)
+STATUS_COALESCE_WINDOW = float(os.environ.get('STATUS_COALESCE_WINDOW', '0.25'))
+STATUS_FIELDS = ('status', 'qr_code', 'session_data')
+
+
+class StatusIngest:
+    """Coalesces status reports per session and flushes them in batches"""
+
+    def __init__(self, app, window=STATUS_COALESCE_WINDOW):
+        self.app = app
+        self.window = window
+        self._pending = {}  # session_id -> {field: latest value}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, updates):
+        """Queues {session_id: report} reports; returns how many carried status fields"""
+        batch = {}
+        for session_id, data in updates.items():
+            fields = {name: data[name] for name in STATUS_FIELDS if name in data}
+            if fields:
+                batch[session_id] = fields
+        if not batch:
+            return 0
+
+        if self.window <= 0:
+            self._write(batch)
+            return len(batch)
+        with self._cond:
+            for session_id, fields in batch.items():
+                self._pending.setdefault(session_id, {}).update(fields)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='status-ingest', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return len(batch)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            # Deixar a rajada terminar antes de gravar
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing status updates: {str(e)}")
+
+    def flush(self):
+        """Writes the pending reports now"""
+        with self._cond:
+            pending, self._pending = self._pending, {}
+        if pending:
+            self._write(pending)
+
+    def _write(self, batch):
+        context = contextlib.nullcontext() if has_app_context() else self.app.app_context()
+        with context:
+            table = WhatsAppSession.__table__
+            now = datetime.utcnow()
+            changed = []
+            try:
+                for session_id, fields in batch.items():
+                    result = db.session.execute(
+                        update(table)
+                        .where(table.c.id == session_id,
+                               or_(*[table.c[name].is_distinct_from(value) for name, value in fields.items()]))
+                        .values(updated_at=now, **fields)
+                    )
+                    if result.rowcount:
+                        changed.append(session_id)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error writing status of sessions {sorted(batch)}: {str(e)}")
+                return
+
+            for session_id, fields in batch.items():
+                session_registry.update(session_id, fields.get('status'))
+            for session_id in changed:
+                fields = batch[session_id]
+                # Evento para o stream de status, só quando o status ou o QR code mudam
+                if 'status' not in fields and 'qr_code' not in fields:
+                    continue
+                state = session_registry.get(session_id)
+                event = {"id": session_id, "status": fields.get('status', state.status if state else None)}
+                if 'qr_code' in fields:
+                    event["qr_etag"] = qr_etag(fields['qr_code'])
+                session_events.publish('session', event)
+        if changed:
+            logger.debug(f"Status of {len(changed)}/{len(batch)} sessions changed")
+
+
+status_ingest = StatusIngest(app)
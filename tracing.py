@@ -0,0 +1,308 @@
+"""
+Request tracing and the sampling profiler.
+
+With TRACING_ENABLED=1 (or PUT /api/debug/traces {"enabled": true}), every request
+gets a trace ID. It is taken from the X-Trace-Id header when the caller sends a valid
+one. The ID is returned in the response, and it is forwarded to the bridge calls made
+while serving the request, so the bridge logs can be matched with the API. The time
+spent in each phase is recorded for sampled requests:
+
+    db            SQL statements (summed, with the number of queries)
+    media         resolving media URLs through the media store
+    queue         waiting for the session send scheduler
+    encode        encoding the bridge payload
+    bridge        the HTTP round trip to the bridge (WhatsApp included)
+    response      encoding the JSON response
+
+The most recent TRACE_BUFFER_SIZE traces are kept in memory and listed by
+GET /api/debug/traces.
+
+The profiler samples the stacks of every thread for a limited time. It returns
+folded stacks ("frame;frame;frame count"), which flamegraph.pl, speedscope and
+similar tools read directly.
+"""
+import contextlib
+import contextvars
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from flask.json.provider import DefaultJSONProvider
+
+# Tracing starts disabled; it can be switched on at runtime
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', '0') == '1'
+# Fraction of traced requests whose phases are recorded in the buffer
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1'))
+TRACE_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', '1000'))
+TRACE_HEADER = 'X-Trace-Id'
+# Upper limit of a profiler run, in seconds
+PROFILER_MAX_SECONDS = float(os.environ.get('PROFILER_MAX_SECONDS', '300'))
+PROFILER_DEFAULT_INTERVAL = float(os.environ.get('PROFILER_DEFAULT_INTERVAL', '0.01'))
+# Required in the X-Debug-Token header by the trace and profiler endpoints, which are
+# disabled while it is not set
+DEBUG_TOKEN = os.environ.get('DEBUG_TOKEN', '')
+
+TRACE_ID_PATTERN = re.compile(r'^[0-9A-Za-z_-]{8,64}$')
+# Leaf frames of threads that are only waiting for work (skipped unless idle=1)
+IDLE_FILES = ('threading.py', 'selectors.py', 'queue.py')
+
+_current = contextvars.ContextVar('trace', default=None)
+_NO_PHASE = contextlib.nullcontext()
+
+
+class Trace:
+    __slots__ = ('id', 'name', 'sampled', 'started_at', 'started_wall', 'phases', 'db_time', 'db_queries',
+                 'status', 'duration')
+
+    def __init__(self, trace_id, name, sampled):
+        self.id = trace_id
+        self.name = name
+        self.sampled = sampled
+        self.started_at = time.perf_counter()
+        self.started_wall = time.time()
+        self.phases = []  # (name, offset, duration) in seconds
+        self.db_time = 0.0
+        self.db_queries = 0
+        self.status = None
+        self.duration = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'started_at': self.started_wall,
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'db_ms': round(self.db_time * 1000, 3),
+            'db_queries': self.db_queries,
+            'phases': [{'name': name, 'offset_ms': round(offset * 1000, 3), 'duration_ms': round(duration * 1000, 3)}
+                       for name, offset, duration in self.phases]
+        }
+
+
+class _Phase:
+    __slots__ = ('trace', 'name', 'started_at')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        now = time.perf_counter()
+        self.trace.phases.append((self.name, self.started_at - self.trace.started_at, now - self.started_at))
+        return False
+
+
+class Tracer:
+    """Trace context of the current request and the buffer of finished traces"""
+
+    def __init__(self, enabled=TRACING_ENABLED, sample_rate=TRACE_SAMPLE_RATE, size=TRACE_BUFFER_SIZE):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self._traces = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def start(self, name, trace_id=None):
+        """Starts a trace for the current context; returns the token to pass to finish"""
+        if not trace_id or not TRACE_ID_PATTERN.match(trace_id):
+            trace_id = os.urandom(8).hex()
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        return _current.set(Trace(trace_id, name, sampled))
+
+    def finish(self, token, status=None):
+        trace = _current.get()
+        _current.reset(token)
+        if trace is None or not trace.sampled:
+            return
+        trace.duration = time.perf_counter() - trace.started_at
+        trace.status = status
+        with self._lock:
+            self._traces.append(trace)
+
+    @staticmethod
+    def current():
+        return _current.get()
+
+    @staticmethod
+    def attach(trace):
+        """Makes trace current in this thread (work done for a request); returns the token to pass to detach"""
+        return _current.set(trace)
+
+    @staticmethod
+    def detach(token):
+        _current.reset(token)
+
+    @staticmethod
+    def current_id():
+        trace = _current.get()
+        return trace.id if trace is not None else None
+
+    @staticmethod
+    def phase(name):
+        """Context manager timing a phase of the current trace (a no-op without one)"""
+        trace = _current.get()
+        if trace is None or not trace.sampled:
+            return _NO_PHASE
+        return _Phase(trace, name)
+
+    @staticmethod
+    def add_query(duration):
+        trace = _current.get()
+        if trace is not None:
+            trace.db_time += duration
+            trace.db_queries += 1
+
+    def traces(self, limit=100, min_ms=0, name=None):
+        """Finished traces, newest first"""
+        with self._lock:
+            traces = list(self._traces)
+        result = []
+        for trace in reversed(traces):
+            if trace.duration * 1000 < min_ms or (name and trace.name != name):
+                continue
+            result.append(trace.to_dict())
+            if len(result) >= limit:
+                break
+        return result
+
+    def get(self, trace_id):
+        with self._lock:
+            return next((trace.to_dict() for trace in self._traces if trace.id == trace_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._traces.clear()
+
+
+class TracingJSONProvider(DefaultJSONProvider):
+    """Times the encoding of JSON responses as the 'response' phase"""
+
+    def response(self, *args, **kwargs):
+        with tracer.phase('response'):
+            return super().response(*args, **kwargs)
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads and aggregates them as folded stacks"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.finished_at = None
+        self.interval = PROFILER_DEFAULT_INTERVAL
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval=PROFILER_DEFAULT_INTERVAL, idle=False):
+        """Starts sampling for seconds; returns False if a run is already in progress"""
+        with self._lock:
+            if self.running:
+                return False
+            self._stop.clear()
+            self._stacks = Counter()
+            self.samples = 0
+            self.interval = max(interval, 0.001)
+            self.started_at = time.time()
+            self.finished_at = None
+            self._thread = threading.Thread(target=self._run, args=(min(seconds, PROFILER_MAX_SECONDS), idle),
+                                            name='sampling-profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self, seconds, idle):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not self._stop.is_set():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if not idle and os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            self._stop.wait(self.interval)
+        self.finished_at = time.time()
+
+    def status(self):
+        return {
+            'running': self.running,
+            'samples': self.samples,
+            'interval': self.interval,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'stacks': len(self._stacks)
+        }
+
+    def folded(self):
+        """The samples as folded stacks, heaviest first"""
+        stacks = self._stacks.copy()
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+tracer = Tracer()
+profiler = SamplingProfiler()
+
+
+def init_app(app, engine):
+    """Installs the trace hooks; they only do work while tracer.enabled is set"""
+    from flask import g, request
+    from sqlalchemy import event
+
+    app.json = TracingJSONProvider(app)
+
+    @app.before_request
+    def start_trace():
+        if tracer.enabled:
+            g.trace_token = tracer.start(request.endpoint or 'unmatched', request.headers.get(TRACE_HEADER))
+
+    @app.after_request
+    def add_trace_header(response):
+        trace_id = tracer.current_id()
+        if trace_id is not None:
+            response.headers[TRACE_HEADER] = trace_id
+            g.trace_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_trace(exc=None):
+        token = g.pop('trace_token', None)
+        if token is not None:
+            tracer.finish(token, g.pop('trace_status', 500))
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            conn.info['trace_query_started_at'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        started_at = conn.info.pop('trace_query_started_at', None)
+        if started_at is not None:
+            tracer.add_query(time.perf_counter() - started_at)
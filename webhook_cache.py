@@ -0,0 +1,107 @@
+"""
+In-process cache of decoded webhook rows, keyed by session and by (session, event).
+
+Used by the session/event scoped lookup that the bridges call on every event and by
+the dispatcher, so that an unchanged subscription set costs neither a query nor JSON
+decoding. On a miss, the subscribers of an event are one indexed query on the
+webhook_event table.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from models import Webhook
+
+# Seconds a cached session entry stays valid; bounds staleness across worker processes
+WEBHOOK_CACHE_TTL = float(os.environ.get('WEBHOOK_CACHE_TTL', '30'))
+
+
+class WebhookCache:
+    """Caches active webhooks per session and per event, and the serialized lookup responses"""
+
+    def __init__(self, ttl=WEBHOOK_CACHE_TTL):
+        self.ttl = ttl
+        self._sessions = {}   # session_id -> (loaded_at, [webhook dicts])
+        self._events = {}     # (session_id, event) -> (loaded_at, [webhook dicts])
+        self._responses = {}  # (session_id, event) -> (body bytes, etag)
+        # Bumped by invalidate(); a load started before an invalidation is not stored
+        self._generations = {}  # session_id -> generation
+        self._epoch = 0         # generation of invalidate() with no sessions
+        self._lock = threading.Lock()
+
+    def _generation(self, session_id):
+        return self._epoch, self._generations.get(session_id, 0)
+
+    def _load(self, session_id):
+        webhooks = Webhook.query.filter_by(session_id=session_id, is_active=True).order_by(Webhook.id).all()
+        return [webhook.to_dict() for webhook in webhooks]
+
+    def get_webhooks(self, session_id):
+        """Returns the decoded active webhooks of a session"""
+        now = time.monotonic()
+        entry = self._sessions.get(session_id)
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+
+        generation = self._generation(session_id)
+        webhooks = self._load(session_id)
+        with self._lock:
+            if self._generation(session_id) == generation:
+                self._sessions[session_id] = (now, webhooks)
+                self._responses.pop((session_id, None), None)
+        return webhooks
+
+    def subscribers(self, session_id, event):
+        """Returns the decoded active webhooks of a session subscribed to event"""
+        key = (session_id, event)
+        now = time.monotonic()
+        entry = self._events.get(key)
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+
+        generation = self._generation(session_id)
+        webhooks = [webhook.to_dict() for webhook in Webhook.subscribed(session_id, event)]
+        with self._lock:
+            if self._generation(session_id) == generation:
+                self._events[key] = (now, webhooks)
+                self._responses.pop(key, None)
+        return webhooks
+
+    def lookup(self, session_id, event=None):
+        """Returns (body, etag) with the session's active webhooks subscribed to the event"""
+        generation = self._generation(session_id)
+        webhooks = self.subscribers(session_id, event) if event else self.get_webhooks(session_id)
+        key = (session_id, event or None)
+        cached = self._responses.get(key)
+        if cached is not None:
+            return cached
+
+        body = json.dumps(webhooks, sort_keys=True).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            # Only store if the entry was not invalidated meanwhile
+            current = key in self._events if event else session_id in self._sessions
+            if current and self._generation(session_id) == generation:
+                self._responses[key] = (body, etag)
+        return body, etag
+
+    def invalidate(self, *session_ids):
+        """Drops cached entries for the given sessions (all sessions if none given)"""
+        with self._lock:
+            if not session_ids:
+                self._epoch += 1
+                self._sessions.clear()
+                self._events.clear()
+                self._responses.clear()
+                return
+            for session_id in session_ids:
+                self._generations[session_id] = self._generations.get(session_id, 0) + 1
+                self._sessions.pop(session_id, None)
+            for cache in (self._events, self._responses):
+                for key in [key for key in cache if key[0] in session_ids]:
+                    del cache[key]
+
+
+webhook_cache = WebhookCache()
@@ -0,0 +1,324 @@
+"""
+Webhook delivery engine.
+
+Events posted by the bridges are normalized and serialized once (event_envelopes),
+stored once as an EventPayload and written to the WebhookDelivery outbox (one row per
+subscribed webhook, pointing at the shared payload). They are delivered by a thread
+pool with a per-webhook concurrency limit. Failed deliveries are retried with
+exponential backoff and moved to the dead-letter state ('dead') after
+WEBHOOK_MAX_ATTEMPTS attempts.
+"""
+import logging
+import os
+import random
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import exists, func, insert, select, update
+
+from app import app, db
+from event_envelopes import EventEnvelope
+from models import EventPayload, WebhookDelivery
+from webhook_cache import webhook_cache
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_DISPATCHER_ENABLED = os.environ.get('WEBHOOK_DISPATCHER_ENABLED', '1') == '1'
+WEBHOOK_DELIVERY_WORKERS = int(os.environ.get('WEBHOOK_DELIVERY_WORKERS', '8'))
+WEBHOOK_MAX_CONCURRENCY_PER_WEBHOOK = int(os.environ.get('WEBHOOK_MAX_CONCURRENCY_PER_WEBHOOK', '2'))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', '8'))
+WEBHOOK_BACKOFF_BASE = float(os.environ.get('WEBHOOK_BACKOFF_BASE', '2'))
+WEBHOOK_BACKOFF_MAX = float(os.environ.get('WEBHOOK_BACKOFF_MAX', '600'))
+WEBHOOK_DELIVERY_TIMEOUT = float(os.environ.get('WEBHOOK_DELIVERY_TIMEOUT', '15'))
+WEBHOOK_POLL_INTERVAL = float(os.environ.get('WEBHOOK_POLL_INTERVAL', '1'))
+# Delivered rows older than this (hours) are purged from the outbox
+WEBHOOK_DELIVERY_RETENTION = float(os.environ.get('WEBHOOK_DELIVERY_RETENTION', '24'))
+# Event bodies kept in memory, so that the deliveries of an event render it only once
+WEBHOOK_PAYLOAD_CACHE_SIZE = int(os.environ.get('WEBHOOK_PAYLOAD_CACHE_SIZE', '512'))
+
+# Client errors that are worth retrying; any other 4xx goes straight to dead-letter
+RETRYABLE_STATUS_CODES = {408, 425, 429}
+
+
+class WebhookDispatcher:
+    """Drains the webhook outbox with a bounded thread pool"""
+
+    def __init__(self, app, workers=WEBHOOK_DELIVERY_WORKERS,
+                 per_webhook_limit=WEBHOOK_MAX_CONCURRENCY_PER_WEBHOOK,
+                 max_attempts=WEBHOOK_MAX_ATTEMPTS, poll_interval=WEBHOOK_POLL_INTERVAL):
+        self.app = app
+        self.workers = workers
+        self.per_webhook_limit = per_webhook_limit
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._executor = None
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._in_flight = defaultdict(int)  # webhook_id -> deliveries running in this process
+        self.counters = defaultdict(int)    # enqueued, delivered, failed_attempts, dead
+        self._payloads = OrderedDict()      # payload_id -> EventEnvelope (LRU)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='webhook-delivery')
+        self._thread = threading.Thread(target=self._run, name='webhook-dispatcher', daemon=True)
+        self._thread.start()
+        logger.info(f"Webhook dispatcher started with {self.workers} workers")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def enqueue(self, session_id, envelope):
+        """Stores the event once and writes one outbox row per active webhook subscribed to it"""
+        webhooks = webhook_cache.subscribers(session_id, envelope.event)
+        if not webhooks:
+            return 0
+
+        record = envelope.to_record(session_id)
+        db.session.add(record)
+        db.session.flush()
+        # payload is the legacy NOT NULL body column: it is still read for deliveries
+        # queued before event_payload existed (payload_id NULL), so new rows store ''
+        db.session.execute(insert(WebhookDelivery), [
+            {'webhook_id': webhook['id'], 'session_id': session_id, 'event': envelope.event, 'payload': '',
+             'payload_id': record.id}
+            for webhook in webhooks
+        ])
+        db.session.commit()
+        self._remember(record.id, envelope)
+
+        with self._lock:
+            self.counters['enqueued'] += len(webhooks)
+        self._wakeup.set()
+        return len(webhooks)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    self._recover_stale()
+                    self._dispatch_due()
+            except Exception as e:
+                logger.error(f"Error in webhook dispatcher loop: {str(e)}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _recover_stale(self):
+        """Puts back deliveries left in 'delivering' by a crashed process, and purges old ones"""
+        now = datetime.utcnow()
+        stale_before = now - timedelta(seconds=WEBHOOK_DELIVERY_TIMEOUT * 4)
+        db.session.execute(
+            update(WebhookDelivery)
+            .where(WebhookDelivery.status == 'delivering', WebhookDelivery.locked_at < stale_before)
+            .values(status='pending', locked_at=None)
+        )
+        db.session.execute(
+            WebhookDelivery.__table__.delete().where(
+                WebhookDelivery.status == 'delivered',
+                WebhookDelivery.delivered_at < now - timedelta(hours=WEBHOOK_DELIVERY_RETENTION)
+            )
+        )
+        # Corpos de eventos sem nenhuma entrega restante
+        db.session.execute(
+            EventPayload.__table__.delete().where(
+                EventPayload.created_at < now - timedelta(hours=WEBHOOK_DELIVERY_RETENTION),
+                ~exists().where(WebhookDelivery.payload_id == EventPayload.id)
+            )
+        )
+        db.session.commit()
+
+    def _remember(self, payload_id, envelope):
+        with self._lock:
+            self._payloads[payload_id] = envelope
+            self._payloads.move_to_end(payload_id)
+            while len(self._payloads) > WEBHOOK_PAYLOAD_CACHE_SIZE:
+                self._payloads.popitem(last=False)
+
+    def _envelopes(self, payload_ids):
+        """The envelopes of payload_ids, loading the ones not in memory with a single query"""
+        with self._lock:
+            envelopes = {payload_id: self._payloads[payload_id]
+                         for payload_id in payload_ids if payload_id in self._payloads}
+        missing = [payload_id for payload_id in payload_ids if payload_id not in envelopes]
+        if missing:
+            records = db.session.execute(
+                select(EventPayload.id, EventPayload.event, EventPayload.body, EventPayload.media_token)
+                .where(EventPayload.id.in_(missing))
+            ).all()
+            for payload_id, event, body, media_token in records:
+                envelopes[payload_id] = EventEnvelope(event, body, media_token)
+                self._remember(payload_id, envelopes[payload_id])
+        return envelopes
+
+    def _dispatch_due(self):
+        with self._lock:
+            capacity = self.workers * 2 - sum(self._in_flight.values())
+        if capacity <= 0:
+            return
+
+        now = datetime.utcnow()
+        due = (
+            db.session.query(WebhookDelivery.id, WebhookDelivery.webhook_id, WebhookDelivery.session_id,
+                             WebhookDelivery.attempts, WebhookDelivery.payload, WebhookDelivery.payload_id)
+            .filter(WebhookDelivery.status == 'pending', WebhookDelivery.next_attempt_at <= now)
+            .order_by(WebhookDelivery.next_attempt_at)
+            .limit(capacity * 4)
+            .all()
+        )
+        envelopes = self._envelopes({row.payload_id for row in due if row.payload_id is not None})
+
+        for delivery_id, webhook_id, session_id, attempts, payload, payload_id in due:
+            if capacity <= 0:
+                break
+            with self._lock:
+                if self._in_flight.get(webhook_id, 0) >= self.per_webhook_limit:
+                    continue
+
+            webhook = self._find_webhook(session_id, webhook_id)
+            if webhook is None:
+                self._finish(delivery_id, 'dead', error='Webhook removed or inactive')
+                continue
+            if payload_id is not None:
+                envelope = envelopes.get(payload_id)
+                if envelope is None:
+                    self._finish(delivery_id, 'dead', error='Event payload purged')
+                    continue
+                body = envelope.render(webhook['url'])
+            else:
+                body = payload.encode('utf-8')
+
+            # Claim the row; another process may have taken it first
+            claimed = db.session.execute(
+                update(WebhookDelivery)
+                .where(WebhookDelivery.id == delivery_id, WebhookDelivery.status == 'pending')
+                .values(status='delivering', locked_at=now)
+            ).rowcount
+            db.session.commit()
+            if not claimed:
+                continue
+
+            with self._lock:
+                self._in_flight[webhook_id] += 1
+            capacity -= 1
+            self._executor.submit(self._deliver, delivery_id, webhook_id, attempts,
+                                  webhook['url'], webhook['headers'], body)
+
+    @staticmethod
+    def _find_webhook(session_id, webhook_id):
+        for webhook in webhook_cache.get_webhooks(session_id):
+            if webhook['id'] == webhook_id:
+                return webhook
+        return None
+
+    def _deliver(self, delivery_id, webhook_id, attempts, url, headers, body):
+        status_code = None
+        error = None
+        try:
+            req = urllib.request.Request(
+                url,
+                data=body,
+                headers={"Content-Type": "application/json", **headers},
+                method="POST"
+            )
+            with urllib.request.urlopen(req, timeout=WEBHOOK_DELIVERY_TIMEOUT) as response:
+                status_code = response.status
+        except urllib.error.HTTPError as e:
+            status_code = e.code
+            error = e.read().decode('utf-8', errors='replace')[:1000] or f"HTTP {e.code}"
+        except Exception as e:
+            error = str(e)
+
+        try:
+            with self.app.app_context():
+                if error is None:
+                    self._finish(delivery_id, 'delivered', status_code=status_code)
+                    self._count('delivered')
+                    return
+
+                attempts += 1
+                retryable = status_code is None or status_code >= 500 or status_code in RETRYABLE_STATUS_CODES
+                if retryable and attempts < self.max_attempts:
+                    delay = min(WEBHOOK_BACKOFF_BASE ** attempts, WEBHOOK_BACKOFF_MAX)
+                    delay *= random.uniform(0.8, 1.2)
+                    self._finish(delivery_id, 'pending', attempts=attempts, status_code=status_code, error=error,
+                                 next_attempt_at=datetime.utcnow() + timedelta(seconds=delay))
+                    self._count('failed_attempts')
+                else:
+                    self._finish(delivery_id, 'dead', attempts=attempts, status_code=status_code, error=error)
+                    self._count('failed_attempts')
+                    self._count('dead')
+                    logger.warning(f"Webhook delivery {delivery_id} moved to dead-letter: {error}")
+        except Exception as e:
+            logger.error(f"Error recording webhook delivery {delivery_id}: {str(e)}")
+        finally:
+            with self._lock:
+                self._in_flight[webhook_id] -= 1
+                if self._in_flight[webhook_id] <= 0:
+                    del self._in_flight[webhook_id]
+            self._wakeup.set()
+
+    @staticmethod
+    def _finish(delivery_id, status, attempts=None, status_code=None, error=None, next_attempt_at=None):
+        values = {'status': status, 'locked_at': None, 'last_status_code': status_code, 'last_error': error}
+        if attempts is not None:
+            values['attempts'] = attempts
+        if next_attempt_at is not None:
+            values['next_attempt_at'] = next_attempt_at
+        if status == 'delivered':
+            values['delivered_at'] = datetime.utcnow()
+        db.session.execute(update(WebhookDelivery).where(WebhookDelivery.id == delivery_id).values(**values))
+        db.session.commit()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def retry(self, webhook_id, delivery_ids=None):
+        """Moves dead-lettered deliveries of a webhook (all, or the given ids) back to the outbox"""
+        statement = (
+            update(WebhookDelivery)
+            .where(WebhookDelivery.webhook_id == webhook_id, WebhookDelivery.status == 'dead')
+            .values(status='pending', attempts=0, next_attempt_at=datetime.utcnow(), last_error=None)
+        )
+        if delivery_ids is not None:
+            statement = statement.where(WebhookDelivery.id.in_(delivery_ids))
+        result = db.session.execute(statement)
+        db.session.commit()
+        self._wakeup.set()
+        return result.rowcount
+
+    def stats(self):
+        rows = (
+            db.session.query(WebhookDelivery.webhook_id, WebhookDelivery.status, func.count(WebhookDelivery.id))
+            .group_by(WebhookDelivery.webhook_id, WebhookDelivery.status)
+            .all()
+        )
+        totals = defaultdict(int)
+        per_webhook = defaultdict(dict)
+        for webhook_id, status, count in rows:
+            totals[status] += count
+            per_webhook[webhook_id][status] = count
+
+        with self._lock:
+            return {
+                'running': self._thread is not None and self._thread.is_alive(),
+                'workers': self.workers,
+                'per_webhook_limit': self.per_webhook_limit,
+                'in_flight': sum(self._in_flight.values()),
+                'outbox': dict(totals),
+                'webhooks': {str(webhook_id): counts for webhook_id, counts in per_webhook.items()},
+                'counters': dict(self.counters)
+            }
+
+
+webhook_dispatcher = WebhookDispatcher(app)
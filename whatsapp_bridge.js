@@ -33,6 +33,11 @@ if (!fs.existsSync(mediaDir)) {
     fs.mkdirSync(mediaDir, { recursive: true });
 }
 
+// Uploads recebidos pela API (multipart/binário), referenciados por uploadId nos envios de mídia
+const uploadsDir = process.env.MEDIA_UPLOAD_DIR || path.join(__dirname, 'media', 'uploads');
+// Armazenamento de mídia por conteúdo da API, referenciado por mediaHash nos envios de mídia
+const mediaStoreDir = process.env.MEDIA_STORE_DIR || path.join(__dirname, 'media', 'store');
+
 
 
 // Initialize the WhatsApp client
@@ -122,13 +127,25 @@ async function downloadMessageMedia(message) {
         }
 
         const fileName = `${message.id._serialized}.${fileExtension}`;
-        const filePath = path.join(mediaDir, fileName);
+        let filePath = null;
 
-        // Decodificar e salvar o arquivo
+        // Decodificar e salvar o arquivo no armazenamento de mídia da API (deduplicado por conteúdo)
         const buffer = Buffer.from(media.data, 'base64');
-        fs.writeFileSync(filePath, buffer);
-
-        console.log(`Media saved to ${filePath}`);
+        try {
+            const apiHost = process.env.API_HOST || 'web';
+            const apiPort = process.env.API_PORT || '5000';
+            await axios.put(`http://${apiHost}:${apiPort}/api/files/session_${sessionId}/${encodeURIComponent(fileName)}`, buffer, {
+                headers: { 'Content-Type': media.mimetype },
+                maxBodyLength: Infinity
+            });
+            console.log(`Media stored: ${fileName}`);
+        } catch (storeError) {
+            // API indisponível: gravar no diretório da sessão, servido como antes
+            console.error('Error storing media, saving locally:', storeError.message);
+            filePath = path.join(mediaDir, fileName);
+            fs.writeFileSync(filePath, buffer);
+            console.log(`Media saved to ${filePath}`);
+        }
 
         return {
             path: filePath,
@@ -143,149 +160,176 @@ async function downloadMessageMedia(message) {
     }
 }
 
+// Cache local dos webhooks por evento, revalidado via ETag/If-None-Match
+const webhookCache = {};
+
+// Function to fetch the active webhooks of this session subscribed to an event
+async function fetchWebhooks(eventType) {
+    const apiHost = process.env.API_HOST || 'web';
+    const apiPort = process.env.API_PORT || '5000';
+    const cached = webhookCache[eventType];
+
+    const response = await axios.get(`http://${apiHost}:${apiPort}/api/sessions/${sessionId}/webhooks`, {
+        params: { event: eventType },
+        headers: cached ? { 'If-None-Match': cached.etag } : {},
+        validateStatus: status => status === 200 || status === 304
+    });
+
+    if (response.status === 304 && cached) {
+        return cached.webhooks;
+    }
+
+    webhookCache[eventType] = { etag: response.headers.etag, webhooks: response.data };
+    return response.data;
+}
+
 // Function to send webhook events
+// O evento é montado uma única vez e enviado ao Flask, que entrega a cada webhook com retentativas
 async function sendWebhookEvent(eventType, data) {
     try {
-        // Fetch all webhooks for this session
-        const apiHost = process.env.API_HOST || 'web';
-        const apiPort = process.env.API_PORT || '5000';
-        const response = await axios.get(`http://${apiHost}:${apiPort}/api/webhooks`);
-        const webhooks = response.data.filter(webhook =>
-            webhook.session_id == sessionId &&
-            webhook.is_active &&
-            webhook.events.includes(eventType)
-        );
+        // Skip events nobody is subscribed to (avoids downloading media for nothing)
+        const webhooks = await fetchWebhooks(eventType);
 
         if (webhooks.length === 0) {
             return;
         }
 
-        // Send the event to each webhook with processed data for each webhook's settings
-        console.log(`Sending ${eventType} event to ${webhooks.length} webhooks`);
-
-        for (const webhook of webhooks) {
-            try {
-                // Gerar um ID de evento único
-                const eventId = `evt_${Date.now().toString(36)}${Math.random().toString(36).substr(2, 9)}`;
-
-                // Obter informações sobre o número do WhatsApp atual
-                let meInfo = {
-                    id: client.info ? client.info.wid._serialized : "unknown",
-                    pushName: client.info ? client.info.pushname : "WhatsFlow"
-                };
+        // Obter informações sobre o número do WhatsApp atual
+        const meInfo = {
+            id: client.info ? client.info.wid._serialized : "unknown",
+            pushName: client.info ? client.info.pushname : "WhatsFlow"
+        };
 
-                // Formatar os dados no padrão WAHA
-                let wahaPayload = {
-                    id: eventId,
-                    event: eventType,
-                    session: `session_${sessionId}`,
-                    metadata: {},
-                    me: meInfo,
-                    payload: {},
-                    engine: "WEBJS",
-                    environment: {
-                        version: "2025.2.1",
-                        engine: "WEBJS",
-                        tier: "CORE",
-                        browser: "/usr/bin/chromium"
-                    }
+        // Só o payload é montado aqui; o Flask monta o envelope WAHA (id, session, engine, environment)
+        const event = { event: eventType, me: meInfo, payload: {} };
+
+        // Processar diferentes tipos de eventos
+        switch (eventType) {
+            case 'message':
+            case 'message_create':
+                // Obter a mensagem original
+                const msg = data._messageObj || data;
+
+                // Dados básicos da mensagem
+                event.payload = {
+                    id: msg.id && msg.id._serialized ? msg.id._serialized :
+                         msg.id ? `${msg.id.fromMe}_${msg.id.remote}_${msg.id.id}` : data.id,
+                    timestamp: msg.timestamp || Math.floor(Date.now() / 1000),
+                    from: msg.from || data.from,
+                    fromMe: msg.fromMe || data.fromMe,
+                    to: msg.to || data.to,
+                    body: msg.body || data.body || "",
+                    hasMedia: msg.hasMedia || data.hasMedia || false,
+                    ack: msg.ack || 1,
+                    ackName: msg.ack ? ['ERROR', 'PENDING', 'RECEIVED', 'READ', 'PLAYED'][msg.ack] || 'UNKNOWN' : 'SERVER',
+                    vCards: msg.vCards || [],
+                    _data: msg._data || {}
                 };
 
-                // Processar diferentes tipos de eventos
-                switch (eventType) {
-                    case 'message':
-                    case 'message_create':
-                        // Obter a mensagem original
-                        const msg = data._messageObj || data;
-
-                        // Dados básicos da mensagem
-                        wahaPayload.payload = {
-                            id: msg.id && msg.id._serialized ? msg.id._serialized :
-                                 msg.id ? `${msg.id.fromMe}_${msg.id.remote}_${msg.id.id}` : data.id,
-                            timestamp: msg.timestamp || Math.floor(Date.now() / 1000),
-                            from: msg.from || data.from,
-                            fromMe: msg.fromMe || data.fromMe,
-                            to: msg.to || data.to,
-                            body: msg.body || data.body || "",
-                            hasMedia: msg.hasMedia || data.hasMedia || false,
-                            ack: msg.ack || 1,
-                            ackName: msg.ack ? ['ERROR', 'PENDING', 'RECEIVED', 'READ', 'PLAYED'][msg.ack] || 'UNKNOWN' : 'SERVER',
-                            vCards: msg.vCards || [],
-                            _data: msg._data || {}
-                        };
-
-                        // Adicionar campos de mídia se disponíveis
-                        if (wahaPayload.payload.hasMedia) {
-                            try {
-                                // Tentativa de download de mídia
-                                if (msg.downloadMedia) {
-                                    // Obter URL base do servidor
-                                    const apiHost = process.env.API_HOST || 'web';
-                                    const apiPort = process.env.API_PORT || '5000';
-
-                                    // Determinar o host correto para o webhook
-                                    const serverHost = webhook.url.includes('localhost') ?
-                                        'localhost:5000' : webhook.url.includes('127.0.0.1') ?
-                                            '127.0.0.1:5000' : `${apiHost}:${apiPort}`;
-                                    // Baixar e salvar mídia
-                                    const mediaInfo = await downloadMessageMedia(msg);
-                                    if (mediaInfo) {
-                                        const mediaUrl = `http://${serverHost}${mediaInfo.url}`;
-                                        wahaPayload.payload.media = {
-                                            url: mediaUrl,
-                                            filename: mediaInfo.filename,
-                                            mimetype: mediaInfo.mimetype
-                                        };
-                                        wahaPayload.payload.mediaUrl = mediaUrl;
-                                    }
-                                }
-                            } catch (mediaError) {
-                                console.error(`Error processing media:`, mediaError);
-                            }
+                // Adicionar campos de mídia se disponíveis
+                if (event.payload.hasMedia && msg.downloadMedia) {
+                    try {
+                        // Baixar e salvar mídia uma única vez; o Flask completa o host por webhook
+                        const mediaInfo = await downloadMessageMedia(msg);
+                        if (mediaInfo) {
+                            event.payload.media = {
+                                url: mediaInfo.url,
+                                filename: mediaInfo.filename,
+                                mimetype: mediaInfo.mimetype
+                            };
+                            event.payload.mediaUrl = mediaInfo.url;
                         }
-                        break;
-
-                    case 'message_ack':
-                        // Dados de confirmação de leitura
-                        wahaPayload.payload = {
-                            id: data.id || "unknown",
-                            ack: data.ack,
-                            ackName: data.ackName,
-                            body: data.body || "",
-                            timestamp: Math.floor(Date.now() / 1000)
-                        };
-                        break;
-
-                    case 'qr':
-                        // Dados de QR code
-                        wahaPayload.payload = {
-                            qr: data.qr
-                        };
-                        break;
-
-                    default:
-                        // Para outros tipos de eventos
-                        wahaPayload.payload = {...data};
+                    } catch (mediaError) {
+                        console.error(`Error processing media:`, mediaError);
+                    }
                 }
+                break;
 
-                // Se o webhook tiver headers especiais, usá-los
-                const headers = webhook.headers || {};
+            case 'message_ack':
+                // Dados de confirmação de leitura
+                event.payload = {
+                    id: data.id || "unknown",
+                    ack: data.ack,
+                    ackName: data.ackName,
+                    body: data.body || "",
+                    timestamp: Math.floor(Date.now() / 1000)
+                };
+                break;
 
-                // Enviar para o webhook
-                const webhookResponse = await axios.post(webhook.url, wahaPayload, { headers });
-                console.log(`Event ${eventType} sent to webhook ${webhook.id} (${webhook.name}) - Response: ${webhookResponse.status}`);
-            } catch (webhookError) {
-                console.error(`Error sending to webhook ${webhook.id}:`, webhookError.message);
-                if (webhookError.response) {
-                    console.error(`Status: ${webhookError.response.status}, Data:`, webhookError.response.data);
-                }
-            }
+            case 'qr':
+                // Dados de QR code
+                event.payload = {
+                    qr: data.qr
+                };
+                break;
+
+            default:
+                // Para outros tipos de eventos
+                event.payload = {...data};
         }
+
+        // Enviar o evento uma vez para o Flask, que cuida da entrega aos webhooks
+        const apiHost = process.env.API_HOST || 'web';
+        const apiPort = process.env.API_PORT || '5000';
+        const response = await axios.post(`http://${apiHost}:${apiPort}/api/sessions/${sessionId}/events`, event);
+        console.log(`Event ${eventType} queued for ${response.data.queued} webhooks`);
     } catch (error) {
         console.error('Error fetching webhooks or sending event:', error.message);
     }
 }
 
+// Histórico de mensagens da API: mensagens (e seus acks) enviadas em lotes
+const messageStoreEnabled = process.env.MESSAGE_STORE_ENABLED !== '0';
+const messageFlushInterval = parseInt(process.env.MESSAGE_FLUSH_INTERVAL_MS) || 1000;
+const messageFlushMax = parseInt(process.env.MESSAGE_FLUSH_MAX) || 200;
+// Mensagens retidas enquanto a API não responde, além das quais as mais antigas são descartadas
+const messageBufferMax = 5000;
+let messageBuffer = [];
+let messageFlushTimer = null;
+
+function recordMessage(message, ack = message.ack) {
+    if (!messageStoreEnabled) return;
+    messageBuffer.push({
+        id: message.id._serialized,
+        chatId: message.id.remote,
+        from: message.from,
+        to: message.to,
+        fromMe: message.fromMe,
+        type: message.type,
+        body: message.body,
+        hasMedia: message.hasMedia,
+        ack: ack,
+        timestamp: message.timestamp
+    });
+    if (messageBuffer.length >= messageFlushMax) {
+        flushMessages();
+    } else if (!messageFlushTimer) {
+        messageFlushTimer = setTimeout(flushMessages, messageFlushInterval);
+    }
+}
+
+async function flushMessages() {
+    if (messageFlushTimer) {
+        clearTimeout(messageFlushTimer);
+        messageFlushTimer = null;
+    }
+    if (messageBuffer.length === 0) return;
+    const batch = messageBuffer;
+    messageBuffer = [];
+    try {
+        const apiHost = process.env.API_HOST || 'web';
+        const apiPort = process.env.API_PORT || '5000';
+        await axios.post(`http://${apiHost}:${apiPort}/api/sessions/${sessionId}/messages`, { messages: batch });
+    } catch (error) {
+        console.error('Error storing messages:', error.message);
+        // Devolver ao buffer e tentar de novo mais tarde (a API faz upsert, repetir é seguro)
+        messageBuffer = batch.concat(messageBuffer).slice(-messageBufferMax);
+        if (!messageFlushTimer) {
+            messageFlushTimer = setTimeout(flushMessages, messageFlushInterval * 5);
+        }
+    }
+}
+
 // Update status to connecting
 updateSessionStatus('connecting');
 
@@ -359,6 +403,9 @@ client.on('message', async (message) => {
 
 // Message create event
 client.on('message_create', async (message) => {
+    // Disparado para mensagens recebidas e enviadas: todas vão para o histórico
+    recordMessage(message);
+
     if (message.fromMe) {
         console.log(`New message sent: ${message.body}`);
 
@@ -392,6 +439,7 @@ client.on('message_ack', async (message, ack) => {
     };
 
     console.log(`Message ACK update: ${message.body} => ${ackMap[ack]}`);
+    recordMessage(message, ack);
 
     // Format ACK data for webhook
     const ackData = {
@@ -456,13 +504,8 @@ client.on('typing', async (chatId, typing) => {
         // Also send to waha.devlike.pro if configured with a webhook for this event
         try {
             // Get webhook configured for waha
-            const response = await axios.get('http://web:5000/api/webhooks');
-            const wahaWebhooks = response.data.filter(webhook =>
-                webhook.session_id == sessionId &&
-                webhook.is_active &&
-                webhook.url.includes('waha.devlike.pro') &&
-                webhook.events.includes('typing')
-            );
+            const webhooks = await fetchWebhooks('typing');
+            const wahaWebhooks = webhooks.filter(webhook => webhook.url.includes('waha.devlike.pro'));
 
             if (wahaWebhooks.length > 0) {
                 for (const webhook of wahaWebhooks) {
@@ -518,13 +561,8 @@ client.on('chat_update', async (chat) => {
         // Also send to waha.devlike.pro if configured with a webhook for this event
         try {
             // Get webhook configured for waha
-            const response = await axios.get('http://web:5000/api/webhooks');
-            const wahaWebhooks = response.data.filter(webhook =>
-                webhook.session_id == sessionId &&
-                webhook.is_active &&
-                webhook.url.includes('waha.devlike.pro') &&
-                webhook.events.includes('seen')
-            );
+            const webhooks = await fetchWebhooks('seen');
+            const wahaWebhooks = webhooks.filter(webhook => webhook.url.includes('waha.devlike.pro'));
 
             if (wahaWebhooks.length > 0) {
                 for (const webhook of wahaWebhooks) {
@@ -573,12 +611,13 @@ process.on('unhandledRejection', (reason, promise) => {
 const express = require('express');
 const bodyParser = require('body-parser');
 const app = express();
-const PORT = 3000 + parseInt(sessionId); // Use dynamic port based on session ID
+// Port allocated by the bridge supervisor (falls back to 3000 + session ID when started by hand)
+const PORT = parseInt(process.env.BRIDGE_PORT) || 3000 + parseInt(sessionId);
 
 // CORS middleware - Allow requests from any origin (including n8n)
 app.use((req, res, next) => {
     res.header('Access-Control-Allow-Origin', '*');
-    res.header('Access-Control-Allow-Headers', 'Origin, X-Requested-With, Content-Type, Accept, Authorization');
+    res.header('Access-Control-Allow-Headers', 'Origin, X-Requested-With, Content-Type, Accept, Authorization, X-Trace-Id');
     res.header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS');
 
     // Handle preflight requests (OPTIONS)
@@ -589,9 +628,29 @@ app.use((req, res, next) => {
     next();
 });
 
+// Trace ID enviado pela API: devolvido na resposta e registrado com o tempo da requisição
+app.use((req, res, next) => {
+    const traceId = req.get('X-Trace-Id');
+    if (!traceId) {
+        return next();
+    }
+    const startedAt = process.hrtime.bigint();
+    res.set('X-Trace-Id', traceId);
+    res.on('finish', () => {
+        const elapsedMs = Number(process.hrtime.bigint() - startedAt) / 1e6;
+        console.log(`[trace ${traceId}] ${req.method} ${req.path} ${res.statusCode} ${elapsedMs.toFixed(1)}ms`);
+    });
+    next();
+});
+
 // Parse JSON request body
 app.use(bodyParser.json());
 
+// Health check used by the bridge supervisor
+app.get('/health', (req, res) => {
+    res.json({ status: 'ok', sessionId: sessionId, uptime: process.uptime() });
+});
+
 // API endpoint to send text message
 app.post('/api/send-text', async (req, res) => {
     try {
@@ -700,22 +759,64 @@ app.post('/api/typing', async (req, res) => {
     }
 });
 
+// Carrega um arquivo mantido pela API: do diretório compartilhado quando o bridge
+// roda no mesmo host, senão baixando-o da API
+async function loadSharedMedia(localPath, apiPath, mimetype, filename) {
+    let media;
+    if (fs.existsSync(localPath)) {
+        console.log(`Loading media from ${localPath}`);
+        media = MessageMedia.fromFilePath(localPath);
+    } else {
+        const apiHost = process.env.API_HOST || 'web';
+        const apiPort = process.env.API_PORT || '5000';
+        const mediaUrl = `http://${apiHost}:${apiPort}${apiPath}`;
+        console.log(`Loading media from URL: ${mediaUrl}`);
+        media = await MessageMedia.fromUrl(mediaUrl, {
+            unsafeMime: true,
+            reqOptions: { timeout: 120000 }
+        });
+    }
+    if (mimetype) media.mimetype = mimetype;
+    if (filename) media.filename = filename;
+    return media;
+}
+
+// uploadId/mediaHash vêm de fora: aceitar apenas os formatos gerados pela API, nunca um caminho
+async function loadUploadedMedia(uploadId, mimetype, filename) {
+    if (!/^[0-9a-f]{32}$/.test(uploadId)) {
+        throw new Error('Invalid uploadId');
+    }
+    return loadSharedMedia(path.join(uploadsDir, uploadId), `/api/uploads/${uploadId}`, mimetype, filename);
+}
+
+async function loadStoredMedia(mediaHash, mimetype, filename) {
+    if (!/^[0-9a-f]{64}$/.test(mediaHash)) {
+        throw new Error('Invalid mediaHash');
+    }
+    const localPath = path.join(mediaStoreDir, mediaHash.slice(0, 2), mediaHash);
+    return loadSharedMedia(localPath, `/api/media/${mediaHash}`, mimetype, filename);
+}
+
 // API endpoint para envio de imagens
 app.post('/api/send-image', async (req, res) => {
     try {
-        const { chatId, imageUrl, imageBase64, caption = '' } = req.body;
+        const { chatId, imageUrl, imageBase64, uploadId, mediaHash, mimetype, caption = '' } = req.body;
         if (!chatId) {
             return res.status(400).json({ success: false, error: 'chatId is required' });
         }
-        if (!imageUrl && !imageBase64) {
-            return res.status(400).json({ success: false, error: 'imageUrl or imageBase64 is required' });
+        if (!imageUrl && !imageBase64 && !uploadId && !mediaHash) {
+            return res.status(400).json({ success: false, error: 'imageUrl, imageBase64 or uploadId is required' });
         }
         if (!client || client.info === undefined) {
             return res.status(500).json({ success: false, error: 'WhatsApp client not ready' });
         }
         let media;
         try {
-            if (imageUrl) {
+            if (uploadId) {
+                media = await loadUploadedMedia(uploadId, mimetype, null);
+            } else if (mediaHash) {
+                media = await loadStoredMedia(mediaHash, mimetype, null);
+            } else if (imageUrl) {
                 // Processar URLs que usam localhost ou 127.0.0.1
                 let processedUrl = imageUrl;
 
@@ -773,12 +874,12 @@ app.post('/api/send-image', async (req, res) => {
 // API endpoint para envio de documentos (PDF, TXT, etc)
 app.post('/api/send-document', async (req, res) => {
     try {
-        const { chatId, documentUrl, documentBase64, filename, caption = '' } = req.body;
+        const { chatId, documentUrl, documentBase64, uploadId, mediaHash, mimetype, filename, caption = '' } = req.body;
         if (!chatId) {
             return res.status(400).json({ success: false, error: 'chatId is required' });
         }
-        if (!documentUrl && !documentBase64) {
-            return res.status(400).json({ success: false, error: 'documentUrl or documentBase64 is required' });
+        if (!documentUrl && !documentBase64 && !uploadId && !mediaHash) {
+            return res.status(400).json({ success: false, error: 'documentUrl, documentBase64 or uploadId is required' });
         }
         if (!client || client.info === undefined) {
             return res.status(500).json({ success: false, error: 'WhatsApp client not ready' });
@@ -786,7 +887,11 @@ app.post('/api/send-document', async (req, res) => {
 
         let media;
         try {
-            if (documentUrl) {
+            if (uploadId) {
+                media = await loadUploadedMedia(uploadId, mimetype, filename || 'document');
+            } else if (mediaHash) {
+                media = await loadStoredMedia(mediaHash, mimetype, filename || 'document');
+            } else if (documentUrl) {
                 // Processar URLs que usam localhost ou 127.0.0.1
                 let processedUrl = documentUrl;
 
@@ -861,12 +966,12 @@ app.post('/api/send-document', async (req, res) => {
 // API endpoint para envio de áudio
 app.post('/api/send-audio', async (req, res) => {
     try {
-        const { chatId, audioUrl, audioBase64, filename, caption = '', asVoiceMessage = true } = req.body;
+        const { chatId, audioUrl, audioBase64, uploadId, mediaHash, mimetype, filename, caption = '', asVoiceMessage = true } = req.body;
         if (!chatId) {
             return res.status(400).json({ success: false, error: 'chatId is required' });
         }
-        if (!audioUrl && !audioBase64) {
-            return res.status(400).json({ success: false, error: 'audioUrl or audioBase64 is required' });
+        if (!audioUrl && !audioBase64 && !uploadId && !mediaHash) {
+            return res.status(400).json({ success: false, error: 'audioUrl, audioBase64 or uploadId is required' });
         }
         if (!client || client.info === undefined) {
             return res.status(500).json({ success: false, error: 'WhatsApp client not ready' });
@@ -874,7 +979,11 @@ app.post('/api/send-audio', async (req, res) => {
 
         let media;
         try {
-            if (audioUrl) {
+            if (uploadId) {
+                media = await loadUploadedMedia(uploadId, mimetype, filename || 'audio');
+            } else if (mediaHash) {
+                media = await loadStoredMedia(mediaHash, mimetype, filename || 'audio');
+            } else if (audioUrl) {
                 // Processar URLs que usam localhost ou 127.0.0.1
                 let processedUrl = audioUrl;
 